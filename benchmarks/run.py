@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+"""
+Benchmark the overhead of Quibble itself.
+
+External tools (php, composer, npm, mysqld...) are replaced by the stubs in
+benchmarks/fakes and git repositories are created locally, so the timings
+only reflect the orchestration done by Quibble.
+
+Results are written as JSON. Given the results of an earlier run, the
+benchmarks which became slower are reported and the exit code is 1.
+"""
+
+import argparse
+from collections import OrderedDict
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import quibble.backend  # noqa: E402
+import quibble.cmd  # noqa: E402
+import quibble.gitchangedinhead  # noqa: E402
+import quibble.resources  # noqa: E402
+import quibble.test  # noqa: E402
+import quibble.zuul  # noqa: E402
+from zuul.lib.clonemapper import CloneMapper  # noqa: E402
+from zuul.lib.cloner import Cloner  # noqa: E402
+
+FAKES_DIR = os.path.join(BENCHMARKS_DIR, 'fakes')
+
+log = logging.getLogger('benchmarks')
+
+
+def git(*args, cwd=None):
+    subprocess.check_call(['git'] + list(args), cwd=cwd,
+                          stdout=subprocess.DEVNULL)
+
+
+def make_repo(path, files=(), message='Initial commit'):
+    """
+    Git repository at path with a commit adding files.
+    """
+    os.makedirs(path, exist_ok=True)
+    if not os.path.exists(os.path.join(path, '.git')):
+        git('init', '-q', path)
+    for name in files:
+        filename = os.path.join(path, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'a') as f:
+            f.write('%s\n' % message)
+    git('add', '-A', cwd=path)
+    git('-c', 'user.name=Bench', '-c', 'user.email=bench@example.org',
+        'commit', '-q', '--allow-empty', '-m', message, cwd=path)
+
+
+def make_bare_repos(git_dir, projects):
+    for project in projects:
+        work = os.path.join(git_dir, 'work', project)
+        make_repo(work, files=['README'])
+        git('clone', '-q', '--bare', work, os.path.join(git_dir, project))
+
+
+def quiet_logging():
+    # Only report the benchmarks
+    for name in ['quibble', 'zuul', 'backend', 'test', 'mw']:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+class Benchmarks:
+
+    def __init__(self, repeat=5, repos=20):
+        self.repeat = repeat
+        self.repos = repos
+        self.results = OrderedDict()
+
+    def measure(self, name, func, setup=None, number=1):
+        """
+        Time func, called number times per round, over repeat rounds.
+
+        setup is called before each round, outside of the timing, and its
+        return value is passed to func.
+        """
+        times = []
+        for _ in range(self.repeat):
+            arg = setup() if setup else None
+            start = time.perf_counter()
+            for _ in range(number):
+                func(arg) if setup else func()
+            times.append((time.perf_counter() - start) / number)
+        self.results[name] = OrderedDict([
+            ('min', min(times)),
+            ('median', statistics.median(times)),
+            ('mean', statistics.mean(times)),
+            ('repeat', self.repeat),
+            ('number', number),
+        ])
+        log.info('%-35s %8.4fs (median)' % (
+            name, self.results[name]['median']))
+
+    def bench_cloner(self, tmpdir):
+        projects = ['mediawiki/core'] + [
+            'mediawiki/extensions/Ext%s' % i for i in range(self.repos)]
+        git_dir = os.path.join(tmpdir, 'git')
+        make_bare_repos(git_dir, projects)
+
+        def cloner(workspace):
+            c = Cloner(git_base_url='file://%s' % git_dir,
+                       projects=projects,
+                       workspace=workspace,
+                       zuul_branch=None, zuul_ref=None, zuul_url=None,
+                       branch='master')
+            c.clone_map = quibble.zuul.CLONE_MAP
+            return c
+
+        workspaces = iter(range(self.repeat * 2))
+
+        def fresh_workspace():
+            return cloner(os.path.join(tmpdir, 'ws%s' % next(workspaces)))
+
+        self.measure('cloner.execute clone (%s repos)' % len(projects),
+                     lambda c: c.execute(), setup=fresh_workspace)
+
+        existing = cloner(os.path.join(tmpdir, 'ws-update'))
+        existing.execute()
+        self.measure('cloner.execute update (%s repos)' % len(projects),
+                     existing.execute)
+
+    def bench_clonemapper(self):
+        projects = ['mediawiki/core', 'mediawiki/vendor'] + [
+            'mediawiki/%s/Repo%s' % (kind, i)
+            for kind in ('extensions', 'skins') for i in range(250)]
+        mapper = CloneMapper(quibble.zuul.CLONE_MAP, projects)
+        self.measure('clonemapper.expand (%s)' % len(projects),
+                     lambda: mapper.expand(workspace='/workspace'),
+                     number=10)
+
+    def bench_gitchangedinhead(self, tmpdir):
+        repo = os.path.join(tmpdir, 'changed')
+        make_repo(repo, files=['README'])
+        make_repo(repo, message='Change', files=[
+            'includes/File%s.php' % i for i in range(200)])
+
+        def changed_files():
+            return quibble.gitchangedinhead.GitChangedInHead(
+                ['php'], cwd=repo).changedFiles()
+
+        self.measure(
+            'gitchangedinhead uncached',
+            lambda _: changed_files(),
+            setup=quibble.gitchangedinhead.clear_cache)
+        self.measure('gitchangedinhead cached', changed_files, number=10)
+
+    def bench_backends(self, tmpdir):
+        def start_stop(backend):
+            backend.start()
+            backend.stop()
+
+        self.measure(
+            'backend DevWebServer start/stop',
+            start_stop,
+            setup=lambda: quibble.backend.DevWebServer(
+                port=quibble.resources.ResourceAllocator(
+                    runtime_dir=tmpdir).port(4881),
+                mwdir=tmpdir, router=None))
+
+        with mock.patch.object(quibble.backend.MySQL, 'mysqld',
+                               os.path.join(FAKES_DIR, 'mysqld')):
+            self.measure(
+                'backend MySQL start/stop',
+                start_stop,
+                setup=lambda: quibble.backend.MySQL(base_dir=tmpdir))
+
+    def bench_parallel_run(self):
+        tasks = [(time.sleep, 0)] * 20
+        self.measure('parallel_run (20 no-op tasks)',
+                     lambda: quibble.test.parallel_run(tasks, workers=4))
+        self.measure('thread_run (20 no-op tasks)',
+                     lambda: quibble.test.thread_run(
+                         [lambda: None] * 20, workers=4))
+
+    def bench_execute(self, tmpdir):
+        counter = iter(range(self.repeat))
+
+        def workspace():
+            ws = os.path.join(tmpdir, 'execute%s' % next(counter))
+            core = os.path.join(ws, 'src')
+            os.makedirs(core)
+            with open(os.path.join(core, 'composer.json'), 'w') as f:
+                json.dump({'require-dev': {'phpunit/phpunit': '6.5.8'}}, f)
+            make_repo(core, files=['index.php'])
+            # Installed by npm
+            os.makedirs(os.path.join(core, 'node_modules/.bin'))
+            os.symlink(os.path.join(FAKES_DIR, 'npm'),
+                       os.path.join(core, 'node_modules/.bin/grunt'))
+            make_repo(os.path.join(ws, 'src/skins/Vector'),
+                      files=['skin.json'])
+            make_repo(os.path.join(ws, 'src/vendor'),
+                      files=['autoload.php', 'composer.json',
+                             'composer/autoload_files.php'])
+            return ws
+
+        def execute(ws):
+            with mock.patch.dict(os.environ, {
+                    'ZUUL_PROJECT': 'mediawiki/core'}):
+                quibble.cmd.QuibbleCmd().execute([
+                    '--skip-zuul', '--db', 'sqlite',
+                    '--workspace', ws, '--log-dir', 'log',
+                    '--runtime-dir', os.path.join(tmpdir, 'runtime')])
+
+        self.measure('QuibbleCmd.execute', execute, setup=workspace)
+
+    def run(self):
+        with tempfile.TemporaryDirectory(prefix='quibble-bench-') as tmpdir:
+            self.bench_clonemapper()
+            self.bench_parallel_run()
+            self.bench_gitchangedinhead(tmpdir)
+            self.bench_cloner(tmpdir)
+            self.bench_backends(tmpdir)
+            self.bench_execute(tmpdir)
+        return self.results
+
+
+def compare(results, baseline, threshold):
+    """
+    Names of benchmarks whose median is slower than baseline by more than
+    threshold (a ratio).
+    """
+    slower = []
+    for (name, result) in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['median'] > before['median'] * (1 + threshold):
+            log.warning('%s: %.4fs, was %.4fs' % (
+                name, result['median'], before['median']))
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', default=5, type=int,
+                        help='Rounds per benchmark. Default: 5')
+    parser.add_argument('--repos', default=20, type=int,
+                        help='Extensions to clone. Default: 20')
+    parser.add_argument('--output', default=None, metavar='FILE',
+                        help='Write the results to FILE. Default: stdout')
+    parser.add_argument('--compare', default=None, metavar='FILE',
+                        help='Results of an earlier run to compare with')
+    parser.add_argument('--threshold', default=20, type=int,
+                        metavar='PERCENT',
+                        help=('How much slower a benchmark must be to be '
+                              'reported. Default: 20'))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    quiet_logging()
+
+    os.environ['PATH'] = os.pathsep.join([FAKES_DIR, os.environ['PATH']])
+    os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='quibble-bench-')
+
+    results = Benchmarks(repeat=args.repeat, repos=args.repos).run()
+    output = json.dumps(OrderedDict([
+        ('python', platform.python_version()),
+        ('results', results),
+    ]), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold / 100):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,6 +16,7 @@
 from functools import lru_cache
 import logging
 import os
+import re
 import subprocess
 
 
@@ -45,7 +46,21 @@ def use_headless():
     return not bool(os.environ.get('DISPLAY'))
 
 
-def chromium_flags():
+@lru_cache(maxsize=1)
+def chromium_supports_headless():
+    """
+    Whether Chromium can run without any X server (since Chromium 59).
+    """
+    chrome_bin = os.environ.get('CHROME_BIN', '/usr/bin/chromium')
+    try:
+        version = subprocess.check_output([chrome_bin, '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    major = re.search(rb' (\d+)\.', version)
+    return bool(major) and int(major.group(1)) >= 59
+
+
+def chromium_flags(remote_debugging_port=9222):
     args = [os.environ.get('CHROMIUM_FLAGS', '')]
 
     # play() would fail if the user didn't interact with the document
@@ -63,7 +78,7 @@ def chromium_flags():
         args.extend([
             '--headless',
             '--disable-gpu',
-            '--remote-debugging-port=9222',
+            '--remote-debugging-port=%s' % remote_debugging_port,
         ])
 
     log = logging.getLogger('quibble.chromium_flags')
@@ -0,0 +1,248 @@
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+from collections import OrderedDict
+import concurrent.futures
+import fnmatch
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+log = logging.getLogger('quibble.artifacts')
+
+MANIFEST = 'artifacts.json'
+CHUNK = 1024 * 1024
+
+# Read as is by CI
+KEEP = ['junit*.xml', '*.json', 'LocalSettings*.php']
+COMPRESSED = ['*.gz', '*.zst', '*.xz', '*.bz2', '*.zip']
+# Whose middle can be dropped
+TRUNCATABLE = ['*.log', '*.txt']
+
+
+def matches(path, patterns):
+    name = os.path.basename(path)
+    return any(fnmatch.fnmatch(name, p) for p in patterns)
+
+
+def written_at_teardown(path):
+    """
+    Whether the file can still be written while backends are stopped.
+
+    MediaWiki logs of web requests are written until the web server stops,
+    databases are dumped once stopped.
+    """
+    name = os.path.basename(path)
+    return ((fnmatch.fnmatch(name, 'mw-*.log')
+             and name != 'mw-debug-cli.log')
+            or path.split(os.sep)[0] in ('mysqldump', 'pg_dump')
+            or name.endswith('.sqlite.gz'))
+
+
+def sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def truncate_middle(path, max_size):
+    """
+    Keep the first and last max_size / 2 bytes of path. Return the number
+    of bytes dropped.
+    """
+    size = os.path.getsize(path)
+    if size <= max_size:
+        return 0
+    half = max_size // 2
+    dropped = size - 2 * half
+    tmp = path + '.truncating'
+    with open(path, 'rb') as src, open(tmp, 'wb') as dest:
+        remaining = half
+        while remaining:
+            chunk = src.read(min(CHUNK, remaining))
+            dest.write(chunk)
+            remaining -= len(chunk)
+        dest.write(b'\n[... %d bytes truncated by Quibble ...]\n' % dropped)
+        src.seek(size - half)
+        shutil.copyfileobj(src, dest, CHUNK)
+    os.replace(tmp, path)
+    return dropped
+
+
+def compress(path):
+    """
+    Replace path by path.gz, streaming. Return the compressed file name.
+    """
+    dest = path + '.gz'
+    with open(path, 'rb') as src, gzip.open(dest, 'wb', compresslevel=6) as f:
+        shutil.copyfileobj(src, f, CHUNK)
+    shutil.copystat(path, dest)
+    os.unlink(path)
+    return dest
+
+
+class Packager:
+    """
+    Shrink the content of the log directory for archiving.
+
+    Files with the same content are hard links to the first copy, the
+    middle of logs larger than max_size is dropped and files larger than
+    min_size are compressed with gzip. What was done is recorded in
+    artifacts.json.
+
+    start() handles the files which are complete once the tests are done,
+    in the background while backends are stopped. finish() handles the rest.
+    """
+
+    def __init__(self, log_dir, max_size=None, min_size=64 * 1024,
+                 workers=None):
+        self.log_dir = log_dir
+        self.max_size = max_size
+        self.min_size = min_size
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            workers or min(os.cpu_count() or 1, 8))
+        self.entries = OrderedDict()
+        self.digests = {}
+        self.outputs = set()
+        self._thread = None
+        self._start = None
+
+    def files(self):
+        found = []
+        for (root, dirs, files) in os.walk(self.log_dir):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.relpath(os.path.join(root, name),
+                                       self.log_dir)
+                if path == MANIFEST or path in self.entries \
+                        or path in self.outputs \
+                        or os.path.islink(os.path.join(root, name)):
+                    continue
+                found.append(path)
+        return found
+
+    def package(self, paths):
+        digests = list(self.pool.map(
+            lambda p: sha256(os.path.join(self.log_dir, p)), paths))
+
+        # In order, so that the first copy is kept
+        todo = []
+        duplicates = []
+        for (path, digest) in zip(paths, digests):
+            size = os.path.getsize(os.path.join(self.log_dir, path))
+            entry = OrderedDict([('size', size), ('sha256', digest)])
+            self.entries[path] = entry
+            if matches(path, KEEP):
+                continue
+            if size >= self.min_size and digest in self.digests:
+                entry['duplicate_of'] = self.digests[digest]
+                duplicates.append(path)
+                continue
+            self.digests.setdefault(digest, path)
+            todo.append(path)
+
+        for future in [self.pool.submit(self.shrink, p) for p in todo]:
+            future.result()
+        # Once the first copies are shrunk
+        for path in duplicates:
+            self.link_duplicate(path)
+
+    def link_duplicate(self, path):
+        """
+        Replace path by a hard link to the packaged first copy of its content.
+        """
+        entry = self.entries[path]
+        first = entry['duplicate_of']
+        original = self.entries[first]
+        target = original.get('compressed', first)
+        # With the extension of the compressed first copy
+        link = path + target[len(first):]
+        filename = os.path.join(self.log_dir, path)
+        tmp = os.path.join(self.log_dir, link + '.linking')
+        try:
+            os.link(os.path.join(self.log_dir, target), tmp)
+            os.replace(tmp, os.path.join(self.log_dir, link))
+        except OSError as e:
+            log.warning('%s: could not link to %s: %s' % (path, target, e))
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            del entry['duplicate_of']
+            self.shrink(path)
+            return
+        if link != path:
+            os.unlink(filename)
+            self.outputs.add(link)
+        for key in ['truncated', 'compressed', 'compressed_size']:
+            if key in original:
+                entry[key] = original[key]
+        if 'compressed' in entry:
+            entry['compressed'] = link
+
+    def shrink(self, path):
+        entry = self.entries[path]
+        filename = os.path.join(self.log_dir, path)
+        if self.max_size and matches(path, TRUNCATABLE):
+            dropped = truncate_middle(filename, self.max_size)
+            if dropped:
+                log.warning('%s: dropped %d bytes' % (path, dropped))
+                entry['truncated'] = dropped
+        if matches(path, COMPRESSED) \
+                or os.path.getsize(filename) < self.min_size:
+            return
+        compressed = compress(filename)
+        entry['compressed'] = os.path.relpath(compressed, self.log_dir)
+        entry['compressed_size'] = os.path.getsize(compressed)
+        self.outputs.add(entry['compressed'])
+
+    def _package_early(self):
+        try:
+            self.package([p for p in self.files()
+                          if not written_at_teardown(p)])
+        except Exception:
+            log.exception('Could not package artifacts')
+
+    def start(self):
+        self._start = time.monotonic()
+        self._thread = threading.Thread(target=self._package_early,
+                                        name='artifacts', daemon=True)
+        self._thread.start()
+
+    def finish(self):
+        if self._thread is None:
+            self._start = time.monotonic()
+        else:
+            self._thread.join()
+
+        try:
+            self.package(self.files())
+        finally:
+            self.pool.shutdown()
+        with open(os.path.join(self.log_dir, MANIFEST), 'w') as f:
+            json.dump(self.entries, f, indent=2)
+
+        before = sum(e['size'] for e in self.entries.values())
+        after = sum(
+            e['compressed_size'] if 'compressed_size' in e
+            else e['size'] - e.get('truncated', 0)
+            for e in self.entries.values() if 'duplicate_of' not in e)
+        log.info('Packaged %s files in %.1fs: %.1f MiB -> %.1f MiB' % (
+            len(self.entries), time.monotonic() - self._start,
+            before / 1048576, after / 1048576))
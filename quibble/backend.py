@@ -13,12 +13,16 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 
+from collections import OrderedDict
+import concurrent.futures
 import json
 import logging
 import os
 import pwd
+import shutil
 import signal
 import socket
+import sqlite3
 import subprocess
 import sys
 import tempfile
@@ -65,6 +69,49 @@ def getDBClass(engine):
     raise Exception('Backend database engine not supported: %s' % engine)
 
 
+# Command compressing its standard input to its standard output, and the
+# extension of the compressed file.
+COMPRESSORS = {
+    'gzip': (['gzip', '--fast', '--stdout'], '.gz'),
+    'zstd': (['zstd', '--quiet', '--stdout'], '.zst'),
+}
+
+
+def dump_compressed(cmd, filename, compression='gzip', **kwargs):
+    """
+    Stream the output of cmd to filename through a compressor.
+
+    The extension of the compression is appended to filename. stderr of cmd
+    is kept apart and returned.
+    """
+    (compressor, extension) = COMPRESSORS[compression]
+    with open(filename + extension, 'wb') as out:
+        dumper = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, **kwargs)
+        compress = subprocess.Popen(compressor, stdin=dumper.stdout,
+                                    stdout=out)
+        # Let the dumper get SIGPIPE should the compressor die
+        dumper.stdout.close()
+        errors = dumper.stderr.read().decode(errors='replace')
+        dumper.wait()
+        compress.wait()
+    if dumper.returncode != 0 or compress.returncode != 0:
+        raise Exception('Dump to %s failed (%s, %s): %s' % (
+            filename + extension, dumper.returncode, compress.returncode,
+            errors))
+    return errors
+
+
+def compress_file(source, filename, compression='gzip'):
+    """
+    Compress source to filename, with the extension of the compression
+    appended.
+    """
+    (compressor, extension) = COMPRESSORS[compression]
+    with open(source, 'rb') as f, open(filename + extension, 'wb') as out:
+        subprocess.check_call(compressor, stdin=f, stdout=out)
+
+
 def stream_relay(process, stream, log_function):
     thread = threading.Thread(
         target=stream_to_log,
@@ -81,6 +128,140 @@ def stream_to_log(process, stream, log_function):
         log_function(line.rstrip())
 
 
+class BackendRegistry:
+    """
+    Hold backends for the whole run.
+
+    Backends are registered with a factory and are only started the first time
+    a stage asks for them with get(). stop() shuts them all down once, in
+    reverse order of startup.
+
+    The key given on registration describes the configuration of the backend,
+    or is a callable returning it when the backend is started. It tells
+    registries keeping backends across runs whether one can be reused.
+    """
+
+    log = logging.getLogger('backend.registry')
+    # quibble.cgroup.Cgroups to start each backend in a cgroup of its own
+    cgroups = None
+    # quibble.trace.Tracer recording the start of backends
+    tracer = None
+
+    def __init__(self):
+        self._factories = {}
+        self._keys = {}
+        self._backends = OrderedDict()
+        # Stages running concurrently may ask for the same backend. Reentrant
+        # since a factory can depend on another backend.
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __contains__(self, name):
+        return name in self._backends
+
+    def started(self, name):
+        """
+        The backend registered as name if it is running, else None.
+        """
+        return self._backends.get(name)
+
+    def register(self, name, factory, key=None):
+        self._factories[name] = factory
+        self._keys[name] = key
+
+    def key(self, name):
+        key = self._keys.get(name)
+        return key() if callable(key) else key
+
+    def get(self, name):
+        with self._lock:
+            if name not in self._backends:
+                if name not in self._factories:
+                    raise Exception('No backend registered as "%s"' % name)
+                backend = self._factories[name]()
+                self.log.debug('Starting backend %s' % name)
+                start = time.monotonic()
+                if self.cgroups is None:
+                    backend.start()
+                else:
+                    with self.cgroups.enter('backend-%s' % name):
+                        backend.start()
+                end = time.monotonic()
+                self.log.info('Started %s in %.2fs' % (name, end - start))
+                if self.tracer is not None:
+                    # start() returns once the backend is ready
+                    self.tracer.add_span('start %s' % name, 'backend',
+                                         start, end)
+                self._backends[name] = backend
+            return self._backends[name]
+
+    def stop(self):
+        for name in reversed(list(self._backends)):
+            self.stop_backend(name)
+
+    def stop_backend(self, name):
+        backend = self._backends.pop(name)
+        self.log.debug('Stopping backend %s' % name)
+        peak_rss = backend.peak_rss()
+        if peak_rss:
+            self.log.info('%s peak RSS: %.1f MiB' % (
+                name, peak_rss / 1024 / 1024))
+        try:
+            backend.stop()
+        except Exception:
+            self.log.exception('Failed to stop backend %s' % name)
+        if self.cgroups is not None:
+            usage = self.cgroups.usage('backend-%s' % name)
+            if usage:
+                self.log.info('%s usage: %s' % (name, ', '.join(
+                    '%s: %s' % (k, v) for (k, v) in usage.items())))
+            self.cgroups.remove('backend-%s' % name)
+
+
+def process_tree(pid):
+    """
+    pid and the pids of all its descendants, read from /proc.
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name is between parenthesis and may contain spaces
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [pid]
+    for parent in pids:
+        pids.extend(children.get(parent, []))
+    return pids
+
+
+def peak_rss(pids):
+    """
+    Sum of peak resident set size (VmHWM) of processes, in bytes.
+    """
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/%s/status' % pid) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
 class BackendServer:
 
     server = None
@@ -97,6 +278,20 @@ class BackendServer:
     def start(self):
         pass
 
+    def pids(self):
+        if self.server is None:
+            return []
+        return process_tree(self.server.pid)
+
+    def peak_rss(self):
+        return peak_rss(self.pids())
+
+    def reset(self):
+        """
+        Get back to the state right after start(), for another run.
+        """
+        pass
+
     def stop(self):
         if self.server is not None:
             self.log.info('Terminating %s' % self.__class__.__name__)
@@ -112,10 +307,14 @@ class BackendServer:
 class DatabaseServer(BackendServer):
 
     dump_dir = None
+    # Tables dumped concurrently
+    dump_jobs = min(os.cpu_count() or 1, 8)
 
-    def __init__(self, base_dir=None, dump_dir=None):
+    def __init__(self, base_dir=None, dump_dir=None, dump_compression='gzip'):
         super(DatabaseServer, self).__init__()
         self.dump_dir = dump_dir
+        self.dump_compression = dump_compression
+        self._dumped = False
         self._init_rootdir(base_dir)
 
     def _init_rootdir(self, base_dir):
@@ -132,23 +331,58 @@ class DatabaseServer(BackendServer):
         self.rootdir = self._tmpdir.name
         self.log.debug('Root dir: %s' % self.rootdir)
 
+    def reset(self):
+        raise Exception('%s can not be reset' % self.__class__.__name__)
+
+    def checkpoint(self):
+        """
+        Save the content of the wiki database, for restore() to get back to.
+
+        Replaces an earlier checkpoint, reset() discards it.
+        """
+        raise Exception('%s does not support checkpoints' % (
+            self.__class__.__name__))
+
+    def restore(self):
+        """
+        Bring the wiki database back to the last checkpoint().
+        """
+        raise Exception('%s does not support checkpoints' % (
+            self.__class__.__name__))
+
+    def dump_once(self):
+        """
+        Dump the database to dump_dir, when set and not dumped yet.
+        """
+        # stop() is called again on garbage collection
+        if self.dump_dir and not self._dumped:
+            self._dumped = True
+            start = time.monotonic()
+            try:
+                self.dump()
+            except Exception:
+                # The server must be stopped regardless
+                self.log.exception('Could not dump the database')
+            else:
+                self.log.info('Dumped in %.1fs' % (time.monotonic() - start))
+
     def stop(self):
-        if self.dump_dir:
-            self.dump()
+        self.dump_once()
         super(DatabaseServer, self).stop()
 
     def dump(self):
         self.log.warning('%s does not support dumping database' % (
-            self.__class__.__name))
+            self.__class__.__name__))
 
 
 class Postgres(DatabaseServer):
 
-    def __init__(self, base_dir=None, dump_dir=None):
-        super(Postgres, self).__init__(base_dir, dump_dir)
+    def __init__(self, base_dir=None, dump_dir=None, dump_compression='gzip'):
+        super(Postgres, self).__init__(base_dir, dump_dir, dump_compression)
 
         self.conffile = os.path.join(self.rootdir, 'conf')
         self.socket = os.path.join(self.rootdir, 'socket')
+        self._checkpointed = False
 
     def start(self):
         # Start pg_virtualenv and save configuration settings
@@ -173,9 +407,103 @@ class Postgres(DatabaseServer):
         self.dbname = conf['PGDATABASE']
         self.dbserver = self.socket
         self.hook_pid = conf['PID']
+        self.checkpoint_name = '%s_checkpoint' % self.dbname
         self.log.info('Postgres is ready')
 
+    def _env(self):
+        return dict(os.environ, PGPASSWORD=self.password)
+
+    def _psql(self, sql):
+        p = subprocess.Popen([
+            'psql',
+            '--host=%s' % self.dbserver,
+            '--username=%s' % self.user,
+            '--dbname=postgres',
+            '--no-psqlrc',
+            '--quiet',
+            '--set=ON_ERROR_STOP=1',
+            ],
+            env=self._env(),
+            universal_newlines=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        outs, errs = p.communicate(input=sql)
+        if p.returncode != 0:
+            raise Exception("FAILED (%s): %s" % (p.returncode, outs))
+
+    def _clone(self, source, target):
+        # Neither a template nor a dropped database can have connections
+        self._psql(
+            "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+            "WHERE datname IN ('%s', '%s') AND pid <> pg_backend_pid();\n"
+            "DROP DATABASE IF EXISTS %s;\n"
+            "CREATE DATABASE %s TEMPLATE %s;\n" % (
+                source, target, target, target, source))
+
+    def checkpoint(self):
+        start = time.monotonic()
+        self._clone(self.dbname, self.checkpoint_name)
+        self._checkpointed = True
+        self.log.info('Checkpoint of %s in %.2fs' % (
+            self.dbname, time.monotonic() - start))
+
+    def restore(self):
+        if not self._checkpointed:
+            raise Exception('No checkpoint to restore %s from' % self.dbname)
+        start = time.monotonic()
+        self._clone(self.checkpoint_name, self.dbname)
+        self.log.info('Restored %s in %.2fs' % (
+            self.dbname, time.monotonic() - start))
+
+    def _dump_compress(self):
+        if self.dump_compression != 'zstd':
+            return '6'
+        # Compression methods other than gzip came with PostgreSQL 16
+        version = subprocess.check_output(
+            ['pg_dump', '--version'], universal_newlines=True)
+        try:
+            major = int(version.split()[-1].split('.')[0])
+        except ValueError:
+            major = 0
+        if major < 16:
+            self.log.warning('%s can not compress with zstd, using gzip' % (
+                version.strip()))
+            return '6'
+        return 'zstd'
+
+    def dump(self):
+        # Directory format, the only one pg_dump can write with several
+        # jobs. Tables are compressed by pg_dump itself.
+        dumpdir = os.path.join(self.dump_dir, 'pg_dump')
+        self.log.info('Dumping database to %s' % dumpdir)
+        if os.path.exists(dumpdir):
+            shutil.rmtree(dumpdir)
+        p = subprocess.Popen([
+            'pg_dump',
+            '--host=%s' % self.dbserver,
+            '--username=%s' % self.user,
+            '--format=directory',
+            '--jobs=%s' % self.dump_jobs,
+            '--compress=%s' % self._dump_compress(),
+            '--file=%s' % dumpdir,
+            self.dbname,
+            ],
+            env=self._env(),
+            universal_newlines=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        outs, errs = p.communicate()
+        if p.returncode != 0:
+            raise Exception("FAILED (%s): %s" % (p.returncode, errs))
+
     def stop(self):
+        if self.server is None:
+            return
+        # pg_virtualenv deletes the cluster once the hook exits
+        self.dump_once()
         # Send a signal to the hook since it's waiting on one
         os.kill(self.hook_pid, signal.SIGUSR1)
         super(Postgres, self).stop()
@@ -186,19 +514,25 @@ class Postgres(DatabaseServer):
 
 class MySQL(DatabaseServer):
 
+    # Not in the PATH of regular users on Debian
+    mysqld = '/usr/sbin/mysqld'
+
     def __init__(
         self,
         base_dir=None,
         dump_dir=None,
         user='wikiuser',
         password='secret',
-        dbname='wikidb'
+        dbname='wikidb',
+        dump_compression='gzip'
     ):
-        super(MySQL, self).__init__(base_dir, dump_dir)
+        super(MySQL, self).__init__(base_dir, dump_dir, dump_compression)
 
         self.user = user
         self.password = password
         self.dbname = dbname
+        self.checkpoint_name = '%s_checkpoint' % dbname
+        self._checkpointed = False
 
         self.errorlog = os.path.join(self.rootdir, 'error.log')
         self.pidfile = os.path.join(self.rootdir, 'mysqld.pid')
@@ -226,30 +560,56 @@ class MySQL(DatabaseServer):
         if p.returncode != 0:
             raise Exception("FAILED (%s): %s" % (p.returncode, outs))
 
-    def _createwikidb(self):
-        self.log.info('Creating the wiki database and grant')
+    def _mysql(self, sql, args=()):
         p = subprocess.Popen([
             'mysql',
             '--user=root',
             '--socket=%s' % self.socket,
-            ],
+            ] + list(args),
             universal_newlines=True,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             )
-        grant = ("CREATE DATABASE IF NOT EXISTS %s;"
-                 "GRANT ALL ON %s.* TO '%s'@'localhost'"
-                 "IDENTIFIED BY '%s';\n" % (
-                     self.dbname, self.dbname, self.user, self.password))
-        outs, errs = p.communicate(input=grant)
+        outs, errs = p.communicate(input=sql)
         if p.returncode != 0:
             raise Exception("FAILED (%s): %s" % (p.returncode, outs))
+        return outs
+
+    def _createwikidb(self, drop=False):
+        self.log.info('Creating the wiki database and grant')
+        grant = ''
+        if drop:
+            grant += "DROP DATABASE IF EXISTS %s;" % self.dbname
+        grant += ("CREATE DATABASE IF NOT EXISTS %s;"
+                  "GRANT ALL ON %s.* TO '%s'@'localhost'"
+                  "IDENTIFIED BY '%s';\n" % (
+                      self.dbname, self.dbname, self.user, self.password))
+        self._mysql(grant)
+
+    def _copy_database(self, source, target):
+        # MySQL has no template databases, copy the tables. Done in a single
+        # client invocation since most tables of a fresh wiki are empty.
+        tables = self._mysql(
+            'SHOW TABLES;\n', args=['--batch', '--skip-column-names', source]
+        ).split()
+        sql = [
+            'SET SESSION FOREIGN_KEY_CHECKS=0;',
+            'DROP DATABASE IF EXISTS %s;' % target,
+            'CREATE DATABASE %s;' % target,
+        ]
+        for table in tables:
+            sql.append('CREATE TABLE %s.`%s` LIKE %s.`%s`;' % (
+                target, table, source, table))
+            sql.append('INSERT INTO %s.`%s` SELECT * FROM %s.`%s`;' % (
+                target, table, source, table))
+        self._mysql('\n'.join(sql) + '\n')
+        return len(tables)
 
     def start(self):
         self.log.info('Starting MySQL')
         self.server = subprocess.Popen([
-            '/usr/sbin/mysqld',  # fixme drop path
+            self.mysqld,
             '--skip-networking',
             '--datadir=%s' % self.rootdir,
             '--log-error=%s' % self.errorlog,
@@ -271,21 +631,66 @@ class MySQL(DatabaseServer):
         self._createwikidb()
         self.log.info('MySQL is ready')
 
-    def dump(self):
-        dumpfile = os.path.join(self.dump_dir, 'mysqldump.sql')
-        self.log.info('Dumping database to %s' % dumpfile)
-
-        mysqldump = open(dumpfile, 'wb')
-        subprocess.Popen([
-                'mysqldump',
-                '--socket=%s' % self.socket,
-                '--user=root',
-                '--all-databases'
+    def reset(self):
+        if self._checkpointed:
+            self._mysql('DROP DATABASE IF EXISTS %s;\n' % (
+                self.checkpoint_name))
+            self._checkpointed = False
+        self._createwikidb(drop=True)
+        # The next run dumps its own database
+        self._dumped = False
+
+    def checkpoint(self):
+        start = time.monotonic()
+        count = self._copy_database(self.dbname, self.checkpoint_name)
+        self._checkpointed = True
+        self.log.info('Checkpoint of %s tables in %.2fs' % (
+            count, time.monotonic() - start))
+
+    def restore(self):
+        if not self._checkpointed:
+            raise Exception('No checkpoint to restore %s from' % self.dbname)
+        start = time.monotonic()
+        # Grants are kept since they are not tied to the database
+        count = self._copy_database(self.checkpoint_name, self.dbname)
+        self.log.info('Restored %s tables in %.2fs' % (
+            count, time.monotonic() - start))
+
+    def _dump_table(self, dumpdir, database, table):
+        errors = dump_compressed([
+            'mysqldump',
+            '--socket=%s' % self.socket,
+            '--user=root',
+            '--single-transaction',
+            database, table,
             ],
-            stdin=subprocess.PIPE,
-            stdout=mysqldump,
-            stderr=subprocess.STDOUT,
-        ).wait()
+            os.path.join(dumpdir, '%s.%s.sql' % (database, table)),
+            compression=self.dump_compression)
+        if errors:
+            self.log.warning('%s.%s: %s' % (database, table, errors.strip()))
+
+    def dump(self):
+        # One file per table, dumped concurrently
+        dumpdir = os.path.join(self.dump_dir, 'mysqldump')
+        self.log.info('Dumping database to %s' % dumpdir)
+        os.makedirs(dumpdir, exist_ok=True)
+
+        tables = [
+            line.split('\t') for line in self._mysql(
+                "SELECT table_schema, table_name "
+                "FROM information_schema.tables "
+                "WHERE table_type = 'BASE TABLE' AND table_schema NOT IN "
+                "('information_schema', 'performance_schema', 'sys');\n",
+                args=['--batch', '--skip-column-names']
+            ).splitlines() if line]
+
+        with concurrent.futures.ThreadPoolExecutor(self.dump_jobs) as pool:
+            futures = [pool.submit(self._dump_table, dumpdir, db, table)
+                       for (db, table) in tables]
+        # Raises the first failure
+        for future in futures:
+            future.result()
+        self.log.info('Dumped %s tables' % len(tables))
 
     def __str__(self):
         return self.socket
@@ -296,24 +701,96 @@ class MySQL(DatabaseServer):
 
 class SQLite(DatabaseServer):
 
-    def __init__(self, base_dir=None, dump_dir=None, dbname='wikidb'):
-        super(SQLite, self).__init__(base_dir, dump_dir)
+    def __init__(self, base_dir=None, dump_dir=None, dbname='wikidb',
+                 dump_compression='gzip'):
+        super(SQLite, self).__init__(base_dir, dump_dir, dump_compression)
 
         self.dbname = dbname
+        # Under rootdir so that reset() discards it
+        self.checkpoint_dir = os.path.join(self.rootdir, '.checkpoint')
 
     def start(self):
         # Created by MediaWiki
         pass
 
+    def _databases(self, directory):
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name for name in os.listdir(directory)
+                      if name.endswith('.sqlite'))
+
+    def _copy(self, source, target):
+        # The backup API gives a consistent copy even with connections opened
+        # on either database, and is faster than going through SQL.
+        src = sqlite3.connect(source)
+        try:
+            dest = sqlite3.connect(target)
+            try:
+                src.backup(dest)
+            finally:
+                dest.close()
+        finally:
+            src.close()
+
+    def dump(self):
+        self.log.info('Dumping database to %s' % self.dump_dir)
+        for name in self._databases(self.rootdir):
+            # A consistent copy, then compressed
+            with tempfile.NamedTemporaryFile(
+                    dir=self.rootdir, suffix='.sqlite') as copy:
+                self._copy(os.path.join(self.rootdir, name), copy.name)
+                compress_file(copy.name, os.path.join(self.dump_dir, name),
+                              compression=self.dump_compression)
+
+    def checkpoint(self):
+        start = time.monotonic()
+        if os.path.exists(self.checkpoint_dir):
+            shutil.rmtree(self.checkpoint_dir)
+        os.mkdir(self.checkpoint_dir)
+        databases = self._databases(self.rootdir)
+        for name in databases:
+            self._copy(os.path.join(self.rootdir, name),
+                       os.path.join(self.checkpoint_dir, name))
+        self.log.info('Checkpoint of %s in %.2fs' % (
+            ', '.join(databases), time.monotonic() - start))
+
+    def restore(self):
+        if not os.path.isdir(self.checkpoint_dir):
+            raise Exception('No checkpoint to restore %s from' % self.dbname)
+        start = time.monotonic()
+        databases = self._databases(self.checkpoint_dir)
+        for name in self._databases(self.rootdir):
+            if name not in databases:
+                os.unlink(os.path.join(self.rootdir, name))
+        for name in databases:
+            self._copy(os.path.join(self.checkpoint_dir, name),
+                       os.path.join(self.rootdir, name))
+        self.log.info('Restored %s in %.2fs' % (
+            ', '.join(databases), time.monotonic() - start))
+
+    def reset(self):
+        for name in os.listdir(self.rootdir):
+            path = os.path.join(self.rootdir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        # The next run dumps its own database
+        self._dumped = False
+
 
 class ChromeWebDriver(BackendServer):
 
-    def __init__(self, display=None, port=4444, url_base='/wd/hub'):
+    def __init__(self, display=None, port=4444, url_base='/wd/hub',
+                 profile_dir=None, remote_debugging_port=9222):
         super(ChromeWebDriver, self).__init__()
 
         self.display = display
         self.port = port
         self.url_base = url_base
+        self.remote_debugging_port = remote_debugging_port
+        # Chromedriver creates the browser profiles in TMPDIR
+        self.profile_dir = profile_dir
 
     def start(self):
         self.log.info('Starting Chromedriver')
@@ -323,13 +800,16 @@ class ChromeWebDriver(BackendServer):
                 # We need DISPLAY in the env for chromium_flags()
                 os.environ.update({'DISPLAY': self.display})
             env = {
-                'CHROMIUM_FLAGS': quibble.chromium_flags(),
+                'CHROMIUM_FLAGS': quibble.chromium_flags(
+                    remote_debugging_port=self.remote_debugging_port),
                 'PATH': os.environ.get('PATH'),
                 }
 
             if self.display is not None:
                 # Pass it to chromedriver
                 env.update({'DISPLAY': self.display})
+            if self.profile_dir is not None:
+                env.update({'TMPDIR': self.profile_dir})
 
             self.server = subprocess.Popen([
                 'chromedriver',
@@ -351,15 +831,112 @@ class ChromeWebDriver(BackendServer):
                 del(os.environ['DISPLAY'])
 
 
+class ChromeWebDriverPool(BackendServer):
+    """
+    Several chromedriver instances to run browser tests in parallel.
+
+    Each instance listens on its own port and has its own profile directory
+    under base_dir (default: a temporary directory). Without a display, each
+    instance runs headless, or when xvfb is set gets its own Xvfb. Ports and
+    displays are claimed from the quibble.resources.ResourceAllocator.
+    """
+
+    def __init__(self, size, allocator, base_dir=None, display=None,
+                 xvfb=False):
+        super(ChromeWebDriverPool, self).__init__()
+
+        if base_dir is None:
+            # Create and hold a reference
+            self._tmpdir = tempfile.TemporaryDirectory(
+                prefix='quibble-chromium-')
+            base_dir = self._tmpdir.name
+
+        self.size = size
+        self.allocator = allocator
+        self.base_dir = base_dir
+        self.display = display
+        self.xvfb = xvfb
+        self.workers = []
+        self._ports = []
+        self._displays = []
+
+    def start(self):
+        self.log.info('Starting %s Chromedriver instances' % self.size)
+        try:
+            for i in range(self.size):
+                self._start_worker(i)
+            for (driver, _) in self.workers:
+                tcp_wait(port=driver.port, timeout=5)
+        except Exception:
+            # Do not leak the instances already started
+            self.stop()
+            raise
+
+    def _start_worker(self, i):
+        display = self.display
+        xvfb = None
+        if not display and self.xvfb:
+            display = self.allocator.display()
+            self._displays.append(display)
+            xvfb = Xvfb(display=display)
+
+        profile_dir = os.path.join(self.base_dir, 'chromium-%s' % i)
+        os.makedirs(profile_dir, exist_ok=True)
+        ports = [self.allocator.port(4444), self.allocator.port(9222)]
+        self._ports.extend(ports)
+        driver = ChromeWebDriver(
+            display=display,
+            port=ports[0],
+            profile_dir=profile_dir,
+            remote_debugging_port=ports[1])
+
+        # Known by stop() before starting
+        self.workers.append((driver, xvfb))
+        if xvfb is not None:
+            xvfb.start()
+        driver.start()
+
+    def stop(self):
+        for (driver, xvfb) in self.workers:
+            driver.stop()
+            if xvfb is not None:
+                xvfb.stop()
+        self.workers = []
+        for port in self._ports:
+            self.allocator.free_port(port)
+        self._ports = []
+        for display in self._displays:
+            self.allocator.free_display(display)
+        self._displays = []
+
+    @property
+    def drivers(self):
+        return [driver for (driver, _) in self.workers]
+
+    def pids(self):
+        pids = []
+        for (driver, xvfb) in self.workers:
+            pids.extend(driver.pids())
+            if xvfb is not None:
+                pids.extend(xvfb.pids())
+        return pids
+
+
 class DevWebServer(BackendServer):
 
     def __init__(self, port=4881, mwdir=None,
-                 router='maintenance/dev/includes/router.php'):
+                 router='maintenance/dev/includes/router.php',
+                 warmup=(), workers=None, env=None):
         super(DevWebServer, self).__init__()
 
         self.port = port
         self.mwdir = mwdir
         self.router = router
+        self.warmup_paths = warmup
+        # Concurrent requests served by the PHP built-in server (PHP 7.4+)
+        self.workers = workers
+        # Extra environment variables
+        self.env = env or {}
 
     def start(self):
         self.log.info('Starting MediaWiki built in webserver')
@@ -376,6 +953,10 @@ class DevWebServer(BackendServer):
                 server_cmd.append(
                     os.path.join(self.mwdir, self.router))
 
+        env = dict(os.environ, **self.env)
+        if self.workers:
+            env['PHP_CLI_SERVER_WORKERS'] = str(self.workers)
+
         self.server = subprocess.Popen(
             server_cmd,
             cwd=self.mwdir,
@@ -383,10 +964,37 @@ class DevWebServer(BackendServer):
             bufsize=1,  # line buffered
             stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
-            env=os.environ,
+            env=env,
         )
         stream_relay(self.server, self.server.stderr, self.log.info)
         tcp_wait(port=self.port, timeout=5)
+        if self.warmup_paths:
+            self.warmup(self.warmup_paths)
+
+    def warmup(self, paths):
+        """
+        Request paths in the background to prime caches and opcache.
+
+        Returns the thread doing the requests.
+        """
+        thread = threading.Thread(target=self._warmup, args=(paths,),
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _warmup(self, paths):
+        # Slow to import, only needed once the server is up
+        import urllib.request
+
+        for path in paths:
+            url = '%s%s' % (self, path)
+            try:
+                with urllib.request.urlopen(url, timeout=120) as resp:
+                    resp.read()
+                    self.log.debug('Warmed up %s (HTTP %s)' % (
+                        path, resp.status))
+            except OSError as e:  # Including URLError
+                self.log.warning('Warm up of %s failed: %s' % (path, e))
 
     def __str__(self):
         return 'http://127.0.0.1:%s' % self.port
@@ -0,0 +1,300 @@
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+"""
+Run many Quibble jobs described in a spec file, over workspaces kept between
+the jobs.
+
+The spec file is YAML::
+
+    defaults:
+      args: [--db, sqlite]
+      env:
+        ZUUL_BRANCH: master
+    jobs:
+      - project: mediawiki/extensions/Foo
+      - project: mediawiki/extensions/Bar
+        ref: refs/changes/12/3412/1
+        url: https://gerrit.wikimedia.org/r/p
+        run: [phpunit, qunit]
+
+"args" and "env" of a job are added to the defaults. The repositories of the
+workspace are updated by each job instead of being cloned again, and the
+backends are kept running between jobs. Extensions and skins cloned by an
+earlier job are removed unless the job asks for them.
+"""
+
+import argparse
+from collections import OrderedDict
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import time
+
+import quibble.resources
+import quibble.worker
+
+log = logging.getLogger('quibble.batch')
+
+
+def load_spec(filename):
+    import yaml
+
+    with open(filename) as f:
+        spec = yaml.safe_load(f) or {}
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+    defaults = spec.get('defaults', {})
+
+    jobs = []
+    for (index, entry) in enumerate(spec.get('jobs', [])):
+        if 'project' not in entry:
+            raise Exception('Job %s of %s has no project' % (
+                index + 1, filename))
+        env = dict(defaults.get('env', {}))
+        env.update(entry.get('env', {}))
+        env['ZUUL_PROJECT'] = entry['project']
+        if 'ref' in entry:
+            env['ZUUL_REF'] = entry['ref']
+        if 'url' in entry:
+            env['ZUUL_URL'] = entry['url']
+
+        args = list(defaults.get('args', [])) + list(entry.get('args', []))
+        for option in ('run', 'skip'):
+            if option in entry:
+                args += ['--%s' % option] + list(entry[option])
+
+        jobs.append(OrderedDict([
+            ('name', '%s-%s' % (
+                index + 1, re.sub(r'\W+', '-', entry['project']))),
+            ('project', entry['project']),
+            ('args', args),
+            ('env', env),
+        ]))
+    return jobs
+
+
+def job_args(job, workspace, log_dir):
+    # Last, so that they take precedence
+    return job['args'] + [
+        '--workspace', workspace,
+        '--log-dir', os.path.join(log_dir, job['name']),
+    ]
+
+
+def run_slot(slot, jobs, results, workspace, log_dir, runtime_dir):
+    """
+    Run jobs received on a queue in a workspace of its own, until getting
+    None. (slot, index, None) is put on results when a job starts and
+    (slot, index, result) once it is done.
+    """
+    worker = quibble.worker.Worker(None, runtime_dir=runtime_dir)
+    try:
+        while True:
+            item = jobs.get()
+            if item is None:
+                break
+            (index, job) = item
+            log.info('Slot %s: %s' % (slot, job['name']))
+            results.put((slot, index, None))
+            result = worker.run_job({
+                'args': job_args(job, workspace, log_dir),
+                'env': job['env'],
+            })
+            results.put((slot, index, result))
+    finally:
+        worker.backends.stop()
+        worker.resources.release()
+
+
+class Batch:
+
+    # Seconds between checks of the slot processes
+    poll = 5
+
+    def __init__(self, jobs, workspace, log_dir, parallel=1,
+                 runtime_dir=None):
+        self.jobs = jobs
+        self.workspace = os.path.abspath(workspace)
+        self.log_dir = os.path.abspath(log_dir)
+        self.parallel = max(1, min(parallel, len(jobs)))
+        self.runtime_dir = runtime_dir
+
+    def workspaces(self):
+        """
+        Workspace of each slot. Slots running in parallel can not share the
+        source tree.
+        """
+        if self.parallel == 1:
+            return [self.workspace]
+        return [os.path.join(self.workspace, 'slot%s' % slot)
+                for slot in range(self.parallel)]
+
+    def run(self):
+        start = time.monotonic()
+        jobs = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        for item in enumerate(self.jobs):
+            jobs.put(item)
+
+        slots = []
+        if self.parallel == 1:
+            jobs.put(None)
+            run_slot(0, jobs, results, self.workspace, self.log_dir,
+                     self.runtime_dir)
+        else:
+            # Processes since a job changes os.environ
+            for (slot, workspace) in enumerate(self.workspaces()):
+                jobs.put(None)
+                p = multiprocessing.Process(
+                    target=run_slot,
+                    args=(slot, jobs, results, workspace, self.log_dir,
+                          self.runtime_dir))
+                p.start()
+                slots.append(p)
+
+        outcome = self.collect(results, slots)
+        for p in slots:
+            p.join()
+
+        return OrderedDict([
+            ('duration', round(time.monotonic() - start, 3)),
+            ('parallel', self.parallel),
+            ('jobs', [
+                self.job_summary(job, result)
+                for (job, result) in zip(self.jobs, outcome)]),
+        ])
+
+    def collect(self, results, slots):
+        """
+        Result of each job. A job whose slot process died is failed.
+        """
+        outcome = [None] * len(self.jobs)
+        running = {}
+        dead = set()
+        pending = len(self.jobs)
+        while pending:
+            try:
+                (slot, index, result) = results.get(timeout=self.poll)
+            except queue.Empty:
+                # Results are flushed when the process exits, only give up
+                # on a slot found dead twice.
+                for (slot, p) in enumerate(slots):
+                    if p.is_alive():
+                        continue
+                    if slot in dead and slot in running:
+                        (index, start) = running.pop(slot)
+                        outcome[index] = OrderedDict([
+                            ('status', 'failed'),
+                            ('error', 'slot %s exited with code %s' % (
+                                slot, p.exitcode)),
+                            ('duration', round(time.monotonic() - start, 3)),
+                        ])
+                        pending -= 1
+                    dead.add(slot)
+                if len(dead) == len(slots) and not running:
+                    # Never started, or their slot died before telling
+                    for (index, result) in enumerate(outcome):
+                        if result is None:
+                            outcome[index] = OrderedDict([
+                                ('status', 'failed'),
+                                ('error', 'all slots exited'),
+                                ('duration', 0.0),
+                            ])
+                    break
+                continue
+            if result is None:
+                running[slot] = (index, time.monotonic())
+            else:
+                running.pop(slot, None)
+                outcome[index] = result
+                pending -= 1
+        return outcome
+
+    def job_summary(self, job, result):
+        summary = OrderedDict([
+            ('name', job['name']),
+            ('project', job['project']),
+            ('log_dir', os.path.join(self.log_dir, job['name'])),
+        ])
+        summary.update(result)
+        timing = os.path.join(summary['log_dir'], 'timing.json')
+        if os.path.exists(timing):
+            with open(timing) as f:
+                summary['stages'] = OrderedDict(
+                    (s['stage'], s['duration']) for s in json.load(f))
+        return summary
+
+
+def format_summary(summary):
+    jobs = summary['jobs']
+    width = max([len(job['name']) for job in jobs] + [3])
+    lines = ['Batch of %s jobs in %.1fs:' % (len(jobs), summary['duration'])]
+    for job in jobs:
+        line = '  %s %-6s %7.1fs' % (
+            job['name'].ljust(width), job['status'], job['duration'])
+        if job.get('stages'):
+            line += '  ' + ', '.join(
+                '%s: %.1fs' % (stage, duration)
+                for (stage, duration) in job['stages'].items())
+        lines.append(line)
+    passed = len([job for job in jobs if job['status'] == 'passed'])
+    lines.append('%s passed, %s failed' % (passed, len(jobs) - passed))
+    return '\n'.join(lines)
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog='quibble batch',
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'spec', help='YAML file listing the jobs')
+    parser.add_argument(
+        '--workspace', default=os.getcwd(),
+        help=('Workspace the jobs run in. With --parallel, each slot has a '
+              'slotN sub directory. Default: current working directory'))
+    parser.add_argument(
+        '--log-dir', default=None,
+        help=('Where each job writes its logs, in a sub directory named '
+              'after the job, and where batch.json is written. '
+              'Default: "log" relatively to workspace'))
+    parser.add_argument(
+        '--parallel', default=1, type=int, metavar='N',
+        help='Run N jobs at a time. Default: 1')
+    parser.add_argument(
+        '--runtime-dir', default=None,
+        help=('See quibble --help. Default: %s' % (
+            quibble.resources.default_runtime_dir())))
+    return parser
+
+
+def main(argv):
+    args = get_arg_parser().parse_args(argv)
+
+    log_dir = args.log_dir or os.path.join(args.workspace, 'log')
+    os.makedirs(log_dir, exist_ok=True)
+
+    batch = Batch(load_spec(args.spec), args.workspace, log_dir,
+                  parallel=args.parallel, runtime_dir=args.runtime_dir)
+    summary = batch.run()
+    log.info(format_summary(summary))
+    with open(os.path.join(log_dir, 'batch.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    if all(job['status'] == 'passed' for job in summary['jobs']):
+        return 0
+    return 1
@@ -0,0 +1,301 @@
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import os
+import re
+import threading
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+CONTROLLERS = ['cpu', 'memory', 'io']
+
+
+def limit(value):
+    """
+    Parse a FILE=VALUE cgroup limit, for example memory.max=4G.
+    """
+    (name, sep, setting) = value.partition('=')
+    if not sep or not re.match(r'^(cpu|memory|io|pids)\.[a-z.]+$', name):
+        raise ValueError('Invalid cgroup limit: %s' % value)
+    return (name, setting)
+
+
+class Cgroups:
+    """
+    Account for the resources used by each stage and backend with cgroup v2.
+
+    setup() creates a quibble-<pid> cgroup below the one Quibble runs in,
+    which must be delegated to the user, and moves Quibble in its "main"
+    leaf. Stages and backends then each get a child cgroup, with the limits
+    given as (file, value), and Quibble moves itself into it while the
+    stage runs or the backend starts so that the processes it spawns are
+    accounted there.
+
+    A process can only be in one cgroup. Once stages run concurrently,
+    Quibble stays in "main" and their usage is not reported.
+
+    It is also a collector for quibble.timing.Timings reporting the CPU time,
+    peak memory and IO of a stage.
+    """
+
+    log = logging.getLogger('quibble.cgroup')
+
+    def __init__(self, limits=(), root=CGROUP_ROOT,
+                 proc_cgroup='/proc/self/cgroup'):
+        self.limits = list(limits)
+        self.root = root
+        self.proc_cgroup = proc_cgroup
+        self.base = None
+        self.origin = None
+        self._lock = threading.Lock()
+        self._owner = None
+        self._stack = []
+        self._concurrent = False
+        self._shared = set()
+        self._entered = {}
+        self._enabled_in_origin = []
+        self._enabled_in_base = []
+
+    def _current(self):
+        with open(self.proc_cgroup) as f:
+            for line in f:
+                if line.startswith('0::'):
+                    return line[3:].strip()
+        raise OSError('cgroup v2 is not available')
+
+    def _write(self, path, value):
+        with open(path, 'w') as f:
+            f.write(value)
+
+    def _move(self, path):
+        self._write(os.path.join(path, 'cgroup.procs'), str(os.getpid()))
+
+    def setup(self):
+        """
+        Return whether cgroups can be used.
+        """
+        root = self.root
+        unified = os.path.join(root, 'unified')
+        if not os.path.exists(os.path.join(root, 'cgroup.controllers')) \
+                and os.path.isdir(unified):
+            # Hybrid hierarchy, cgroup v1 controllers are mounted at the root
+            root = unified
+        try:
+            self.origin = os.path.join(root, self._current().lstrip('/'))
+            base = os.path.join(self.origin, 'quibble-%s' % os.getpid())
+            os.mkdir(base)
+            self.base = base
+            os.mkdir(self.path('main'))
+            # A cgroup with controllers enabled for its children can not
+            # have processes of its own.
+            self._move(self.path('main'))
+            # The controllers of base are those enabled by its parent
+            enabled = self._enable_in_origin()
+            if enabled:
+                self._write(os.path.join(base, 'cgroup.subtree_control'),
+                            ' '.join('+%s' % c for c in enabled))
+                self._enabled_in_base = enabled
+        except OSError as e:
+            self.log.warning('cgroup accounting disabled: %s' % e)
+            self.teardown()
+            return False
+
+        missing = [c for c in CONTROLLERS if c not in enabled]
+        if missing:
+            self.log.warning(
+                'cgroup controllers not delegated: %s. Their limits and '
+                'usage are not available.' % ', '.join(missing))
+        self.log.info('Accounting stages and backends in %s' % base)
+        return True
+
+    def _enable_in_origin(self):
+        """
+        Enable the delegated controllers for the children of origin. Return
+        the controllers enabled, including those which already were.
+        """
+        path = self.origin
+        with open(os.path.join(path, 'cgroup.controllers')) as f:
+            available = f.read().split()
+        control = os.path.join(path, 'cgroup.subtree_control')
+        with open(control) as f:
+            already = f.read().split()
+        wanted = [c for c in CONTROLLERS
+                  if c in available and c not in already]
+        try:
+            if wanted:
+                self._write(control, ' '.join('+%s' % c for c in wanted))
+            enabled = wanted
+        except OSError:
+            # The write fails as a whole, find out which are refused
+            enabled = []
+            for controller in wanted:
+                try:
+                    self._write(control, '+%s' % controller)
+                    enabled.append(controller)
+                except OSError as e:
+                    self.log.debug('Could not enable %s in %s: %s' % (
+                        controller, path, e))
+        self._enabled_in_origin = enabled
+        return [c for c in CONTROLLERS if c in enabled or c in already]
+
+    def path(self, name):
+        return os.path.join(self.base, re.sub(r'[^\w.-]+', '-', name))
+
+    def create(self, name):
+        path = self.path(name)
+        os.makedirs(path, exist_ok=True)
+        for (setting, value) in self.limits:
+            try:
+                self._write(os.path.join(path, setting), value)
+            except OSError as e:
+                self.log.warning('Could not set %s=%s for %s: %s' % (
+                    setting, value, name, e))
+        return path
+
+    @contextmanager
+    def enter(self, name):
+        """
+        Move Quibble into the cgroup of name, and its children to come.
+        """
+        if self.base is None:
+            yield
+            return
+
+        moved = False
+        with self._lock:
+            if self._owner not in (None, threading.get_ident()):
+                if not self._concurrent:
+                    self.log.warning(
+                        'Stages running concurrently, their usage is not '
+                        'accounted separately')
+                    self._concurrent = True
+                    self._shared.update(self._stack)
+                    self._move(self.path('main'))
+            if self._concurrent:
+                self._shared.add(name)
+            else:
+                path = self.create(name)
+                self._owner = threading.get_ident()
+                self._stack.append(path)
+                self._move(path)
+                moved = True
+        try:
+            yield
+        finally:
+            if moved:
+                with self._lock:
+                    self._stack.pop()
+                    if not self._concurrent:
+                        self._move(self._stack[-1] if self._stack
+                                   else self.path('main'))
+                    if not self._stack:
+                        self._owner = None
+
+    def usage(self, name):
+        """
+        CPU seconds, peak memory and IO bytes of the cgroup of name.
+        """
+        if self.base is None or name in self._shared:
+            return {}
+        path = self.path(name)
+        usage = OrderedDict()
+        try:
+            with open(os.path.join(path, 'cpu.stat')) as f:
+                for line in f:
+                    (key, value) = line.split()
+                    if key == 'usage_usec':
+                        usage['cpu'] = '%.1fs' % (int(value) / 1e6)
+        except OSError:
+            pass
+        try:
+            with open(os.path.join(path, 'memory.peak')) as f:
+                usage['memory peak'] = '%.1f MiB' % (
+                    int(f.read()) / 1048576)
+        except (OSError, ValueError):
+            # memory.peak needs Linux 5.19
+            pass
+        try:
+            read = written = 0
+            with open(os.path.join(path, 'io.stat')) as f:
+                for line in f:
+                    for field in line.split()[1:]:
+                        (key, _, value) = field.partition('=')
+                        if key == 'rbytes':
+                            read += int(value)
+                        elif key == 'wbytes':
+                            written += int(value)
+            usage['io read'] = '%.1f MiB' % (read / 1048576)
+            usage['io written'] = '%.1f MiB' % (written / 1048576)
+        except OSError:
+            pass
+        return usage
+
+    def remove(self, name):
+        try:
+            os.rmdir(self.path(name))
+        except OSError as e:
+            # Processes left behind, it is removed on teardown
+            self.log.debug('Could not remove cgroup of %s: %s' % (name, e))
+
+    def begin(self, name):
+        context = self.enter(name)
+        context.__enter__()
+        self._entered[(threading.get_ident(), name)] = context
+
+    def end(self, name):
+        context = self._entered.pop((threading.get_ident(), name), None)
+        if context is not None:
+            context.__exit__(None, None, None)
+        usage = self.usage(name)
+        if self.base is not None:
+            self.remove(name)
+        return usage
+
+    def teardown(self):
+        if self.base is None:
+            return
+        # Processes can only be moved back once origin has no controllers
+        # enabled for its children.
+        for (path, controllers) in [
+                (self.base, self._enabled_in_base),
+                (self.origin, self._enabled_in_origin)]:
+            if not controllers:
+                continue
+            try:
+                self._write(os.path.join(path, 'cgroup.subtree_control'),
+                            ' '.join('-%s' % c for c in controllers))
+            except OSError as e:
+                self.log.warning('Could not disable controllers in %s: %s' % (
+                    path, e))
+        self._enabled_in_base = []
+        self._enabled_in_origin = []
+        try:
+            self._move(self.origin)
+        except OSError as e:
+            self.log.warning('Could not move back to %s: %s' % (
+                self.origin, e))
+        for name in sorted(os.listdir(self.base)):
+            path = os.path.join(self.base, name)
+            if os.path.isdir(path):
+                try:
+                    os.rmdir(path)
+                except OSError as e:
+                    self.log.debug('Could not remove %s: %s' % (path, e))
+        try:
+            os.rmdir(self.base)
+        except OSError as e:
+            self.log.debug('Could not remove %s: %s' % (self.base, e))
+        self.base = None
@@ -17,21 +17,60 @@
 #     limitations under the License.
 
 import argparse
-from contextlib import ExitStack
+import contextlib
+import copy
+import glob
+import hashlib
 import json
 import logging
 import os
-import pkg_resources
 from shutil import copyfile
+import shutil
 import subprocess
 import sys
 import tempfile
 
 import quibble
+import quibble.mediawiki.localsettings
 import quibble.mediawiki.maintenance
 import quibble.backend
-import quibble.test
-import quibble.zuul
+import quibble.gitchangedinhead
+import quibble.opcache
+import quibble.progress
+import quibble.relevance
+import quibble.resources
+import quibble.resultcache
+import quibble.timing
+
+DB_ENGINES = ['sqlite', 'mysql', 'postgres']
+# Files recording the dependencies resolved by composer and npm
+DEPENDENCY_LOCKS = [
+    'composer.lock',
+    'vendor/composer/installed.json',
+    'package-lock.json',
+    'node_modules/.package-lock.json',
+]
+
+
+def db_engines(value):
+    """
+    Validate a comma separated list of database engines.
+    """
+    for engine in value.split(','):
+        if engine not in DB_ENGINES:
+            raise argparse.ArgumentTypeError(
+                'invalid engine: %s (choose from %s)' % (
+                    engine, ', '.join(DB_ENGINES)))
+    return value
+
+
+def cgroup_limit(value):
+    import quibble.cgroup
+
+    try:
+        return quibble.cgroup.limit(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
 
 class QuibbleCmd(object):
@@ -40,18 +79,38 @@ class QuibbleCmd(object):
     stages = ['phpunit', 'npm-test', 'composer-test', 'qunit', 'selenium']
     dump_dir = None
     db_dir = None
+    stage_rules = None
+    result_cache = None
+    db_checkpoint = False
+    cgroups = None
+    tracer = None
+    # Database engine of a run made by for_engine()
+    engine = None
+    engine_runs = []
+    http_port = 9412
+    # Requested in the background once the web server is up, so that the
+    # first browser test does not pay for cold caches.
+    web_warmup_paths = [
+        '/load.php?modules=startup&only=scripts&raw=1',
+        '/index.php?title=Main_Page',
+    ]
 
     def __init__(self):
         self.dependencies = []
-        # Hold backend objects so they do not get garbage collected until end
-        # of script.
-        self.backends = {}
+        # Backends are started on first use and held until the end of the
+        # script.
+        self.backends = quibble.backend.BackendRegistry()
+        self.timings = quibble.timing.Timings()
+        self.changed_files = []
+        self.skipped_stages = {}
         self.default_git_cache = ('/srv/git' if quibble.is_in_docker()
                                   else 'ref')
         self.default_workspace = ('/workspace' if quibble.is_in_docker()
                                   else os.getcwd())
 
-    def parse_arguments(self, args=sys.argv[1:]):
+    def parse_arguments(self, args=None):
+        if args is None:
+            args = sys.argv[1:]
         return self.get_arg_parser().parse_args(args)
 
     def get_arg_parser(self):
@@ -77,9 +136,16 @@ class QuibbleCmd(object):
             help='Do not run composer/npm')
         parser.add_argument(
             '--db',
-            choices=['sqlite', 'mysql', 'postgres'],
+            type=db_engines,
             default='mysql',
-            help='Database backend to use. Default: mysql')
+            metavar='{%s}[,...]' % ','.join(DB_ENGINES),
+            help=('Database backend to use. Default: mysql. '
+                  'Given several comma separated engines, repositories '
+                  'and dependencies are set up once, then MediaWiki is '
+                  'installed and the QUnit, Selenium and PHPUnit Database '
+                  'stages are run for each engine in parallel. Each has its '
+                  'own LocalSettings-<engine>.php, web server and '
+                  'junit-db-<engine>.xml'))
         parser.add_argument(
             '--db-dir',
             default=None,
@@ -94,13 +160,70 @@ class QuibbleCmd(object):
         parser.add_argument(
             '--dump-db-postrun',
             action='store_true',
-            help='Dump the db before shutting down the server (mysql only)')
+            help=('Dump the db before shutting down the server, to the log '
+                  'directory: mysqldump/<database>.<table>.sql.gz, '
+                  'pg_dump/ or <database>.sqlite.gz'))
+        parser.add_argument(
+            '--dump-db-compression',
+            choices=['gzip', 'zstd'],
+            default='gzip',
+            help='Compression of the database dumps. Default: gzip')
+        parser.add_argument(
+            '--isolate-db',
+            action='store_true',
+            help=('Checkpoint the database once MediaWiki is installed and '
+                  'restore it before QUnit, Selenium and the PHPUnit '
+                  'Database group, so that they do not see data left by '
+                  'earlier stages. Ignored with --parallel-stages'))
+        parser.add_argument(
+            '--php-opcache-dir',
+            default=None,
+            help=(
+                'Base directory to keep the PHP opcache file cache in, '
+                'shared by runs having the same git trees. '
+                'Default: a temporary directory for the run'))
+        parser.add_argument(
+            '--no-php-opcache',
+            action='store_true',
+            help='Do not enable opcache for PHP command line invocations')
+        parser.add_argument(
+            '--result-cache',
+            default=os.environ.get('QUIBBLE_RESULT_CACHE'), metavar='DIR',
+            help=('Directory where results of successful test stages are '
+                  'kept, keyed by the git trees of the repositories, the '
+                  'stage configuration and the tools versions. A stage '
+                  'whose result is found is replayed instead of being run. '
+                  'Default: $QUIBBLE_RESULT_CACHE, else disabled'))
+        parser.add_argument(
+            '--no-result-cache',
+            action='store_true',
+            help='Run all stages even if their result is cached')
+        parser.add_argument(
+            '--result-cache-ttl',
+            default=7, type=int, metavar='DAYS',
+            help='Days after which a cached result expires. Default: 7')
+        parser.add_argument(
+            '--result-cache-size',
+            default=1024, type=int, metavar='MB',
+            help=('Size the result cache is trimmed to, by evicting the '
+                  'least recently used results. Default: 1024'))
+        parser.add_argument(
+            '--runtime-dir',
+            default=None,
+            help=('Directory holding the locks used to allocate TCP ports '
+                  'and X displays among Quibble runs on the same host. '
+                  'Default: %s' % quibble.resources.default_runtime_dir()))
         parser.add_argument(
             '--git-cache',
             default=self.default_git_cache,
             help='Path to bare git repositories to speed up git clone'
                  'operation. Passed to zuul-cloner as --cache-dir. '
                  'In Docker: "/srv/git", else "ref"')
+        parser.add_argument(
+            '--git-parallel',
+            default=4, type=int, metavar='N',
+            help=('Number of repositories to update git submodules for in '
+                  'parallel, also passed to git as --jobs. Default: 4'))
         parser.add_argument(
             '--branch',
             default=None,
@@ -128,6 +251,43 @@ class QuibbleCmd(object):
             help='Where logs and artifacts will be written to. '
             'Default: "log" relatively to workspace'
             )
+        parser.add_argument(
+            '--cgroup',
+            action='store_true',
+            help=('Run each stage and backend in a cgroup of its own and '
+                  'report their CPU time, peak memory and IO in the timing '
+                  'report. Requires cgroup v2 delegated to the user, for '
+                  'example with systemd-run --user --scope -p Delegate=yes. '
+                  'Stages running concurrently are not accounted '
+                  'separately'))
+        parser.add_argument(
+            '--cgroup-limit',
+            action='append', default=[], type=cgroup_limit,
+            metavar='FILE=VALUE',
+            help=('Limit set on the cgroup of each stage and backend, for '
+                  'example memory.max=4G or cpu.max="200000 100000". May be '
+                  'given multiple times'))
+        parser.add_argument(
+            '--trace',
+            action='store_true',
+            help=('Write a timeline of the stages, backends, repositories '
+                  'cloned and processes of the run, with samples of their '
+                  'CPU, memory and IO usage, to trace.json in the log '
+                  'directory. It can be loaded in https://ui.perfetto.dev/ '
+                  'or chrome://tracing'))
+        parser.add_argument(
+            '--package-artifacts',
+            action='store_true',
+            help=('Once tests are done, shrink the log directory for '
+                  'archiving: identical files are only kept once, files '
+                  'larger than 64 KiB are compressed with gzip, except '
+                  'junit XML and JSON files, and what was done is recorded '
+                  'in artifacts.json'))
+        parser.add_argument(
+            '--log-max-size',
+            default=200, type=int, metavar='MB',
+            help=('With --package-artifacts, drop the middle of .log and '
+                  '.txt files larger than MB. 0 to disable. Default: 200'))
         parser.add_argument(
             'projects', default=[], nargs='*',
             help='MediaWiki extensions and skins to clone. Always clone '
@@ -151,6 +311,12 @@ class QuibbleCmd(object):
             help='Stages to skip (default: none). '
                  'Set to "all" to skip all stages.'
         )
+        stages_args.add_argument(
+            '--stage-rules', default=None, metavar='FILE',
+            help=('YAML file mapping stages to the patterns of files which '
+                  'can affect them. Stages no changed file can affect are '
+                  'skipped. Default: %s in the tested project, if any.' % (
+                      quibble.relevance.PROJECT_RULES_FILE)))
         stages_args.add_argument(
             '--commands', default=[], nargs='*', metavar='command',
             help=(
@@ -158,6 +324,55 @@ class QuibbleCmd(object):
                 'Each command is executed relatively to '
                 'MediaWiki installation path.'))
 
+        parser.add_argument(
+            '--selenium-workers', default=1, type=int, metavar='N',
+            help=('Selenium: spread the spec files among N browsers '
+                  'running in parallel. Default: 1'))
+
+        parser.add_argument(
+            '--xvfb', action='store_true',
+            help=('Selenium: when DISPLAY is not set, run the browser in '
+                  'Xvfb instead of headless, for specs requiring a display. '
+                  'Xvfb is always used if the browser can not run '
+                  'headless.'))
+
+        parser.add_argument(
+            '--parallel-stages', default=None, type=int, nargs='?', const=0,
+            metavar='N',
+            help=('Run the PHPUnit databaseless and Database groups, QUnit '
+                  'and Selenium concurrently, at most N at a time. PHPUnit '
+                  'output is written to phpunit-dbless.log and '
+                  'phpunit-db.log in the log directory. '
+                  'Default for N: the number of CPUs'))
+
+        parser.add_argument(
+            '--phpunit-progress', action='store_true',
+            help=('PHPUnit: log failures as they happen and write the '
+                  'progress to phpunit-<group>-progress.json in the log '
+                  'directory while tests run'))
+
+        parser.add_argument(
+            '--fail-fast', default=None, type=int, nargs='?', const=1,
+            metavar='N',
+            help=('PHPUnit: abort the run once N tests failed. Implies '
+                  '--phpunit-progress. Default for N: 1'))
+
+        parser.add_argument(
+            '--slow-tests-top', default=20, type=int, metavar='N',
+            help=('PHPUnit: number of slowest tests, test classes and data '
+                  'providers reported in phpunit-slow.json. Default: 20'))
+
+        parser.add_argument(
+            '--slow-tests-baseline', default=None, metavar='FILE',
+            help=('PHPUnit: phpunit-slow.json of an earlier run, to report '
+                  'tests which became slower'))
+
+        parser.add_argument(
+            '--slow-tests-threshold', default=20, type=int,
+            metavar='PERCENT',
+            help=('PHPUnit: how much slower than the baseline a test must '
+                  'be to be reported. Default: 20'))
+
         parser.add_argument(
             '--phpunit-testsuite', default=None, metavar='pattern',
             help='PHPUnit: filter which testsuite to run')
@@ -221,32 +436,34 @@ class QuibbleCmd(object):
         return self.dependencies
 
     def clone(self, projects):
+        import quibble.zuul
+
         quibble.zuul.clone(
             projects,
             branch=self.args.branch,
             project_branch=self.args.project_branch,
             workspace=os.path.join(self.workspace, 'src'),
-            cache_dir=self.args.git_cache)
+            cache_dir=self.args.git_cache,
+            tracer=self.tracer)
 
     def ext_skin_submodule_update(self):
+        import quibble.test
+        import quibble.zuul
+
         self.log.info('Updating git submodules of extensions and skins')
-        # From JJB macro ext-skins-submodules-update
-        # jjb/mediawiki-extensions.yaml
-        subprocess.check_call([
-            # Do not add ., or that will process mediawiki/core submodules in
-            # wmf branches which is a mess.
-            'find', 'extensions', 'skins',
-            '-maxdepth', '2',
-            '-name', '.gitmodules',
-            '-print',
-            '-execdir', 'bash', '-xe', '-c',
-            '\n'.join([
-                 'git submodule foreach git clean -xdff -q',
-                 'git submodule update --init --recursive',
-                 'git submodule status',
-                 ]),
-            ';',  # end of -execdir
-             ], cwd=self.mw_install_path)
+        # Do not add ., or that will process mediawiki/core submodules in
+        # wmf branches which is a mess.
+        gitmodules = []
+        for pattern in ['extensions/*/.gitmodules', 'skins/*/.gitmodules']:
+            gitmodules.extend(glob.glob(
+                os.path.join(self.mw_install_path, pattern)))
+
+        jobs = self.args.git_parallel
+        quibble.test.parallel_run([
+            (quibble.zuul.submodule_update, os.path.dirname(gitmodule),
+             jobs, self.args.git_cache)
+            for gitmodule in sorted(gitmodules)
+        ], workers=jobs)
 
     # Used to be bin/mw-create-composer-local.py
     def create_composer_local(self):
@@ -265,11 +482,261 @@ class QuibbleCmd(object):
             json.dump(out, f)
         self.log.info('Created composer.local.json')
 
-    def mw_install(self):
+    def git_trees(self, projects):
+        """
+        Git tree hashes of the cloned repositories, None when unknown.
+        """
+        import quibble.zuul
+
+        try:
+            return quibble.zuul.tree_hashes(projects, self.mw_install_path)
+        except (OSError, subprocess.CalledProcessError):
+            # OSError: a repository is missing, for example with --skip-zuul
+            self.log.warning('Could not get git trees of the repositories')
+            return None
+
+    def setup_opcache(self, trees):
+        if self.args.no_php_opcache or quibble.php_is_hhvm():
+            return
+
+        key = None
+        if self.args.php_opcache_dir:
+            if trees is None:
+                self.log.warning('Opcache file cache will not be keyed')
+            else:
+                key = hashlib.sha1(json.dumps(trees).encode()).hexdigest()
+
+        opcache = quibble.opcache.OpcacheFileCache(
+            base_dir=self.args.php_opcache_dir, key=key)
+        opcache.setup()
+        # Hold a reference, the temporary directory is removed on gc
+        self.opcache = opcache
+        self.timings.collectors.append(opcache)
+
+    def setup_cgroups(self):
+        if not self.args.cgroup:
+            return
+        import quibble.cgroup
+
+        cgroups = quibble.cgroup.Cgroups(limits=self.args.cgroup_limit)
+        if not cgroups.setup():
+            return
+        self.cgroups = cgroups
+        self.timings.collectors.append(cgroups)
+        self.backends.cgroups = cgroups
+
+    def setup_tracer(self):
+        if not self.args.trace:
+            return
+        import quibble.trace
+
+        self.tracer = quibble.trace.Tracer()
+        self.tracer.start()
+        self.timings.collectors.append(self.tracer)
+        self.backends.tracer = self.tracer
+
+    def setup_result_cache(self, trees):
+        if self.args.no_result_cache or not self.args.result_cache:
+            return
+        if trees is None:
+            self.log.warning('Result cache disabled, git trees are unknown')
+            return
+        self.result_cache = quibble.resultcache.ResultCache(
+            self.args.result_cache, trees,
+            ttl=self.args.result_cache_ttl * 86400,
+            max_size=self.args.result_cache_size * 1024 * 1024)
+        self.log.info('Replaying stage results from %s' % (
+            self.args.result_cache))
+
+    def stage_config(self, **config):
+        """
+        Settings, beside the git trees, a stage result depends upon.
+        """
+        config.update({
+            'zuul_project': os.environ.get('ZUUL_PROJECT'),
+            'projects': sorted(self.args.projects),
+            'packages_source': self.args.packages_source,
+            'db': self.args.db,
+        })
+        config['dependencies'] = self.resolved_dependencies(
+            self.mw_install_path)
+        return config
+
+    def extskin_config(self, directory, composer, npm):
+        """
+        Config of the extension or skin tests, which install the dependencies
+        of the project. None when they are not locked, since they are only
+        known once installed.
+        """
+        floating = []
+        if composer and not os.path.exists(
+                os.path.join(directory, 'composer.lock')):
+            floating.append('composer.json')
+        if npm and not os.path.exists(
+                os.path.join(directory, 'package-lock.json')):
+            floating.append('package.json')
+        floating = [f for f in floating
+                    if os.path.exists(os.path.join(directory, f))]
+        if floating:
+            self.log.info('Not caching the result of %s, %s is not locked' % (
+                directory, ', '.join(floating)))
+            return None
+        return self.stage_config(
+            composer=composer, npm=npm,
+            project_dependencies=self.resolved_dependencies(directory))
+
+    def resolved_dependencies(self, directory):
+        """
+        Hash of the dependencies composer and npm resolved in directory,
+        which the git trees do not account for.
+        """
+        digest = hashlib.sha1()
+        for lock in DEPENDENCY_LOCKS:
+            path = os.path.join(directory, lock)
+            if os.path.exists(path):
+                digest.update(lock.encode())
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+        return digest.hexdigest()
+
+    def run_stage(self, name, func, config, artifacts=()):
+        """
+        Run a stage, or replay its result from the result cache.
+
+        artifacts are file names relative to the log directory which are
+        stored along the result of a successful run. With config None, the
+        stage is always run.
+        """
+        cache = self.result_cache
+        if config is None:
+            # Depends on something unknown until the stage runs
+            cache = None
+        with self.timings.stage(name):
+            if cache is not None and cache.replay(name, config, self.log_dir):
+                return
+            func()
+        if cache is not None:
+            try:
+                cache.store(name, config, artifacts=[
+                    os.path.join(self.log_dir, a) for a in artifacts])
+            except Exception:
+                # The stage passed, only the cache is lost
+                self.log.exception('Could not store the result of %s' % name)
+
+    def engine_backend(self, name):
+        """
+        Name of the database or web server backend of the engine.
+        """
+        if self.engine is None:
+            return name
+        return '%s-%s' % (name, self.engine)
+
+    def engine_env(self):
+        """
+        Environment selecting the settings of the engine.
+        """
+        if self.engine is None:
+            return {}
+        return {'QUIBBLE_DB': self.engine}
+
+    def register_backends(self):
+        if ',' not in self.args.db:
+            # Else registered by each engine run
+            self.register_engine_backends()
+
+        self.backends.register('xvfb', lambda: quibble.backend.Xvfb(
+            display=self.resources.display()))
+        self.backends.register('chromedriver', self.chromedriver,
+                               key=os.environ.get('DISPLAY'))
+        self.backends.register(
+            'chromedriver-pool', lambda: quibble.backend.ChromeWebDriverPool(
+                size=self.args.selenium_workers,
+                allocator=self.resources,
+                display=os.environ.get('DISPLAY', None),
+                xvfb=self.use_xvfb()),
+            key=(self.args.selenium_workers, os.environ.get('DISPLAY')))
+
+    def register_engine_backends(self):
+        # Keys tell whether a backend kept from an earlier run, by the
+        # worker, can be reused.
         dbclass = quibble.backend.getDBClass(engine=self.args.db)
-        db = dbclass(base_dir=self.db_dir, dump_dir=self.dump_dir)
-        self.backends['db'] = db  # hold a reference to prevent gc
-        db.start()
+        self.backends.register(self.engine_backend('db'), lambda: dbclass(
+            base_dir=self.db_dir, dump_dir=self.dump_dir,
+            dump_compression=self.args.dump_db_compression),
+            key=(self.args.db, self.db_dir, self.dump_dir,
+                 self.args.dump_db_compression if self.dump_dir else None))
+
+        self.backends.register(
+            self.engine_backend('web'),
+            lambda: quibble.backend.DevWebServer(
+                mwdir=self.mw_install_path,
+                port=self.http_port,
+                warmup=self.web_warmup_paths,
+                workers=self.args.selenium_workers,
+                env=self.engine_env()),
+            # Opcache settings are only known once the repositories are
+            # cloned.
+            key=lambda: (self.mw_install_path, self.http_port,
+                         self.args.selenium_workers,
+                         os.environ.get('PHP_INI_SCAN_DIR'),
+                         self.engine))
+
+    def setup_engine_runs(self):
+        """
+        Copy the command for each engine when --db has several. Done once
+        the stage rules, result cache and opcache are set up, for the copies
+        to share them.
+        """
+        engines = self.args.db.split(',')
+        if len(engines) > 1:
+            self.engine_runs = [self.for_engine(e) for e in engines]
+
+    def for_engine(self, engine):
+        """
+        Copy of the command installing MediaWiki and running the stages
+        depending on the database with engine, when --db has several.
+
+        Backends are shared, under names suffixed by the engine.
+        """
+        run = copy.copy(self)
+        run.args = copy.copy(self.args)
+        run.args.db = engine
+        run.engine = engine
+        run.engine_runs = []
+        web = self.backends.started(run.engine_backend('web'))
+        if web is not None:
+            # Kept running by a worker, which still claims its port
+            run.http_port = web.port
+        else:
+            run.http_port = self.resources.port(self.http_port)
+        run.register_engine_backends()
+        return run
+
+    def free_engine_ports(self):
+        for run in self.engine_runs:
+            # Unless a worker keeps the web server bound to it
+            if run.engine_backend('web') not in self.backends:
+                self.resources.free_port(run.http_port)
+
+    def use_xvfb(self):
+        return self.args.xvfb or not quibble.chromium_supports_headless()
+
+    def chromedriver(self):
+        display = os.environ.get('DISPLAY', None)
+        if display:
+            pass
+        elif self.use_xvfb():
+            self.log.info("No DISPLAY, using Xvfb.")
+            display = self.backends.get('xvfb').display
+        else:
+            self.log.info("No DISPLAY, running headless.")
+        return quibble.backend.ChromeWebDriver(
+            display=display,
+            port=self.resources.port(4444),
+            remote_debugging_port=self.resources.port(9222))
+
+    def mw_install(self):
+        db = self.backends.get(self.engine_backend('db'))
 
         install_args = [
             '--scriptpath=',
@@ -289,25 +756,30 @@ class QuibbleCmd(object):
         else:
             raise Exception('Unsupported database: %s' % self.args.db)
 
+        localsettings = os.path.join(self.mw_install_path, 'LocalSettings.php')
+        if self.engine is not None:
+            # Set aside, LocalSettings.php is written once all engines are
+            # installed since install.php refuses to run when it exists.
+            confpath = tempfile.mkdtemp(prefix='quibble-%s-' % self.engine)
+            install_args.append('--confpath=%s' % confpath)
+            localsettings = os.path.join(
+                self.mw_install_path, 'LocalSettings-%s.php' % self.engine)
+
         quibble.mediawiki.maintenance.install(
             args=install_args,
             mwdir=self.mw_install_path
         )
 
-        localsettings = os.path.join(self.mw_install_path, 'LocalSettings.php')
+        if self.engine is not None:
+            shutil.move(os.path.join(confpath, 'LocalSettings.php'),
+                        localsettings)
+            os.rmdir(confpath)
+
         # Prepend our custom configuration snippets
-        with open(localsettings, 'r+') as lf:
-            extra_conf = subprocess.check_output([
-                'php',
-                pkg_resources.resource_filename(
-                    __name__, 'mediawiki.d/_join.php')
-                ])
-            installed_conf = lf.read()
-            lf.seek(0, 0)
-            lf.write(extra_conf.decode() + installed_conf)
-        subprocess.check_call(['php', '-l', localsettings])
-        self.copylog(localsettings, 'LocalSettings.php')
+        quibble.mediawiki.localsettings.apply(localsettings)
+        self.copylog(localsettings, os.path.basename(localsettings))
 
+    def mw_update(self):
         update_args = []
         if self.args.packages_source == 'vendor':
             # When trying to update a library in mediawiki/core and
@@ -326,11 +798,48 @@ class QuibbleCmd(object):
 
         quibble.mediawiki.maintenance.update(
             args=update_args,
-            mwdir=self.mw_install_path
+            mwdir=self.mw_install_path,
+            env=self.engine_env()
         )
+
+    def mw_install_engines(self):
+        import quibble.test
+
+        engines = [run.engine for run in self.engine_runs]
+        self.log.info('Installing MediaWiki for %s' % ', '.join(engines))
+        quibble.test.thread_run([run.mw_install for run in self.engine_runs])
+        quibble.mediawiki.localsettings.write_dispatcher(
+            os.path.join(self.mw_install_path, 'LocalSettings.php'), engines)
+        quibble.test.thread_run([run.mw_update for run in self.engine_runs])
+
+    def install(self):
+        """
+        Install MediaWiki, with each engine when --db has several.
+        """
+        if self.engine_runs:
+            self.mw_install_engines()
+        else:
+            self.mw_install()
+            self.mw_update()
+        # The cache is shared by the engines
         quibble.mediawiki.maintenance.rebuildLocalisationCache(
             lang=['en'], mwdir=self.mw_install_path)
 
+    def checkpoint_db(self):
+        if self.args.parallel_stages is not None:
+            # Stages share the database while they run
+            self.log.warning('--isolate-db is ignored with --parallel-stages')
+            return
+        with self.timings.stage(self.engine_backend('db checkpoint')):
+            self.backends.get(self.engine_backend('db')).checkpoint()
+        self.db_checkpoint = True
+
+    def restore_db(self):
+        if not self.db_checkpoint:
+            return
+        with self.timings.stage(self.engine_backend('db restore')):
+            self.backends.get(self.engine_backend('db')).restore()
+
     def fetch_composer_dev(self):
         mw_composer_json = os.path.join(self.mw_install_path, 'composer.json')
         vendor_dir = os.path.join(self.mw_install_path, 'vendor')
@@ -385,16 +894,204 @@ class QuibbleCmd(object):
             return False
         if stage in self.args.skip:
             return False
-        if 'all' in self.args.run:
+        if 'all' not in self.args.run and stage not in self.args.run:
+            return False
+        return self.is_relevant(stage)
+
+    def needs_install(self):
+        if self.stage_rules is None or self.args.commands:
             return True
-        return stage in self.args.run
+        # Stages requiring an installed wiki
+        return any(self.should_run(stage)
+                   for stage in ['phpunit', 'qunit', 'selenium'])
+
+    def is_relevant(self, stage):
+        if self.stage_rules is None:
+            return True
+        if stage not in self.skipped_stages:
+            reason = self.stage_rules.skip_reason(stage, self.changed_files)
+            if reason:
+                self.log.info('Skipping %s: %s' % (stage, reason))
+            self.skipped_stages[stage] = reason
+        return self.skipped_stages[stage] is None
+
+    def run_stages_concurrently(self, zuul_project, phpunit_testsuite):
+        """
+        Run the PHPUnit groups and the browser stages at the same time.
+
+        mediawiki/core tests are run first, they already run composer and
+        npm in parallel.
+        """
+        import quibble.test
+
+        if zuul_project == 'mediawiki/core':
+            self.run_core_stage()
+
+        tasks = []
+        if self.should_run('phpunit'):
+            tasks.append(lambda: self.run_phpunit_stage(
+                'dbless', phpunit_testsuite, separate_log=True))
+            tasks.append(lambda: self.run_phpunit_stage(
+                'db', phpunit_testsuite, separate_log=True))
+        if self.should_run('qunit'):
+            tasks.append(self.run_qunit_stage)
+        if self.should_run('selenium') and self.has_selenium_tests():
+            tasks.append(self.run_selenium_stage)
+
+        workers = self.args.parallel_stages or os.cpu_count() or 1
+        self.log.info('Running %s stages, %s at a time' % (
+            len(tasks), min(workers, len(tasks))))
+        quibble.test.thread_run(tasks, workers=workers)
+
+    def run_phpunit_stage(self, group, testsuite, separate_log=False):
+        import quibble.test
+
+        if group == 'db':
+            self.log.info("PHPUnit%sDatabase group" % (
+                ' %s suite ' % (testsuite or ' ')))
+            run = quibble.test.run_phpunit_database
+        else:
+            self.log.info("PHPUnit%swithout Database group" % (
+                ' %s suite ' % (testsuite or ' ')))
+            # XXX might want to run the triggered extension first then the
+            # other tests.
+            # XXX some mediawiki/core smoke PHPunit tests should probably
+            # be run as well.
+            run = quibble.test.run_phpunit_databaseless
+
+        if self.engine is not None:
+            group = '%s-%s' % (group, self.engine)
+        junit = 'junit-%s.xml' % group
+        log_file = None
+        if separate_log:
+            log_file = os.path.join(self.log_dir, 'phpunit-%s.log' % group)
+        progress = None
+        if self.args.phpunit_progress or self.args.fail_fast is not None:
+            # Else PHPUnit is run with the same command line as before
+            progress = quibble.progress.TestProgress(
+                'phpunit %s' % group,
+                teamcity_file=os.path.join(
+                    self.log_dir, 'phpunit-%s.teamcity.log' % group),
+                summary_file=os.path.join(
+                    self.log_dir, 'phpunit-%s-progress.json' % group),
+                fail_fast=self.args.fail_fast)
+        self.run_stage(
+            'phpunit %s' % group,
+            lambda: run(mwdir=self.mw_install_path,
+                        testsuite=testsuite,
+                        junit_file=os.path.join(self.log_dir, junit),
+                        log_file=log_file,
+                        progress=progress,
+                        env=self.engine_env()),
+            self.stage_config(testsuite=testsuite),
+            artifacts=[junit])
+
+    def report_slow_tests(self):
+        import quibble.junit
+
+        # junit-dbless.xml, junit-db.xml or junit-db-<engine>.xml
+        junit_files = sorted(
+            glob.glob(os.path.join(self.log_dir, 'junit-db*.xml')))
+        if not junit_files:
+            return
+        with self.timings.stage('slow tests'):
+            try:
+                quibble.junit.slow_tests(
+                    junit_files,
+                    os.path.join(self.log_dir, 'phpunit-slow.json'),
+                    baseline=self.args.slow_tests_baseline,
+                    threshold=self.args.slow_tests_threshold / 100,
+                    top=self.args.slow_tests_top)
+            except Exception:
+                # Must not hide the outcome of the tests
+                self.log.exception('Could not report slow tests')
+
+    def run_core_stage(self):
+        import quibble.test
+
+        run_composer = self.should_run('composer-test')
+        run_npm = self.should_run('npm-test')
+        self.run_stage(
+            'core tests',
+            lambda: quibble.test.run_core(
+                self.mw_install_path,
+                composer=run_composer,
+                npm=run_npm),
+            self.stage_config(composer=run_composer, npm=run_npm))
+
+    def run_qunit_stage(self):
+        import quibble.test
+
+        self.backends.get(self.engine_backend('web'))
+        debugging_port = self.resources.port(9222)
+        try:
+            with self.timings.stage(self.engine_backend('qunit')):
+                quibble.test.run_qunit(
+                    self.mw_install_path,
+                    port=self.http_port,
+                    remote_debugging_port=debugging_port)
+        finally:
+            self.resources.free_port(debugging_port)
+
+    def has_selenium_tests(self):
+        # Webdriver.io Selenium tests available since 1.29
+        return os.path.exists(
+            os.path.join(self.mw_install_path, 'tests/selenium'))
+
+    def run_selenium_stage(self):
+        import quibble.test
+
+        self.backends.get(self.engine_backend('web'))
+        stage = self.engine_backend('selenium')
+        if self.args.selenium_workers > 1:
+            pool = self.backends.get('chromedriver-pool')
+            log_dir = self.log_dir
+            if self.engine is not None:
+                log_dir = os.path.join(self.log_dir, self.engine)
+                os.makedirs(log_dir, exist_ok=True)
+            with self.timings.stage(stage):
+                quibble.test.run_webdriver_parallel(
+                    mwdir=self.mw_install_path,
+                    drivers=pool.drivers,
+                    log_dir=log_dir,
+                    port=self.http_port)
+        else:
+            chromedriver = self.backends.get('chromedriver')
+            with self.timings.stage(stage):
+                quibble.test.run_webdriver(
+                    mwdir=self.mw_install_path,
+                    port=self.http_port,
+                    display=chromedriver.display)
 
-    def execute(self):
-        logging.basicConfig(level=logging.INFO)
-        logging.getLogger('quibble').setLevel(logging.DEBUG)
-        quibble.colored_logging()
+    def run_database_stages(self, phpunit_testsuite):
+        """
+        Stages using the database, run for each engine when --db has
+        several.
+        """
+        if self.should_run('qunit'):
+            self.restore_db()
+            self.run_qunit_stage()
+        if self.should_run('selenium') and self.has_selenium_tests():
+            self.restore_db()
+            self.run_selenium_stage()
+        if self.should_run('phpunit'):
+            self.restore_db()
+            self.run_phpunit_stage('db', phpunit_testsuite,
+                                   separate_log=self.engine is not None)
+
+    def run_engines(self, zuul_project, phpunit_testsuite):
+        import quibble.test
+
+        if self.should_run('phpunit'):
+            self.run_phpunit_stage('dbless', phpunit_testsuite)
+        if zuul_project == 'mediawiki/core':
+            self.run_core_stage()
+        quibble.test.thread_run([
+            (lambda run=run: run.run_database_stages(phpunit_testsuite))
+            for run in self.engine_runs])
 
-        self.args = self.parse_arguments()
+    def execute(self, args=None):
+        self.args = self.parse_arguments(args)
 
         self.workspace = self.args.workspace
         self.mw_install_path = os.path.join(self.workspace, 'src')
@@ -413,6 +1110,58 @@ class QuibbleCmd(object):
 
         self.setup_environment()
 
+        self.allocate_resources()
+        self.register_backends()
+        self.setup_cgroups()
+        self.setup_tracer()
+
+        packager = None
+        if self.args.package_artifacts:
+            import quibble.artifacts
+            packager = quibble.artifacts.Packager(
+                self.log_dir,
+                max_size=self.args.log_max_size * 1024 * 1024 or None)
+
+        try:
+            with self.lifetime():
+                try:
+                    self.run()
+                finally:
+                    if packager is not None:
+                        # While backends are stopped
+                        packager.start()
+        finally:
+            self.free_engine_ports()
+            self.timings.report()
+            self.timings.dump(os.path.join(self.log_dir, 'timing.json'))
+            if self.cgroups is not None:
+                self.cgroups.teardown()
+                self.backends.cgroups = None
+            if self.tracer is not None:
+                self.tracer.stop()
+                self.tracer.dump(os.path.join(self.log_dir, 'trace.json'))
+                self.backends.tracer = None
+            if packager is not None:
+                packager.finish()
+
+    def allocate_resources(self):
+        self.resources = quibble.resources.ResourceAllocator(
+            runtime_dir=self.args.runtime_dir)
+        self.http_port = self.resources.port(self.http_port)
+
+    def lifetime(self):
+        """
+        Context manager releasing the resources and backends of the run.
+        """
+        stack = contextlib.ExitStack()
+        stack.enter_context(self.resources)
+        stack.enter_context(self.backends)
+        return stack
+
+    def run(self):
+        import quibble.test
+        import quibble.zuul
+
         zuul_project = os.environ.get('ZUUL_PROJECT', None)
         if zuul_project is None:
             self.log.warning('ZUUL_PROJECT not set. Assuming mediawiki/core')
@@ -425,8 +1174,31 @@ class QuibbleCmd(object):
             clone_vendor=(self.args.packages_source == 'vendor'))
 
         if not self.args.skip_zuul:
-            self.clone(projects_to_clone)
-            self.ext_skin_submodule_update()
+            with self.timings.stage('clone'):
+                self.clone(projects_to_clone)
+            with self.timings.stage('submodules'):
+                self.ext_skin_submodule_update()
+
+        trees = self.git_trees(projects_to_clone)
+        self.setup_opcache(trees)
+        self.setup_result_cache(trees)
+
+        self.project_dir = os.path.join(
+            self.mw_install_path, quibble.zuul.repo_dir(zuul_project))
+        try:
+            # Stages forked by parallel_run() inherit the cached result
+            for changed in quibble.gitchangedinhead.changed_files(
+                    self.project_dir):
+                self.changed_files.append(changed.path)
+                if changed.old_path:
+                    self.changed_files.append(changed.old_path)
+        except subprocess.CalledProcessError:
+            self.log.warning('Could not find files changed in %s' % (
+                self.project_dir))
+
+        self.stage_rules = quibble.relevance.StageRules.for_project(
+            self.project_dir, filename=self.args.stage_rules)
+        self.setup_engine_runs()
 
         if self.isExtOrSkin(zuul_project):
             run_composer = self.should_run('composer-test')
@@ -436,8 +1208,12 @@ class QuibbleCmd(object):
                     self.mw_install_path,
                     quibble.zuul.repo_dir(os.environ['ZUUL_PROJECT']))
 
-                quibble.test.run_extskin(directory=project_dir,
-                                         composer=run_composer, npm=run_npm)
+                self.run_stage(
+                    'extskin tests',
+                    lambda: quibble.test.run_extskin(directory=project_dir,
+                                                     composer=run_composer,
+                                                     npm=run_npm),
+                    self.extskin_config(project_dir, run_composer, run_npm))
 
                 self.log.info('%s: git clean -xqdf' % project_dir)
                 subprocess.check_call(['git', 'clean', '-xqdf'],
@@ -450,18 +1226,30 @@ class QuibbleCmd(object):
                    '--ansi', '--no-progress', '--prefer-dist',
                    '--profile', '-v',
                    ]
-            subprocess.check_call(cmd, cwd=self.mw_install_path)
-
-        self.mw_install()
+            with self.timings.stage('composer update'):
+                subprocess.check_call(cmd, cwd=self.mw_install_path)
+
+        if self.needs_install():
+            with self.timings.stage('install'):
+                self.install()
+            if self.args.isolate_db:
+                for run in self.engine_runs or [self]:
+                    run.checkpoint_db()
+        else:
+            self.log.info('Skipping MediaWiki installation: no stage '
+                          'needs it')
 
         if not self.args.skip_deps:
-            if self.args.packages_source == 'vendor':
-                self.log.info('vendor.git used. '
-                              'Requiring composer dev dependencies')
-                self.fetch_composer_dev()
+            with self.timings.stage('dependencies'):
+                if self.args.packages_source == 'vendor':
+                    self.log.info('vendor.git used. '
+                                  'Requiring composer dev dependencies')
+                    self.fetch_composer_dev()
 
-            subprocess.check_call(['npm', 'prune'], cwd=self.mw_install_path)
-            subprocess.check_call(['npm', 'install'], cwd=self.mw_install_path)
+                subprocess.check_call(['npm', 'prune'],
+                                      cwd=self.mw_install_path)
+                subprocess.check_call(['npm', 'install'],
+                                      cwd=self.mw_install_path)
 
         phpunit_testsuite = None
         if self.args.phpunit_testsuite:
@@ -471,69 +1259,28 @@ class QuibbleCmd(object):
         elif zuul_project.startswith('mediawiki/skins/'):
             phpunit_testsuite = 'skins'
 
-        if self.should_run('phpunit'):
-            self.log.info("PHPUnit%swithout Database group" % (
-                ' %s suite ' % (phpunit_testsuite or ' ')))
-            # XXX might want to run the triggered extension first then the
-            # other tests.
-            # XXX some mediawiki/core smoke PHPunit tests should probably
-            # be run as well.
-            junit_dbless_file = os.path.join(
-                self.log_dir, 'junit-dbless.xml')
-            quibble.test.run_phpunit_databaseless(
-                mwdir=self.mw_install_path,
-                testsuite=phpunit_testsuite,
-                junit_file=junit_dbless_file)
-
-        if zuul_project == 'mediawiki/core':
-            quibble.test.run_core(
-                self.mw_install_path,
-                composer=self.should_run('composer-test'),
-                npm=self.should_run('npm-test')
-            )
-
-        http_port = 9412
-        if self.should_run('qunit') or self.should_run('selenium'):
-            with quibble.backend.DevWebServer(
-                    mwdir=self.mw_install_path,
-                    port=http_port):
-                if self.should_run('qunit'):
-                    quibble.test.run_qunit(self.mw_install_path,
-                                           port=http_port)
-
-                # Webdriver.io Selenium tests available since 1.29
-                if self.should_run('selenium') and \
-                        os.path.exists(os.path.join(
-                            self.mw_install_path, 'tests/selenium')):
-                    with ExitStack() as stack:
-                        display = os.environ.get('DISPLAY', None)
-                        if not display:
-                            display = ':94'  # XXX racy when run concurrently!
-                            self.log.info("No DISPLAY, using Xvfb.")
-                            stack.enter_context(
-                                quibble.backend.Xvfb(display=display))
-
-                        with quibble.backend.ChromeWebDriver(display=display):
-                            quibble.test.run_webdriver(
-                                mwdir=self.mw_install_path,
-                                port=http_port,
-                                display=display)
-
-        if self.should_run('phpunit'):
-            self.log.info("PHPUnit%sDatabase group" % (
-                ' %s suite ' % (phpunit_testsuite or ' ')))
-            junit_db_file = os.path.join(
-                self.log_dir, 'junit-db.xml')
-            quibble.test.run_phpunit_database(
-                mwdir=self.mw_install_path,
-                testsuite=phpunit_testsuite,
-                junit_file=junit_db_file)
+        try:
+            if self.engine_runs:
+                self.run_engines(zuul_project, phpunit_testsuite)
+            elif self.args.parallel_stages is None:
+                if self.should_run('phpunit'):
+                    self.run_phpunit_stage('dbless', phpunit_testsuite)
+                if zuul_project == 'mediawiki/core':
+                    self.run_core_stage()
+                self.run_database_stages(phpunit_testsuite)
+            else:
+                self.run_stages_concurrently(zuul_project, phpunit_testsuite)
+        finally:
+            # Also helps finding out why a run timed out
+            if self.should_run('phpunit'):
+                self.report_slow_tests()
 
         if self.args.commands:
             self.log.info('User commands')
-            with quibble.backend.DevWebServer(
-                    mwdir=self.mw_install_path,
-                    port=http_port):
+            # With several engines, the first one is used by default
+            run = (self.engine_runs or [self])[0]
+            self.backends.get(run.engine_backend('web'))
+            with self.timings.stage('commands'):
                 quibble.test.commands(
                     self.args.commands,
                     cwd=self.mw_install_path)
@@ -554,6 +1301,17 @@ def get_arg_parser():
 
 
 def main():
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('quibble').setLevel(logging.DEBUG)
+    quibble.colored_logging()
+
+    if sys.argv[1:2] == ['worker']:
+        import quibble.worker
+        return quibble.worker.main(sys.argv[2:])
+    if sys.argv[1:2] == ['batch']:
+        import quibble.batch
+        return quibble.batch.main(sys.argv[2:])
+
     cmd = QuibbleCmd()
     cmd.execute()
 
@@ -52,8 +52,125 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """
 
+import os
 import subprocess
 
+# (repository path, HEAD commit) => list of ChangedFile
+_changed_files_cache = {}
+
+
+class ChangedFile:
+    """
+    A file changed by HEAD.
+
+    status is the git diff status letter: A (added), C (copied), M
+    (modified) or R (renamed). old_path is the source path of a copy or a
+    rename, else None.
+    """
+
+    def __init__(self, status, path, old_path=None):
+        self.status = status
+        self.path = path
+        self.old_path = old_path
+
+    def __eq__(self, other):
+        return (self.status, self.path, self.old_path) == (
+            other.status, other.path, other.old_path)
+
+    def __repr__(self):
+        if self.old_path:
+            return '<%s %s -> %s>' % (self.status, self.old_path, self.path)
+        return '<%s %s>' % (self.status, self.path)
+
+
+def _git_dir(cwd):
+    git_dir = os.path.join(cwd, '.git')
+    if os.path.isfile(git_dir):
+        # Submodules and worktrees: "gitdir: <path>"
+        with open(git_dir) as f:
+            git_dir = os.path.join(cwd, f.read().split(':', 1)[1].strip())
+    return git_dir
+
+
+def head_commit(cwd=None):
+    """
+    Commit HEAD points to, read from the repository files without
+    spawning git. None when it can not be figured out.
+    """
+    try:
+        git_dir = _git_dir(cwd or os.getcwd())
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head  # detached
+        ref = head[len('ref: '):]
+        ref_file = os.path.join(git_dir, ref)
+        if os.path.exists(ref_file):
+            with open(ref_file) as f:
+                return f.read().strip()
+        with open(os.path.join(git_dir, 'packed-refs')) as f:
+            for line in f:
+                if line.rstrip().endswith(' ' + ref):
+                    return line.split(' ', 1)[0]
+    except (OSError, IndexError):
+        pass
+    return None
+
+
+def changed_files(cwd=None):
+    """
+    Files added, copied, modified or renamed by HEAD.
+
+    git is run once per repository and HEAD commit, later calls are served
+    from a cache.
+    """
+    key = (os.path.realpath(cwd or os.getcwd()), head_commit(cwd))
+    if key[1] is None or key not in _changed_files_cache:
+        _changed_files_cache[key] = list(_git_changed_files(cwd))
+    return _changed_files_cache[key]
+
+
+def clear_cache():
+    _changed_files_cache.clear()
+
+
+def _git_changed_files(cwd):
+    # Some explanations for the git command below:
+    # HEAD^ will not exist for an initial commit, we thus need `git show`
+    # --name-status: strip patch payload, only report the file being altered
+    #                and how.
+    # --diff-filter=ACMR: only care about files Added, Copied, Modified or
+    #                     Renamed
+    # --find-renames=100%: renamed files that had a slight change would be
+    #                      considered modified and thus included.
+    # -m: show differences for merge commits ...
+    # --first-parent: ... but only follow the first parent commit
+    # --format=format: : strip out the commit summary
+    cmd = [
+        'git', 'show', 'HEAD',
+        '--name-status',
+        '--diff-filter=ACMR',
+        '--find-renames=100%',
+        '-m',
+        '--first-parent',
+        '--format=format:',
+    ]
+    out = subprocess.check_output(cmd, cwd=cwd).decode()
+    seen = set()
+    for line in out.splitlines():
+        if not line:
+            continue
+        fields = line.split('\t')
+        status = fields[0][0]
+        if status in ('C', 'R'):
+            changed = ChangedFile(status, fields[2], old_path=fields[1])
+        else:
+            changed = ChangedFile(status, fields[1])
+        if changed.path in seen:
+            continue
+        seen.add(changed.path)
+        yield changed
+
 
 class GitChangedInHead:
     def __init__(self, args, cwd=None):
@@ -67,26 +184,11 @@ class GitChangedInHead:
         return [f for f in self.get_changed_files()]
 
     def get_changed_files(self):
-        # Some explanations for the git command below:
-        # HEAD^ will not exist for an initial commit, we thus need `git show`
-        # --name-only: strip patch payload, only report the file being altered
-        # --diff-filter=ACM: only care about files Added, Copied or Modified
-        # --find-renames=100%: renamed files that had a slight change would be
-        #                      considered modified and thus included.
-        # -m: show differences for merge commits ...
-        # --first-parent: ... but only follow the first parent commit
-        # --format=format: : strip out the commit summary
-        cmd = [
-            'git', 'show', 'HEAD',
-            '--name-only',
-            '--diff-filter=ACM',
-            '--find-renames=100%',
-            '-m',
-            '--first-parent',
-            '--format=format:',
-        ]
-        out = subprocess.check_output(cmd, cwd=self.cwd).decode()
-        for line in out.splitlines():
+        for changed in changed_files(self.cwd):
+            # Pure renames are not changes
+            if changed.status == 'R':
+                continue
+            line = changed.path
             # If matching on file extensions, filter that out
             if self.path_args and not line.endswith(tuple(self.path_args)):
                 continue
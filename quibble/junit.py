@@ -0,0 +1,157 @@
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+from collections import defaultdict
+import heapq
+import json
+import logging
+import xml.etree.ElementTree as ET
+
+# PHPUnit suffixes the name of tests fed by a data provider
+DATA_SET = ' with data set '
+
+
+def testcases(filename):
+    """
+    Yield (class, test name, seconds) for each testcase of a junit file.
+
+    The file is parsed incrementally and elements are dropped once read, so
+    memory does not grow with the size of the file.
+    """
+    context = ET.iterparse(filename, events=('end',))
+    for (_, elem) in context:
+        if elem.tag == 'testcase':
+            try:
+                duration = float(elem.get('time', 0))
+            except ValueError:
+                duration = 0.0
+            yield (elem.get('class') or elem.get('classname') or '',
+                   elem.get('name', ''),
+                   duration)
+            elem.clear()
+        elif elem.tag == 'testsuite':
+            # Drops the (cleared) testcases and nested suites
+            elem.clear()
+
+
+class SlowTests:
+    """
+    Rank the slowest tests, test classes and data providers.
+
+    Only the top slowest tests are kept. Classes and data providers (test
+    methods fed by a data provider, all data sets summed) are aggregated.
+    """
+
+    log = logging.getLogger('quibble.junit')
+
+    def __init__(self, top=20):
+        self.top = top
+        self._tests = []
+        self._classes = defaultdict(float)
+        self._providers = defaultdict(float)
+
+    def add(self, classname, name, duration):
+        test = '%s::%s' % (classname, name) if classname else name
+        entry = (duration, test)
+        if len(self._tests) < self.top:
+            heapq.heappush(self._tests, entry)
+        else:
+            heapq.heappushpop(self._tests, entry)
+
+        self._classes[classname] += duration
+        if DATA_SET in test:
+            self._providers[test.split(DATA_SET, 1)[0]] += duration
+
+    def add_file(self, filename):
+        for testcase in testcases(filename):
+            self.add(*testcase)
+
+    def _ranked(self, times):
+        return heapq.nlargest(self.top, ((t, n) for (n, t) in times.items()))
+
+    def report(self):
+        return {
+            kind: [{'name': name, 'time': round(duration, 3)}
+                   for (duration, name) in ranked]
+            for (kind, ranked) in [
+                ('tests', sorted(self._tests, reverse=True)),
+                ('classes', self._ranked(self._classes)),
+                ('providers', self._ranked(self._providers)),
+            ]
+        }
+
+
+def regressions(report, baseline, threshold=0.2, min_delta=0.5):
+    """
+    Entries of report slower than in baseline by more than threshold.
+
+    baseline is a report from an earlier run. Differences under min_delta
+    seconds are ignored, they are mostly noise.
+    """
+    found = []
+    for (kind, entries) in sorted(report.items()):
+        if kind == 'regressions':
+            continue
+        before = {e['name']: e['time'] for e in baseline.get(kind, [])}
+        for entry in entries:
+            if entry['name'] not in before:
+                continue
+            previous = before[entry['name']]
+            delta = entry['time'] - previous
+            if delta >= min_delta and delta > previous * threshold:
+                found.append({
+                    'kind': kind,
+                    'name': entry['name'],
+                    'time': entry['time'],
+                    'baseline': previous,
+                })
+    return found
+
+
+def format_report(report):
+    lines = []
+    for kind in ['tests', 'classes', 'providers']:
+        if not report.get(kind):
+            continue
+        lines.append('Slowest %s:' % kind)
+        for entry in report[kind]:
+            lines.append('  %8.2fs %s' % (entry['time'], entry['name']))
+    return '\n'.join(lines)
+
+
+def slow_tests(junit_files, output, baseline=None, threshold=0.2, top=20):
+    """
+    Write a report of the slowest tests of junit_files to output.
+
+    When a baseline report is given, regressions are added to the report
+    and logged. Returns the report.
+    """
+    log = logging.getLogger('quibble.junit')
+    slow = SlowTests(top=top)
+    for junit_file in junit_files:
+        slow.add_file(junit_file)
+    report = slow.report()
+
+    if baseline is not None:
+        with open(baseline) as f:
+            report['regressions'] = regressions(
+                report, json.load(f), threshold=threshold)
+        for r in report['regressions']:
+            log.warning('Slower than baseline: %s %s %.2fs (was %.2fs)' % (
+                r['kind'], r['name'], r['time'], r['baseline']))
+
+    log.info(format_report(report))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
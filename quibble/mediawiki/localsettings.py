@@ -0,0 +1,155 @@
+# Copyright 2018, Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+import glob
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import tempfile
+
+log = logging.getLogger('quibble.mediawiki.localsettings')
+
+SETTINGS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'mediawiki.d')
+
+
+def default_cache_dir():
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'quibble')
+
+
+# Tokens of PHP code which may contain '?>' without closing PHP mode, and
+# single line comments which are ended by it.
+PHP_TOKENS = re.compile(r'''
+    (?P<comment> (?://|\#(?!\[)) [^\n]* )
+    | /\* .*? (?:\*/|\Z)
+    | <<<[ \t]*(?P<quote>["']?)(?P<label>[A-Za-z_]\w*)(?P=quote)\r?\n
+      .*? ^[ \t]*(?P=label)\b
+    | '(?:[^'\\]|\\.)*'
+    | "(?:[^"\\]|\\.)*"
+    | `(?:[^`\\]|\\.)*`
+    | (?P<close>\?>)
+''', re.VERBOSE | re.DOTALL | re.MULTILINE)
+
+
+def has_close_tag(source):
+    """
+    Whether PHP source has a closing tag, outside of strings and comments.
+    """
+    for token in PHP_TOKENS.finditer(source):
+        if token.group('close') or '?>' in (token.group('comment') or ''):
+            return True
+    return False
+
+
+def snippets(settings_dir=SETTINGS_DIR):
+    """
+    Concatenate the settings files of settings_dir in alphabetical order.
+
+    Each file must start with a PHP open tag and must not contain a closing
+    tag, since a closing tag is appended to it. Other files are skipped.
+    """
+    content = ''
+    for path in sorted(glob.glob(os.path.join(settings_dir,
+                                              '[0-9][0-9]*.php'))):
+        fname = os.path.basename(path)
+        with open(path) as f:
+            source = f.read()
+        if not source.startswith('<?php'):
+            log.warning("File '%s' does not start with '<?php' .. "
+                        "skipping." % fname)
+            continue
+        if has_close_tag(source):
+            log.warning("File '%s' contains a closing PHP tag .. "
+                        "skipping." % fname)
+            continue
+        log.debug("Proceeding '%s'..." % fname)
+        content += source + '\n?>'
+    return content
+
+
+def lint(content, cache_dir=None):
+    """
+    Check the PHP syntax of content with php -l.
+
+    The hash of content is remembered in cache_dir once it passed, so that
+    the same content is not checked again.
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    digest = hashlib.sha256(content.encode()).hexdigest()
+    marker = os.path.join(cache_dir, 'localsettings-lint', digest)
+    if os.path.exists(marker):
+        log.debug('Settings %s already validated' % digest[:12])
+        return
+
+    proc = subprocess.run(['php', '-l'], input=content.encode(),
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if proc.returncode != 0:
+        raise Exception('Invalid PHP syntax in settings:\n%s' % (
+            proc.stdout.decode()))
+
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    open(marker, 'w').close()
+
+
+def prepend(localsettings, content):
+    """
+    Atomically insert content at the beginning of localsettings.
+    """
+    with open(localsettings) as f:
+        installed = f.read()
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(localsettings),
+                                 prefix='.LocalSettings-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content + installed)
+        os.chmod(tmp, os.stat(localsettings).st_mode & 0o777)
+        os.replace(tmp, localsettings)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+DISPATCHER = """<?php
+// Generated by Quibble. Each database engine has its own settings, selected
+// with the QUIBBLE_DB environment variable.
+$quibbleDb = getenv( 'QUIBBLE_DB' ) ?: '%(default)s';
+if ( !in_array( $quibbleDb, [ %(engines)s ], true ) ) {
+\tthrow new Exception( "Unknown QUIBBLE_DB: $quibbleDb" );
+}
+require __DIR__ . "/LocalSettings-$quibbleDb.php";
+"""
+
+
+def write_dispatcher(localsettings, engines):
+    """
+    Write a LocalSettings.php including LocalSettings-<engine>.php next to
+    it, for the engine in $QUIBBLE_DB or else the first of engines.
+    """
+    with open(localsettings, 'w') as f:
+        f.write(DISPATCHER % {
+            'default': engines[0],
+            'engines': ', '.join("'%s'" % e for e in engines),
+        })
+
+
+def apply(localsettings, settings_dir=SETTINGS_DIR, cache_dir=None):
+    content = snippets(settings_dir)
+    lint(content, cache_dir=cache_dir)
+    prepend(localsettings, content)
@@ -18,7 +18,7 @@ import os
 import subprocess
 
 
-def update(args, mwdir=None):
+def update(args, mwdir=None, env=None):
     log = logging.getLogger('mw.maintenance.update')
 
     cmd = ['php', 'maintenance/update.php', '--quick']
@@ -29,6 +29,7 @@ def update(args, mwdir=None):
     update_env.update(os.environ)
     if mwdir is not None:
         update_env['MW_INSTALL_PATH'] = mwdir
+    update_env.update(env or {})
 
     p = subprocess.Popen(cmd, cwd=mwdir, env=update_env)
     p.communicate()
@@ -0,0 +1,101 @@
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+import logging
+import os
+import subprocess
+import tempfile
+
+
+def php_ini_scan_dir():
+    """
+    Directory php scans for additional .ini files, None if there is none.
+    """
+    out = subprocess.check_output(['php', '--ini']).decode()
+    for line in out.splitlines():
+        if line.startswith('Scan for additional .ini files in:'):
+            scan_dir = line.split(':', 1)[1].strip()
+            if scan_dir != '(none)':
+                return scan_dir
+    return None
+
+
+class OpcacheFileCache:
+    """
+    Opcache with a file cache for the PHP command line.
+
+    Quibble spawns many short lived php processes, each of them compiling the
+    MediaWiki sources again. setup() writes an .ini file enabling opcache for
+    the command line with a file cache and adds it to PHP_INI_SCAN_DIR, child
+    processes thus share the compiled scripts.
+
+    When a base directory is given, the file cache is kept in a sub directory
+    named after key and can be reused by later runs. Else a temporary
+    directory is used for the duration of the run.
+
+    It is also a collector for quibble.timing.Timings reporting how many
+    scripts have been compiled (cache misses) during a stage.
+    """
+
+    log = logging.getLogger('quibble.opcache')
+
+    def __init__(self, base_dir=None, key=None):
+        if base_dir is None:
+            self._tmpdir = tempfile.TemporaryDirectory(
+                prefix='quibble-opcache-')
+            self.cache_dir = self._tmpdir.name
+        else:
+            self.cache_dir = os.path.join(base_dir, key or 'default')
+        self.file_cache = os.path.join(self.cache_dir, 'files')
+        self.ini_dir = os.path.join(self.cache_dir, 'php.d')
+        self._cached_at_begin = {}
+
+    def settings(self):
+        return [
+            'opcache.enable=1',
+            'opcache.enable_cli=1',
+            'opcache.file_cache=%s' % self.file_cache,
+            'opcache.file_cache_consistency_checks=1',
+            'opcache.validate_timestamps=1',
+        ]
+
+    def setup(self, env=os.environ):
+        os.makedirs(self.file_cache, exist_ok=True)
+        os.makedirs(self.ini_dir, exist_ok=True)
+        with open(os.path.join(self.ini_dir, 'quibble-opcache.ini'),
+                  'w') as f:
+            f.write('\n'.join(self.settings()) + '\n')
+
+        # Setting PHP_INI_SCAN_DIR overrides the compiled in directory which
+        # loads the opcache extension, keep it.
+        scan_dirs = env.get('PHP_INI_SCAN_DIR') or php_ini_scan_dir()
+        env['PHP_INI_SCAN_DIR'] = os.pathsep.join(
+            d for d in [scan_dirs, self.ini_dir] if d)
+
+        self.log.info('PHP opcache file cache in %s (%s scripts cached)' % (
+            self.file_cache, self.cached_scripts()))
+
+    def cached_scripts(self):
+        count = 0
+        for (_, _, files) in os.walk(self.file_cache):
+            count += sum(1 for f in files if f.endswith('.bin'))
+        return count
+
+    def begin(self, name):
+        self._cached_at_begin[name] = self.cached_scripts()
+
+    def end(self, name):
+        cached = self.cached_scripts()
+        compiled = cached - self._cached_at_begin.pop(name, cached)
+        return {'opcache compiled': compiled, 'opcache cached': cached}
@@ -0,0 +1,183 @@
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+import json
+import logging
+import os
+import re
+import subprocess
+import time
+
+TEAMCITY_MESSAGE = re.compile(r"^##teamcity\[(\w+)(.*)\]\s*$")
+TEAMCITY_ATTRIBUTE = re.compile(r"(\w+)='((?:[^|']|\|.)*)'")
+TEAMCITY_ESCAPES = {
+    "'": "'", 'n': '\n', 'r': '\r', '[': '[', ']': ']', '|': '|',
+}
+
+
+def teamcity_unescape(value):
+    return re.sub(r'\|(.)',
+                  lambda m: TEAMCITY_ESCAPES.get(m.group(1), m.group(1)),
+                  value)
+
+
+def parse_teamcity(line):
+    """
+    (message, attributes) of a TeamCity service message, None otherwise.
+    """
+    match = TEAMCITY_MESSAGE.match(line)
+    if not match:
+        return None
+    attributes = {k: teamcity_unescape(v)
+                  for (k, v) in TEAMCITY_ATTRIBUTE.findall(match.group(2))}
+    return (match.group(1), attributes)
+
+
+class TestProgress:
+    """
+    Follow a test run through its TeamCity log while it is in progress.
+
+    Failures are reported as soon as they happen and counts of passed,
+    failed, skipped and slow tests are written to summary_file, at most every
+    interval seconds, for CI to poll. With fail_fast, the run is aborted once
+    that many tests failed.
+    """
+
+    log = logging.getLogger('quibble.progress')
+
+    def __init__(self, name, teamcity_file, summary_file, fail_fast=None,
+                 slow=1.0, interval=1.0, report_interval=60):
+        self.name = name
+        self.teamcity_file = teamcity_file
+        self.summary_file = summary_file
+        self.fail_fast = fail_fast
+        self.slow = slow
+        self.interval = interval
+        self.report_interval = report_interval
+
+        self.status = 'pending'
+        self.counts = {'passed': 0, 'failed': 0, 'skipped': 0, 'slow': 0}
+        self.failures = []
+        self._outcomes = {}
+        self._written = 0
+        self._reported = time.monotonic()
+
+    def feed(self, line):
+        parsed = parse_teamcity(line)
+        if parsed is None:
+            return
+        (message, attrs) = parsed
+        test = attrs.get('name')
+
+        if message == 'testStarted':
+            self._outcomes[test] = 'passed'
+        elif message == 'testFailed':
+            self._outcomes[test] = 'failed'
+            failure = {'name': test, 'message': attrs.get('message', '')}
+            self.failures.append(failure)
+            self.log.error('%s: FAILED %s: %s' % (
+                self.name, test, failure['message']))
+        elif message == 'testIgnored':
+            self._outcomes[test] = 'skipped'
+        elif message == 'testFinished':
+            self.counts[self._outcomes.pop(test, 'passed')] += 1
+            try:
+                duration = int(attrs.get('duration', 0)) / 1000
+            except ValueError:
+                duration = 0
+            if duration >= self.slow:
+                self.counts['slow'] += 1
+
+    def should_abort(self):
+        # Counted as soon as reported, the failing test might never finish
+        return (self.fail_fast is not None
+                and len(self.failures) >= self.fail_fast)
+
+    def summary(self):
+        return {
+            'name': self.name,
+            'status': self.status,
+            'running': len(self._outcomes),
+            'counts': self.counts,
+            'failures': self.failures,
+            'updated': time.time(),
+        }
+
+    def write_summary(self, force=True):
+        if not force and time.monotonic() - self._written < self.interval:
+            return
+        # Written aside then renamed, a poller never reads a partial file
+        tmp = self.summary_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        os.replace(tmp, self.summary_file)
+        self._written = time.monotonic()
+
+    def format(self):
+        return '%s: %s passed, %s failed, %s skipped, %s slow' % (
+            self.name, self.counts['passed'], self.counts['failed'],
+            self.counts['skipped'], self.counts['slow'])
+
+    def start(self):
+        """
+        Create an empty TeamCity log, before the test run opens it.
+        """
+        open(self.teamcity_file, 'w').close()
+
+    def follow(self, proc):
+        """
+        Tail the TeamCity log until proc exits.
+
+        Raises CalledProcessError when proc fails, and an Exception when the
+        run has been aborted after too many failures.
+        """
+        self.status = 'running'
+        self.write_summary()
+        pending = ''
+        with open(self.teamcity_file) as f:
+            while True:
+                # Polled before reading so nothing written before the exit
+                # is missed.
+                running = proc.poll() is None
+                pending += f.read()
+                *lines, pending = pending.split('\n')
+                for line in lines:
+                    self.feed(line)
+
+                if self.should_abort():
+                    proc.terminate()
+                    proc.wait()
+                    self.status = 'aborted'
+                    self.write_summary()
+                    raise Exception('%s: aborted after %s failures' % (
+                        self.name, len(self.failures)))
+
+                if not running:
+                    break
+                self.write_summary(force=False)
+                if time.monotonic() - self._reported >= self.report_interval:
+                    self.log.info(self.format())
+                    self._reported = time.monotonic()
+                try:
+                    # Returns as soon as the run is over
+                    proc.wait(timeout=self.interval)
+                except subprocess.TimeoutExpired:
+                    pass
+        self.feed(pending)
+
+        self.status = 'passed' if proc.returncode == 0 else 'failed'
+        self.write_summary()
+        self.log.info(self.format())
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
@@ -0,0 +1,82 @@
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+from fnmatch import fnmatch
+import logging
+import os
+
+# Read from the root of the project being tested
+PROJECT_RULES_FILE = '.quibble.yaml'
+
+
+class StageRules:
+    """
+    Decide which stages can be affected by the files changed.
+
+    rules maps a stage to shell patterns of the paths which can affect it. A
+    stage having rules is only run when one of the changed files matches
+    one of its patterns. Stages without rules are always run.
+
+    Example of a rules file::
+
+        stages:
+          phpunit: ['*.php', 'composer.json', 'extension.json']
+          qunit: ['*.js', '*.json', '*.less', '*.css']
+    """
+
+    log = logging.getLogger('quibble.relevance')
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    @classmethod
+    def load(cls, filename):
+        import yaml
+
+        with open(filename) as f:
+            conf = yaml.safe_load(f) or {}
+        rules = conf.get('stages', {})
+        if not isinstance(rules, dict):
+            raise Exception('%s: "stages" must map stages to lists of '
+                            'patterns' % filename)
+        cls.log.info('Loaded stage rules from %s' % filename)
+        return cls(rules)
+
+    @classmethod
+    def for_project(cls, project_dir, filename=None):
+        """
+        Rules from filename if given, else from the project rules file.
+
+        None when there is no rules.
+        """
+        if filename is None:
+            filename = os.path.join(project_dir, PROJECT_RULES_FILE)
+            if not os.path.exists(filename):
+                return None
+        return cls.load(filename)
+
+    def skip_reason(self, stage, changed_files):
+        """
+        Why stage can not be affected by changed_files, None if it can.
+        """
+        patterns = self.rules.get(stage)
+        if patterns is None:
+            return None
+        if not changed_files:
+            # Nothing to decide upon
+            return None
+        for path in changed_files:
+            if any(fnmatch(path, pattern) for pattern in patterns):
+                return None
+        return 'no changed file matches %s' % ', '.join(patterns)
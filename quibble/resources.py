@@ -0,0 +1,140 @@
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+import fcntl
+import logging
+import os
+import socket
+import tempfile
+
+
+def default_runtime_dir():
+    return os.path.join(tempfile.gettempdir(), 'quibble-resources')
+
+
+def port_is_free(port):
+    with socket.socket() as s:
+        try:
+            s.bind(('127.0.0.1', port))
+        except OSError:
+            return False
+    return True
+
+
+def display_is_free(number):
+    return not any(os.path.exists(path) for path in [
+        '/tmp/.X%s-lock' % number,
+        '/tmp/.X11-unix/X%s' % number,
+    ])
+
+
+class ResourceAllocator:
+    """
+    Allocate TCP ports and X displays among concurrent Quibble runs.
+
+    A resource is claimed by holding an exclusive lock on a file named after
+    it in runtime_dir, which must be shared by the runs. The locks are
+    released by release() or when the process exits.
+    """
+
+    log = logging.getLogger('quibble.resources')
+
+    def __init__(self, runtime_dir=None, attempts=1000):
+        self.runtime_dir = runtime_dir or default_runtime_dir()
+        self.attempts = attempts
+        self._locks = {}
+
+        if not os.path.isdir(self.runtime_dir):
+            os.makedirs(self.runtime_dir, exist_ok=True)
+            try:
+                # Shared by all users, like /tmp
+                os.chmod(self.runtime_dir, 0o1777)
+            except PermissionError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _claim(self, name):
+        if name in self._locks:
+            return False
+        path = os.path.join(self.runtime_dir, '%s.lock' % name)
+        try:
+            # flock() works on read only files, which other users can open
+            # whatever the umask of the user who created it.
+            fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o666)
+        except PermissionError:
+            # Left unreadable by another user
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._locks[name] = fd
+        return True
+
+    def _unclaim(self, name):
+        fd = self._locks.pop(name, None)
+        if fd is not None:
+            os.close(fd)
+
+    def port(self, preferred):
+        """
+        Claim a free TCP port, the preferred one or the next free one.
+        """
+        for port in range(preferred, preferred + self.attempts):
+            name = 'port-%s' % port
+            if not self._claim(name):
+                continue
+            if port_is_free(port):
+                self.log.debug('Allocated port %s' % port)
+                return port
+            self._unclaim(name)
+        raise Exception('No free TCP port in range %s-%s' % (
+            preferred, preferred + self.attempts - 1))
+
+    def free_port(self, port):
+        """
+        Release a port claimed with port().
+        """
+        self._unclaim('port-%s' % port)
+
+    def display(self, preferred=94):
+        """
+        Claim a free X display number, returned as ':<number>'.
+        """
+        for number in range(preferred, preferred + self.attempts):
+            name = 'display-%s' % number
+            if not self._claim(name):
+                continue
+            if display_is_free(number):
+                self.log.debug('Allocated display :%s' % number)
+                return ':%s' % number
+            self._unclaim(name)
+        raise Exception('No free X display in range %s-%s' % (
+            preferred, preferred + self.attempts - 1))
+
+    def free_display(self, display):
+        """
+        Release a display claimed with display().
+        """
+        self._unclaim('display-%s' % display.lstrip(':'))
+
+    def release(self):
+        for name in list(self._locks):
+            self._unclaim(name)
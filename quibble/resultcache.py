@@ -0,0 +1,196 @@
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+from functools import lru_cache
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+# Tools whose version affects the outcome of a stage
+TOOLS = [
+    ['php', '--version'],
+    ['composer', '--version'],
+    ['node', '--version'],
+    ['npm', '--version'],
+]
+
+
+@lru_cache(maxsize=1)
+def tool_versions():
+    versions = {}
+    for cmd in TOOLS:
+        try:
+            versions[cmd[0]] = subprocess.check_output(
+                cmd, stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            versions[cmd[0]] = None
+    return versions
+
+
+@lru_cache(maxsize=1)
+def quibble_digest():
+    """
+    Hash of the files of Quibble: the commands it builds and the settings it
+    adds to LocalSettings.php.
+    """
+    package = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for (root, dirs, files) in os.walk(package):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for name in sorted(files):
+            if name.endswith('.pyc'):
+                continue
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, package).encode())
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def dir_size(directory):
+    size = 0
+    for (root, _, files) in os.walk(directory):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class ResultCache:
+    """
+    Replay results of successful stages run against identical trees.
+
+    A stage result is stored in a sub directory of cache_dir named after a
+    hash of the git trees of all repositories, the stage name and
+    configuration, the versions of the tools and the files of Quibble. It
+    holds the artifacts of the stage (junit files, logs...) which are copied
+    back to the log directory when the result is replayed.
+
+    Results older than ttl seconds are evicted, as are the least recently
+    used ones once the cache exceeds max_size bytes.
+    """
+
+    log = logging.getLogger('quibble.resultcache')
+
+    def __init__(self, cache_dir, trees, ttl=7 * 86400,
+                 max_size=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.trees = trees
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, stage, config):
+        return hashlib.sha256(json.dumps({
+            'trees': self.trees,
+            'stage': stage,
+            'config': config,
+            'tools': tool_versions(),
+            'quibble': quibble_digest(),
+        }, sort_keys=True).encode()).hexdigest()
+
+    def _entry(self, stage, config):
+        return os.path.join(self.cache_dir, self.key(stage, config))
+
+    def _is_expired(self, entry):
+        try:
+            with open(os.path.join(entry, 'result.json')) as f:
+                created = json.load(f)['created']
+        except (OSError, ValueError, KeyError):
+            return True
+        return time.time() - created > self.ttl
+
+    def replay(self, stage, config, log_dir):
+        """
+        Copy the artifacts of a cached result to log_dir.
+
+        Returns whether there was a result to replay.
+        """
+        entry = self._entry(stage, config)
+        if not os.path.isdir(entry) or self._is_expired(entry):
+            return False
+
+        artifacts_dir = os.path.join(entry, 'artifacts')
+        for name in os.listdir(artifacts_dir):
+            shutil.copy2(os.path.join(artifacts_dir, name),
+                         os.path.join(log_dir, name))
+        # Mark as recently used
+        os.utime(entry)
+        self.log.info('%s: replayed result from %s' % (stage, entry))
+        return True
+
+    def store(self, stage, config, artifacts=()):
+        entry = self._entry(stage, config)
+        if os.path.isdir(entry) and not self._is_expired(entry):
+            # Stored by a concurrent run, the result is the same
+            self.log.debug('%s: result already in %s' % (stage, entry))
+            return
+
+        # Fill a temporary directory then rename it, so a concurrent run
+        # never sees a partial result.
+        tmp_entry = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            artifacts_dir = os.path.join(tmp_entry, 'artifacts')
+            os.mkdir(artifacts_dir)
+            for artifact in artifacts:
+                if os.path.exists(artifact):
+                    shutil.copy2(artifact, artifacts_dir)
+            with open(os.path.join(tmp_entry, 'result.json'), 'w') as f:
+                json.dump({
+                    'stage': stage,
+                    'config': config,
+                    'trees': self.trees,
+                    'created': time.time(),
+                }, f)
+
+            shutil.rmtree(entry, ignore_errors=True)
+            try:
+                os.rename(tmp_entry, entry)
+            except OSError:
+                if not os.path.isdir(entry):
+                    raise
+                # A concurrent run stored it in between
+                self.log.debug('%s: result already in %s' % (stage, entry))
+                return
+        finally:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.log.debug('%s: stored result in %s' % (stage, entry))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            if self._is_expired(entry):
+                self.log.debug('Evicting expired %s' % entry)
+                shutil.rmtree(entry, ignore_errors=True)
+                continue
+            entries.append((os.path.getmtime(entry), dir_size(entry), entry))
+
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, entry) in sorted(entries):
+            if total <= self.max_size:
+                break
+            self.log.debug('Evicting %s to fit in cache size' % entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
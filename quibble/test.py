@@ -16,6 +16,8 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 
+from concurrent.futures import ThreadPoolExecutor
+import glob
 import logging
 import os
 import subprocess
@@ -43,17 +45,37 @@ def task_wrapper(args):
         return ret
 
 
-def parallel_run(tasks):
+def parallel_run(tasks, workers=None):
     """
     Tasks is an iteratable of (function, args...).
 
     They should ALL return None.
+
+    At most workers tasks are run at the same time, by default all of them.
     """
-    workers = max(1, len(tasks))
+    workers = max(1, min(workers or len(tasks), len(tasks)))
     with Pool(processes=workers) as pool:
         return all(pool.imap_unordered(task_wrapper, tasks))
 
 
+def thread_run(tasks, workers=None):
+    """
+    Call each of tasks concurrently in threads of this process.
+
+    For tasks which can not be sent to another process, such as stages
+    sharing the backends of the run. At most workers tasks are run at the same
+    time, by default one per CPU. Once all tasks are done, the exception
+    raised by the first failing one is raised.
+    """
+    if not tasks:
+        return
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(task) for task in tasks]
+    for future in futures:
+        future.result()
+
+
 def run_core(mwdir, composer=True, npm=True):
     tasks = []
     if composer:
@@ -99,7 +121,7 @@ def run_npm_test(mwdir):
     subprocess.check_call(['npm', 'test'], cwd=mwdir, env=os.environ)
 
 
-def run_qunit(mwdir, port=9412):
+def run_qunit(mwdir, port=9412, remote_debugging_port=9222):
     karma_env = {
          'CHROME_BIN': '/usr/bin/chromium',
          'MW_SERVER': 'http://127.0.0.1:%s' % port,
@@ -107,7 +129,8 @@ def run_qunit(mwdir, port=9412):
          'FORCE_COLOR': '1',  # for 'supports-color'
          }
     karma_env.update(os.environ)
-    karma_env.update({'CHROMIUM_FLAGS': quibble.chromium_flags()})
+    karma_env.update({'CHROMIUM_FLAGS': quibble.chromium_flags(
+        remote_debugging_port=remote_debugging_port)})
 
     subprocess.check_call(
         ['./node_modules/.bin/grunt', 'qunit'],
@@ -165,7 +188,15 @@ def run_extskin_npm(directory):
 
 
 def run_phpunit(mwdir, group=[], exclude_group=[], testsuite=None,
-                junit_file=None):
+                junit_file=None, log_file=None, progress=None, env=None):
+    """
+    Run PHPUnit.
+
+    When given a quibble.progress.TestProgress, PHPUnit also writes a
+    TeamCity log which is followed while the tests are running.
+
+    env holds extra environment variables for PHPUnit.
+    """
 
     log = logging.getLogger('test.run_phpunit')
     always_excluded = ['Broken', 'ParserFuzz', 'Stub']
@@ -182,13 +213,35 @@ def run_phpunit(mwdir, group=[], exclude_group=[], testsuite=None,
 
     if junit_file:
         cmd.extend(['--log-junit', junit_file])
+    if progress is not None:
+        cmd.extend(['--log-teamcity', progress.teamcity_file])
     log.info(' '.join(cmd))
 
     phpunit_env = {}
     phpunit_env.update(os.environ)
     phpunit_env.update({'LANG': 'C.UTF-8'})
+    phpunit_env.update(env or {})
+
+    def call(**kwargs):
+        if progress is None:
+            subprocess.check_call(cmd, cwd=mwdir, env=phpunit_env, **kwargs)
+        else:
+            progress.start()
+            progress.follow(subprocess.Popen(
+                cmd, cwd=mwdir, env=phpunit_env, **kwargs))
+
+    if log_file is None:
+        call()
+        return
 
-    subprocess.check_call(cmd, cwd=mwdir, env=phpunit_env)
+    # Keep the output apart from the stages running concurrently
+    log.info('Output written to %s' % log_file)
+    with open(log_file, 'w') as f:
+        try:
+            call(stdout=f, stderr=subprocess.STDOUT)
+        except Exception:
+            log.error('PHPUnit failed, see %s' % log_file)
+            raise
 
 
 def run_phpunit_database(*args, **kwargs):
@@ -212,7 +265,7 @@ def commands(cmds, cwd):
     return True
 
 
-def run_webdriver(mwdir, display, port=9412):
+def webdriver_environment(port, display):
     webdriver_env = {}
     webdriver_env.update(os.environ)
     webdriver_env.update({
@@ -221,10 +274,96 @@ def run_webdriver(mwdir, display, port=9412):
         'FORCE_COLOR': '1',  # for 'supports-color'
         'MEDIAWIKI_USER': 'WikiAdmin',
         'MEDIAWIKI_PASSWORD': 'testwikijenkinspass',
-        'DISPLAY': display,
     })
+    if display:
+        webdriver_env['DISPLAY'] = display
+    else:
+        # Headless
+        webdriver_env.pop('DISPLAY', None)
+    return webdriver_env
+
+
+def run_webdriver(mwdir, display=None, port=9412):
+    webdriver_env = webdriver_environment(port, display)
 
     subprocess.check_call([
         'npm', 'run', 'selenium-test'],
         cwd=mwdir,
         env=webdriver_env)
+
+
+# Spec files run by MediaWiki core tests/selenium/wdio.conf.js
+SELENIUM_SPECS = [
+    'tests/selenium/specs/**/*.js',
+    'extensions/*/tests/selenium/specs/**/*.js',
+    'skins/*/tests/selenium/specs/**/*.js',
+]
+
+
+def selenium_specs(mwdir):
+    specs = set()
+    for pattern in SELENIUM_SPECS:
+        specs.update(glob.glob(os.path.join(mwdir, pattern), recursive=True))
+    return sorted(os.path.relpath(spec, mwdir) for spec in specs)
+
+
+def distribute(items, buckets, weight=lambda item: 1):
+    """
+    Spread items in buckets with roughly the same total weight.
+
+    Heaviest items are placed first, each in the lightest bucket.
+    """
+    loads = [0] * buckets
+    distributed = [[] for _ in range(buckets)]
+    for item in sorted(items, key=weight, reverse=True):
+        lightest = loads.index(min(loads))
+        distributed[lightest].append(item)
+        loads[lightest] += weight(item)
+    return [sorted(bucket) for bucket in distributed if bucket]
+
+
+def run_webdriver_parallel(mwdir, drivers, log_dir, port=9412):
+    """
+    Run the Selenium specs spread among several chromedriver instances.
+
+    Each worker writes its output, screenshots and reports to a
+    selenium-<n> sub directory of log_dir.
+    """
+    log = logging.getLogger('test.run_webdriver_parallel')
+
+    specs = selenium_specs(mwdir)
+    buckets = distribute(
+        specs, len(drivers),
+        weight=lambda spec: os.path.getsize(os.path.join(mwdir, spec)))
+    log.info('Running %s Selenium specs with %s workers' % (
+        len(specs), len(buckets)))
+
+    workers = []
+    for (i, (driver, bucket)) in enumerate(zip(drivers, buckets)):
+        worker_log_dir = os.path.join(log_dir, 'selenium-%s' % i)
+        os.makedirs(worker_log_dir, exist_ok=True)
+
+        webdriver_env = webdriver_environment(port, driver.display)
+        webdriver_env['LOG_DIR'] = worker_log_dir
+
+        cmd = ['npm', 'run', 'selenium-test', '--',
+               '--port', str(driver.port)]
+        for spec in bucket:
+            cmd.extend(['--spec', spec])
+        log.info('Worker %s: %s' % (i, ' '.join(bucket)))
+
+        output = open(os.path.join(worker_log_dir, 'selenium.log'), 'w')
+        workers.append((cmd, output, subprocess.Popen(
+            cmd, cwd=mwdir, env=webdriver_env,
+            stdout=output, stderr=subprocess.STDOUT)))
+
+    failed = []
+    for (cmd, output, proc) in workers:
+        proc.wait()
+        output.close()
+        if proc.returncode != 0:
+            log.error('Selenium worker failed, see %s' % output.name)
+            failed.append(subprocess.CalledProcessError(proc.returncode, cmd))
+
+    if failed:
+        raise failed[0]
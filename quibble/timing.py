@@ -0,0 +1,70 @@
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import time
+
+
+class Timings:
+    """
+    Record how long each stage of a run took.
+
+    Collectors can be added to report extra values per stage. They must
+    provide begin(name) and end(name), the later returning a dict of values
+    to report alongside the duration.
+    """
+
+    log = logging.getLogger('quibble.timing')
+
+    def __init__(self):
+        self.collectors = []
+        self.records = []
+
+    @contextmanager
+    def stage(self, name):
+        for collector in self.collectors:
+            collector.begin(name)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            extra = OrderedDict()
+            for collector in self.collectors:
+                extra.update(collector.end(name) or {})
+            self.records.append((name, duration, extra))
+            self.log.debug('%s finished in %.1fs' % (name, duration))
+
+    def report(self):
+        if not self.records:
+            return
+        width = max(len(name) for (name, _, _) in self.records)
+        lines = ['Timing report:']
+        for (name, duration, extra) in self.records:
+            line = '  %s %7.1fs' % (name.ljust(width), duration)
+            if extra:
+                line += '  ' + ', '.join(
+                    '%s: %s' % (k, v) for k, v in extra.items())
+            lines.append(line)
+        self.log.info('\n'.join(lines))
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump([
+                dict(stage=name, duration=round(duration, 3), **extra)
+                for (name, duration, extra) in self.records
+            ], f, indent=2)
@@ -0,0 +1,238 @@
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+"""
+Timeline of a run in the Chrome trace event format, to be loaded in
+https://ui.perfetto.dev/ or chrome://tracing.
+"""
+
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+import quibble.backend
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def read_stat(pid):
+    """
+    (command name, CPU seconds, RSS bytes) of a process. The CPU time
+    includes the children it has waited for.
+    """
+    with open('/proc/%s/stat' % pid) as f:
+        stat = f.read()
+    # The command name is between parenthesis and may contain spaces
+    (head, _, tail) = stat.rpartition(')')
+    fields = tail.split()
+    # utime, stime, cutime and cstime are fields 14 to 17
+    ticks = sum(int(t) for t in fields[11:15])
+    return (head.partition('(')[2], ticks / CLOCK_TICKS,
+            int(fields[21]) * PAGE_SIZE)
+
+
+def read_io(pid):
+    """
+    Bytes read from and written to storage by a process.
+    """
+    io = {}
+    with open('/proc/%s/io' % pid) as f:
+        for line in f:
+            (key, _, value) = line.partition(':')
+            io[key] = int(value)
+    return (io.get('read_bytes', 0), io.get('write_bytes', 0))
+
+
+def read_cmdline(pid):
+    with open('/proc/%s/cmdline' % pid, 'rb') as f:
+        return f.read().rstrip(b'\0').replace(b'\0', b' ').decode(
+            errors='replace')
+
+
+class Tracer:
+    """
+    Record spans of the run and samples of its processes.
+
+    Spans are recorded by span(), and for stages by acting as a collector of
+    quibble.timing.Timings. While started, a thread samples the CPU usage,
+    resident memory and IO of Quibble and its descendants from /proc every
+    interval seconds. The processes seen by the sampler are reported as
+    spans of their own, from the first to the last sample they were seen
+    in: short lived commands may be missed.
+    """
+
+    log = logging.getLogger('quibble.trace')
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.pid = os.getpid()
+        self.origin = time.monotonic()
+        self.events = []
+        self.processes = {}
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._begun = {}
+        self._stop = threading.Event()
+        self._sampler = None
+        self._io = {}
+        self._cpu = None
+
+    def _ts(self, instant):
+        # Microseconds
+        return round((instant - self.origin) * 1e6)
+
+    def _thread(self):
+        tid = threading.get_ident()
+        if tid not in self._threads:
+            self._threads[tid] = threading.current_thread().name
+        return tid
+
+    def add_span(self, name, cat, start, end, args=None):
+        event = {
+            'name': name, 'cat': cat, 'ph': 'X',
+            'ts': self._ts(start), 'dur': self._ts(end) - self._ts(start),
+            'pid': self.pid, 'tid': self._thread(),
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_span(name, cat, start, time.monotonic(), args)
+
+    def begin(self, name):
+        self._begun[(threading.get_ident(), name)] = time.monotonic()
+
+    def end(self, name):
+        start = self._begun.pop((threading.get_ident(), name), None)
+        if start is not None:
+            self.add_span(name, 'stage', start, time.monotonic())
+        return {}
+
+    def sample(self):
+        now = time.monotonic()
+        cpu = rss = 0
+        read = written = 0
+        seen = set()
+        for pid in quibble.backend.process_tree(self.pid):
+            try:
+                (comm, seconds, resident) = read_stat(pid)
+            except (OSError, IndexError, ValueError):
+                # Exited
+                continue
+            seen.add(pid)
+            cpu += seconds
+            rss += resident
+            try:
+                io = read_io(pid)
+            except (OSError, ValueError):
+                io = None
+            if io is not None:
+                (last_read, last_written) = self._io.get(pid, (0, 0))
+                read += max(0, io[0] - last_read)
+                written += max(0, io[1] - last_written)
+                self._io[pid] = io
+
+            if pid == self.pid:
+                continue
+            if pid not in self.processes:
+                try:
+                    cmdline = read_cmdline(pid)
+                except OSError:
+                    cmdline = comm
+                self.processes[pid] = {'name': comm, 'cmdline': cmdline,
+                                       'first': now, 'last': now}
+            self.processes[pid]['last'] = now
+
+        for pid in list(self._io):
+            if pid not in seen:
+                del self._io[pid]
+
+        counters = [('rss', {'MiB': round(rss / 1048576, 1)})]
+        if self._cpu is not None:
+            (last_time, last_cpu) = self._cpu
+            elapsed = now - last_time
+            counters += [
+                ('cpu', {'cores': round(
+                    max(0, cpu - last_cpu) / elapsed, 2)}),
+                ('io', {'read MiB/s': round(read / elapsed / 1048576, 2),
+                        'write MiB/s': round(
+                            written / elapsed / 1048576, 2)}),
+            ]
+        self._cpu = (now, cpu)
+        with self._lock:
+            for (name, args) in counters:
+                self.events.append({
+                    'name': name, 'ph': 'C', 'ts': self._ts(now),
+                    'pid': self.pid, 'args': args})
+
+    def _run_sampler(self):
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception:
+                self.log.exception('Could not sample processes')
+                return
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._sampler = threading.Thread(target=self._run_sampler,
+                                         name='trace sampler', daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def trace_events(self):
+        events = [{
+            'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+            'args': {'name': 'quibble'},
+        }]
+        for (tid, name) in list(self._threads.items()):
+            events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                'tid': tid, 'args': {'name': name},
+            })
+        for (pid, process) in sorted(self.processes.items()):
+            events += [{
+                'name': 'process_name', 'ph': 'M', 'pid': pid,
+                'args': {'name': process['name']},
+            }, {
+                'name': process['name'], 'cat': 'process', 'ph': 'X',
+                'ts': self._ts(process['first']),
+                'dur': self._ts(process['last']) - self._ts(process['first']),
+                'pid': pid, 'tid': pid,
+                'args': {'cmdline': process['cmdline']},
+            }]
+        with self._lock:
+            events += self.events
+        return events
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.trace_events(),
+                       'displayTimeUnit': 'ms'}, f)
+        self.log.info('Trace written to %s' % filename)
@@ -0,0 +1,267 @@
+# Copyright 2018 Wikimedia Foundation Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import socketserver
+import sys
+import time
+
+import quibble.backend
+import quibble.cmd
+import quibble.resources
+
+
+def default_socket():
+    return os.path.join(quibble.resources.default_runtime_dir(),
+                        'worker-%s.sock' % os.getuid())
+
+
+class WarmBackends(quibble.backend.BackendRegistry):
+    """
+    Backends kept running across the jobs of a worker.
+
+    At the end of a job, the backends it started are reset instead of being
+    stopped, and are handed to the next jobs registering them with the same
+    key. A backend which can not be reset, or which is registered with another
+    key, is stopped and started again. Databases having a dump directory are
+    dumped before being reset.
+    """
+
+    log = logging.getLogger('quibble.worker')
+
+    def __init__(self):
+        super(WarmBackends, self).__init__()
+        self._started_keys = {}
+
+    def __exit__(self, *args):
+        # End of a job
+        self.reset()
+
+    def get(self, name):
+        with self._lock:
+            if name in self._backends:
+                if self._started_keys[name] != self.key(name):
+                    self.log.info('%s configuration changed, restarting' % (
+                        name))
+                    self.stop_backend(name)
+                else:
+                    self.log.debug('Reusing warm %s' % name)
+            if name not in self._backends:
+                self._started_keys[name] = self.key(name)
+            return super(WarmBackends, self).get(name)
+
+    def reset(self):
+        for name in reversed(list(self._backends)):
+            backend = self._backends[name]
+            if isinstance(backend, quibble.backend.DatabaseServer):
+                # --dump-db-postrun of the job, before its database is gone
+                backend.dump_once()
+            start = time.monotonic()
+            try:
+                backend.reset()
+            except Exception as e:
+                self.log.info('Stopping %s: %s' % (name, e))
+                self.stop_backend(name)
+            else:
+                self.log.debug('Reset %s in %.2fs' % (
+                    name, time.monotonic() - start))
+
+
+class WorkerJob(quibble.cmd.QuibbleCmd):
+    """
+    A Quibble run using the backends and resources of a worker.
+    """
+
+    def __init__(self, worker):
+        super(WorkerJob, self).__init__()
+        self.worker = worker
+        self.backends = worker.backends
+
+    def allocate_resources(self):
+        # Held by the worker, since the backends outlive the job
+        self.resources = self.worker.resources
+        self.http_port = self.worker.http_port
+
+    def lifetime(self):
+        return self.backends
+
+    def clone(self, projects):
+        self.remove_stale_repos(projects)
+        super(WorkerJob, self).clone(projects)
+
+    def remove_stale_repos(self, projects):
+        """
+        Remove the extensions and skins cloned by earlier jobs that this one
+        does not ask for, else MediaWiki would install and test them.
+        """
+        import quibble.zuul
+
+        wanted = set(os.path.normpath(quibble.zuul.repo_dir(p))
+                     for p in projects)
+        for pattern in ['extensions/*/.git', 'skins/*/.git']:
+            for git_dir in sorted(glob.glob(
+                    os.path.join(self.mw_install_path, pattern))):
+                repo = os.path.dirname(git_dir)
+                if os.path.relpath(repo, self.mw_install_path) in wanted:
+                    continue
+                self.log.info('Removing %s cloned by an earlier job' % repo)
+                shutil.rmtree(repo)
+
+
+class Worker:
+    """
+    Run Quibble jobs received on a unix socket, one at a time.
+
+    A job is a JSON object on a single line, with "args" the command line
+    arguments of quibble and "env" environment variables to set for the job
+    (ZUUL_PROJECT...). The worker replies with a JSON object on a single line
+    having "status" ("passed", "failed" or "error"), "duration" and, unless
+    the job passed, "error".
+    """
+
+    log = logging.getLogger('quibble.worker')
+
+    def __init__(self, socket_path, runtime_dir=None):
+        self.socket_path = socket_path
+        self.backends = WarmBackends()
+        self.resources = quibble.resources.ResourceAllocator(
+            runtime_dir=runtime_dir)
+        self.http_port = self.resources.port(quibble.cmd.QuibbleCmd.http_port)
+
+    def prestart(self, db):
+        """
+        Start a database before the first job asks for it.
+
+        Matches jobs using the same engine and neither --db-dir nor
+        --dump-db-postrun.
+        """
+        dbclass = quibble.backend.getDBClass(engine=db)
+        self.backends.register('db', lambda: dbclass(),
+                               key=(db, None, None, None))
+        self.backends.get('db')
+
+    def run_job(self, job):
+        start = time.monotonic()
+        environ = dict(os.environ)
+        os.environ.update(job.get('env', {}))
+        try:
+            WorkerJob(self).execute(job.get('args', []))
+            result = {'status': 'passed'}
+        except SystemExit as e:
+            # Raised by argparse on invalid arguments
+            result = {'status': 'error', 'error': 'exit code %s' % e.code}
+        except Exception as e:
+            self.log.exception('Job failed')
+            result = {'status': 'failed', 'error': str(e)}
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        result['duration'] = round(time.monotonic() - start, 3)
+        self.log.info('Job %s in %.1fs' % (result['status'],
+                                           result['duration']))
+        return result
+
+    def server(self):
+        worker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    job = json.loads(self.rfile.readline().decode())
+                except ValueError as e:
+                    result = {'status': 'error', 'error': str(e)}
+                else:
+                    result = worker.run_job(job)
+                self.wfile.write(json.dumps(result).encode() + b'\n')
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        # Jobs can run arbitrary commands, only accept the current user
+        umask = os.umask(0o077)
+        try:
+            return socketserver.UnixStreamServer(self.socket_path, Handler)
+        finally:
+            os.umask(umask)
+
+    def serve(self):
+        server = self.server()
+        self.log.info('Waiting for jobs on %s' % self.socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(self.socket_path)
+            self.backends.stop()
+            self.resources.release()
+
+
+def submit(socket_path, args, env=None):
+    """
+    Send a job to a worker and wait for its result.
+    """
+    with socket.socket(socket.AF_UNIX) as s:
+        s.connect(socket_path)
+        s.sendall(json.dumps({'args': args, 'env': env or {}}).encode()
+                  + b'\n')
+        with s.makefile('rb') as f:
+            return json.loads(f.readline().decode())
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog='quibble worker',
+        description=(
+            'Run Quibble jobs received on a unix socket, keeping backends '
+            'started between jobs.'))
+    parser.add_argument(
+        '--socket', default=default_socket(),
+        help='Unix socket to listen on. Default: %(default)s')
+    parser.add_argument(
+        '--runtime-dir', default=None,
+        help='See quibble --help')
+    parser.add_argument(
+        '--db', default=None, choices=['sqlite', 'mysql', 'postgres'],
+        help='Database to start before the first job')
+    parser.add_argument(
+        '--submit', action='store_true',
+        help=('Send the quibble arguments following -- to the worker, with '
+              'the ZUUL_* environment variables, and wait for the result'))
+    parser.add_argument(
+        'args', nargs='*', help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv):
+    args = get_arg_parser().parse_args(argv)
+
+    if args.submit:
+        env = {k: v for (k, v) in os.environ.items()
+               if k.startswith('ZUUL_')}
+        result = submit(args.socket, args.args, env=env)
+        print(json.dumps(result))
+        return 0 if result['status'] == 'passed' else 1
+
+    # Let serve() clean up
+    signal.signal(signal.SIGTERM, lambda *a: sys.exit(0))
+    worker = Worker(args.socket, runtime_dir=args.runtime_dir)
+    if args.db:
+        worker.prestart(args.db)
+    worker.serve()
@@ -13,8 +13,10 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 
+from collections import OrderedDict
 import logging
 import os
+import subprocess
 
 from zuul.lib.cloner import Cloner
 from zuul.lib.clonemapper import CloneMapper
@@ -27,7 +29,21 @@ CLONE_MAP = [
 ]
 
 
-def clone(repos, workspace, cache_dir, branch=None, project_branch=[]):
+class TracedCloner(Cloner):
+    """
+    Cloner recording the preparation of each repository with a
+    quibble.trace.Tracer.
+    """
+
+    tracer = None
+
+    def prepareRepo(self, project, dest):
+        with self.tracer.span('clone %s' % project, 'clone', dest=dest):
+            return super(TracedCloner, self).prepareRepo(project, dest)
+
+
+def clone(repos, workspace, cache_dir, branch=None, project_branch=[],
+          tracer=None):
     logging.getLogger('zuul').setLevel(logging.DEBUG)
 
     if isinstance(repos, str):
@@ -49,7 +65,8 @@ def clone(repos, workspace, cache_dir, branch=None, project_branch=[]):
             p, p_branch = x[0].split('=')
             project_branches[p] = p_branch
 
-    zuul_cloner = Cloner(
+    cloner_class = Cloner if tracer is None else TracedCloner
+    zuul_cloner = cloner_class(
         git_base_url='https://gerrit.wikimedia.org/r/p',
         projects=repos,
         workspace=workspace,
@@ -65,6 +82,8 @@ def clone(repos, workspace, cache_dir, branch=None, project_branch=[]):
         )
     # The constructor expects a file, set the value directly
     zuul_cloner.clone_map = CLONE_MAP
+    if tracer is not None:
+        zuul_cloner.tracer = tracer
 
     return zuul_cloner.execute()
 
@@ -72,3 +91,84 @@ def clone(repos, workspace, cache_dir, branch=None, project_branch=[]):
 def repo_dir(repo):
     mapper = CloneMapper(CLONE_MAP, [repo])
     return mapper.expand(workspace='./')[repo]
+
+
+def tree_hashes(repos, workspace):
+    """
+    Map each repository to the git tree hash of its checked out HEAD.
+    """
+    hashes = OrderedDict()
+    for repo in repos:
+        hashes[repo] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD^{tree}'],
+            cwd=os.path.join(workspace, repo_dir(repo))
+        ).decode().strip()
+    return hashes
+
+
+def git_mirror(url, cache_dir):
+    """
+    Find a repository in cache_dir mirroring the repository at url.
+
+    The trailing components of the url path are looked up in cache_dir,
+    for example https://example.org/r/p/mediawiki/extensions/Foo.git would
+    match mediawiki/extensions/Foo.git or mediawiki/extensions/Foo.
+    """
+    if not cache_dir or not url:
+        return None
+    path = url.split('://', 1)[-1].rstrip('/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+    parts = path.split('/')[1:]  # strip host
+    for i in range(len(parts)):
+        base = os.path.join(cache_dir, *parts[i:])
+        for candidate in ['%s.git' % base, base]:
+            if os.path.isdir(candidate):
+                return os.path.abspath(candidate)
+    return None
+
+
+def submodule_update(directory, jobs=1, cache_dir=None):
+    """
+    Clean and update the git submodules of the repository in directory.
+
+    Submodules mirrored in cache_dir are cloned using the mirror as a
+    reference.
+    """
+    log = logging.getLogger('quibble.zuul.submodule_update')
+
+    def git(*args):
+        return subprocess.check_output(
+            ['git'] + list(args), cwd=directory).decode()
+
+    log.info('Updating submodules of %s' % directory)
+    subprocess.check_call(
+        ['git', 'submodule', 'foreach', 'git', 'clean', '-xdff', '-q'],
+        cwd=directory)
+    git('submodule', 'init')
+
+    try:
+        paths = git('config', '-f', '.gitmodules',
+                    '--get-regexp', r'^submodule\..*\.path$')
+    except subprocess.CalledProcessError:
+        paths = ''  # No submodules
+    for line in paths.splitlines():
+        (key, path) = line.split(' ', 1)
+        name = key[len('submodule.'):-len('.path')]
+        try:
+            url = git('config', '--get', 'submodule.%s.url' % name).strip()
+        except subprocess.CalledProcessError:
+            continue
+        mirror = git_mirror(url, cache_dir)
+        if mirror:
+            log.info('%s: cloning %s using %s' % (directory, path, mirror))
+            subprocess.check_call(
+                ['git', 'submodule', 'update', '--init',
+                 '--reference', mirror, '--', path],
+                cwd=directory)
+
+    subprocess.check_call(
+        ['git', 'submodule', 'update', '--init', '--recursive',
+         '--jobs', str(jobs)],
+        cwd=directory)
+    log.info('%s:\n%s' % (directory, git('submodule', 'status')))
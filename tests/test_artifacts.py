@@ -0,0 +1,123 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from quibble import artifacts
+
+
+class TestArtifacts(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+        self.log_dir = self._tmpdir.name
+
+    def write(self, name, content):
+        path = os.path.join(self.log_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def manifest(self):
+        with open(os.path.join(self.log_dir, artifacts.MANIFEST)) as f:
+            return json.load(f)
+
+    def test_truncate_middle(self):
+        path = self.write('big.log', b'a' * 10 + b'b' * 80 + b'c' * 10)
+        self.assertEqual(80, artifacts.truncate_middle(path, 20))
+        with open(path, 'rb') as f:
+            self.assertEqual(
+                b'a' * 10 + b'\n[... 80 bytes truncated by Quibble ...]\n'
+                + b'c' * 10,
+                f.read())
+        self.assertEqual(0, artifacts.truncate_middle(path, 1000))
+
+    def test_package(self):
+        big = b'PHPUnit output\n' * 1000
+        self.write('phpunit-db.log', big)
+        self.write('selenium/phpunit-db.log', big)
+        self.write('junit-db.xml', big)
+        self.write('small.log', b'x')
+
+        packager = artifacts.Packager(self.log_dir, min_size=1024)
+        packager.finish()
+
+        self.assertEqual(
+            ['artifacts.json', 'junit-db.xml', 'phpunit-db.log.gz',
+             'selenium', 'small.log'],
+            sorted(os.listdir(self.log_dir)))
+        with gzip.open(os.path.join(self.log_dir, 'phpunit-db.log.gz')) as f:
+            self.assertEqual(big, f.read())
+        # Hard linked to the first copy
+        self.assertEqual(
+            os.stat(os.path.join(self.log_dir, 'phpunit-db.log.gz')),
+            os.stat(os.path.join(self.log_dir,
+                                 'selenium/phpunit-db.log.gz')))
+        self.assertEqual(['phpunit-db.log.gz'],
+                         os.listdir(os.path.join(self.log_dir, 'selenium')))
+
+        manifest = self.manifest()
+        self.assertEqual('phpunit-db.log.gz',
+                         manifest['phpunit-db.log']['compressed'])
+        self.assertEqual('phpunit-db.log',
+                         manifest['selenium/phpunit-db.log']['duplicate_of'])
+        self.assertEqual('selenium/phpunit-db.log.gz',
+                         manifest['selenium/phpunit-db.log']['compressed'])
+        self.assertNotIn('compressed', manifest['junit-db.xml'])
+
+    def test_duplicate_of_an_early_file(self):
+        self.write('phpunit-db.log', b'a' * 2048)
+        packager = artifacts.Packager(self.log_dir, min_size=1024)
+        packager.start()
+        packager._thread.join()
+
+        self.write('mw-debug-www.log', b'a' * 2048)
+        packager.finish()
+        self.assertEqual(
+            os.stat(os.path.join(self.log_dir, 'phpunit-db.log.gz')),
+            os.stat(os.path.join(self.log_dir, 'mw-debug-www.log.gz')))
+        self.assertNotIn('mw-debug-www.log', os.listdir(self.log_dir))
+
+    def test_duplicate_is_kept_when_it_can_not_be_linked(self):
+        self.write('phpunit-db.log', b'a' * 2048)
+        self.write('selenium/phpunit-db.log', b'a' * 2048)
+        packager = artifacts.Packager(self.log_dir, min_size=1024)
+        with mock.patch('os.link', side_effect=OSError('Not supported')):
+            with self.assertLogs('quibble.artifacts', level='WARNING'):
+                packager.finish()
+        self.assertEqual(['phpunit-db.log.gz'],
+                         os.listdir(os.path.join(self.log_dir, 'selenium')))
+        self.assertNotIn('duplicate_of',
+                         self.manifest()['selenium/phpunit-db.log'])
+
+    def test_oversized_logs_are_truncated_before_compression(self):
+        self.write('mw-debug-cli.log', b'x' * 4096)
+        packager = artifacts.Packager(self.log_dir, max_size=2048,
+                                      min_size=1024)
+        packager.finish()
+        entry = self.manifest()['mw-debug-cli.log']
+        self.assertEqual(4096, entry['size'])
+        self.assertEqual(2048, entry['truncated'])
+        self.assertIn('compressed', entry)
+
+    def test_files_written_at_teardown_are_packaged_last(self):
+        self.write('phpunit-db.log', b'a' * 2048)
+        self.write('mw-debug-www.log', b'b' * 2048)
+        packager = artifacts.Packager(self.log_dir, min_size=1024)
+        packager.start()
+        packager._thread.join()
+        self.assertEqual(['phpunit-db.log'], list(packager.entries))
+
+        # Dumped while the packager was running
+        self.write('mysqldump/wikidb.page.sql.gz', b'c' * 2048)
+        packager.finish()
+        self.assertEqual(
+            ['mw-debug-www.log.gz', 'mysqldump', 'phpunit-db.log.gz'],
+            sorted(f for f in os.listdir(self.log_dir)
+                   if f != artifacts.MANIFEST))
+        self.assertNotIn(
+            'compressed', self.manifest()['mysqldump/wikidb.page.sql.gz'])
@@ -1,17 +1,31 @@
+import gzip
+import io
 import json
 import os
 import shutil
+import signal
+import sqlite3
+import subprocess
+import tempfile
 import unittest
 from unittest import mock
 import urllib.request
 
 from nose.plugins.attrib import attr
 from quibble.backend import getDBClass
+from quibble.backend import BackendRegistry
+from quibble.backend import BackendServer
+from quibble.backend import process_tree
 from quibble.backend import DatabaseServer
 from quibble.backend import ChromeWebDriver
+from quibble.backend import ChromeWebDriverPool
 from quibble.backend import DevWebServer
 from quibble.backend import MySQL
+from quibble.backend import Postgres
+from quibble.backend import SQLite
+from quibble.backend import dump_compressed
 from quibble import php_is_hhvm
+from quibble.resources import ResourceAllocator
 
 FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
 PHPDOCROOT = os.path.join(FIXTURES_DIR, 'phpdocroot')
@@ -39,6 +53,71 @@ class TestGetDBClass(unittest.TestCase):
             getDBClass('fakeDBengine')
 
 
+def mock_backend():
+    return mock.Mock(**{'peak_rss.return_value': 0})
+
+
+class TestBackendRegistry(unittest.TestCase):
+
+    def test_backend_is_started_lazily_and_once(self):
+        backend = mock_backend()
+        factory = mock.Mock(return_value=backend)
+        registry = BackendRegistry()
+        registry.register('web', factory)
+
+        self.assertFalse(factory.called)
+        self.assertNotIn('web', registry)
+
+        self.assertIs(backend, registry.get('web'))
+        self.assertIs(backend, registry.get('web'))
+        factory.assert_called_once_with()
+        backend.start.assert_called_once_with()
+        self.assertIn('web', registry)
+
+    def test_stop_in_reverse_order(self):
+        stopped = []
+        registry = BackendRegistry()
+        for name in ['db', 'web']:
+            backend = mock_backend()
+            backend.stop.side_effect = lambda name=name: stopped.append(name)
+            registry.register(name, lambda backend=backend: backend)
+            registry.get(name)
+
+        registry.stop()
+        self.assertEqual(['web', 'db'], stopped)
+        self.assertNotIn('db', registry)
+
+    def test_unregistered_backend_raises(self):
+        with self.assertRaisesRegex(Exception, 'No backend registered'):
+            BackendRegistry().get('nope')
+
+    def test_context_manager_stops_backends(self):
+        backend = mock_backend()
+        with BackendRegistry() as registry:
+            registry.register('db', lambda: backend)
+            registry.get('db')
+        backend.stop.assert_called_once_with()
+
+
+class TestBackendServer(unittest.TestCase):
+
+    @mock.patch('quibble.backend.process_tree', return_value=[1, 2])
+    def test_peak_rss_of_process_tree(self, _):
+        backend = BackendServer()
+        backend.server = mock.Mock(pid=1)
+        status = {1: 'VmHWM:\t    1024 kB\n', 2: 'VmHWM:\t    2048 kB\n'}
+        with mock.patch('builtins.open', side_effect=lambda path: io.StringIO(
+                status[int(path.split('/')[2])])):
+            self.assertEqual(3 * 1024 * 1024, backend.peak_rss())
+
+    def test_process_tree_includes_children(self):
+        with subprocess.Popen(['sleep', '10']) as child:
+            try:
+                self.assertIn(child.pid, process_tree(os.getpid()))
+            finally:
+                child.kill()
+
+
 class TestDatabaseServer(unittest.TestCase):
 
     @mock.patch('quibble.backend.os.makedirs')
@@ -67,6 +146,45 @@ class TestDatabaseServer(unittest.TestCase):
             os.path.join(os.getcwd(), 'data'),
             kwargs.get('dir'))
 
+    def test_checkpoint_is_not_supported_by_default(self):
+        with self.assertRaisesRegex(Exception, 'does not support'):
+            DatabaseServer().checkpoint()
+        with self.assertRaisesRegex(Exception, 'does not support'):
+            DatabaseServer().restore()
+
+    @mock.patch('quibble.backend.DatabaseServer.dump')
+    def test_dumps_once_on_stop(self, mock_dump):
+        db = DatabaseServer(dump_dir='/log')
+        db.stop()
+        db.stop()
+        mock_dump.assert_called_once_with()
+
+    def test_dump_not_supported(self):
+        with self.assertLogs('backend.DatabaseServer', 'WARNING') as cm:
+            DatabaseServer().dump()
+        self.assertIn('DatabaseServer does not support', cm.output[0])
+
+
+class TestDumpCompressed(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+        self.dumpfile = os.path.join(self._tmpdir.name, 'dump.sql')
+
+    def test_streams_to_gzip_and_keeps_stderr_apart(self):
+        errors = dump_compressed(
+            ['sh', '-c', 'echo CREATE TABLE; echo warning >&2'],
+            self.dumpfile)
+        self.assertEqual('warning\n', errors)
+        with gzip.open(self.dumpfile + '.gz') as f:
+            self.assertEqual(b'CREATE TABLE\n', f.read())
+
+    def test_failure_raises(self):
+        with self.assertRaisesRegex(Exception, 'failed .*: boom'):
+            dump_compressed(['sh', '-c', 'echo boom >&2; exit 2'],
+                            self.dumpfile)
+
 
 class TestChromeWebDriver(unittest.TestCase):
 
@@ -125,6 +243,41 @@ class TestChromeWebDriver(unittest.TestCase):
         self.assertEqual(os.environ['DISPLAY'], ':30')
 
 
+@mock.patch('quibble.backend.tcp_wait')
+@mock.patch('quibble.backend.ChromeWebDriver.start')
+class TestChromeWebDriverPool(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+        self.allocator = ResourceAllocator(runtime_dir=self._tmpdir.name)
+        self.addCleanup(self.allocator.release)
+
+    def pool(self, **kwargs):
+        return ChromeWebDriverPool(
+            2, self.allocator,
+            base_dir=os.path.join(self._tmpdir.name, 'profiles'), **kwargs)
+
+    @mock.patch('quibble.backend.Xvfb.start')
+    def test_stop_frees_ports_and_displays(self, *_):
+        pool = self.pool(xvfb=True)
+        pool.start()
+        self.assertEqual(6, len(self.allocator._locks))
+
+        pool.stop()
+        self.assertEqual({}, self.allocator._locks)
+
+    def test_start_failure_stops_started_drivers(self, driver_start, _):
+        driver_start.side_effect = [None, Exception('chromedriver failed')]
+        pool = self.pool()
+        with mock.patch('quibble.backend.ChromeWebDriver.stop') as stop:
+            with self.assertRaisesRegex(Exception, 'chromedriver failed'):
+                pool.start()
+        self.assertEqual(2, stop.call_count)
+        self.assertEqual([], pool.workers)
+        self.assertEqual({}, self.allocator._locks)
+
+
 class TestDevWebServer(unittest.TestCase):
 
     def assertServerRespond(self, flavor, url):
@@ -202,6 +355,15 @@ class TestDevWebServer(unittest.TestCase):
         self.assertIn('MW_LOG_DIR', server_env)
         self.assertIn('LOG_DIR', server_env)
 
+    @mock.patch('urllib.request.urlopen')
+    def test_warmup_requests_paths(self, mock_urlopen):
+        server = DevWebServer(port=4886)
+        server.warmup(['/load.php', '/index.php']).join()
+
+        urls = [args[0] for (args, kwargs) in mock_urlopen.call_args_list]
+        self.assertEqual(['http://127.0.0.1:4886/load.php',
+                          'http://127.0.0.1:4886/index.php'], urls)
+
 
 class TestMySQL(unittest.TestCase):
 
@@ -221,3 +383,142 @@ class TestMySQL(unittest.TestCase):
         mock_popen.return_value.returncode = 42
         with self.assertRaises(Exception, msg='FAILED (42): some output'):
             MySQL()._createwikidb()
+
+    @mock.patch('quibble.backend.MySQL._install_db')
+    @mock.patch('quibble.backend.subprocess.Popen')
+    def test_reset_recreates_wikidb(self, mock_popen, _):
+        mock_popen.return_value.communicate.return_value = ('', None)
+        mock_popen.return_value.returncode = 0
+        MySQL().reset()
+        (_, kwargs) = mock_popen.return_value.communicate.call_args
+        self.assertTrue(kwargs['input'].startswith(
+            'DROP DATABASE IF EXISTS wikidb;CREATE DATABASE'))
+
+    @mock.patch('quibble.backend.MySQL._install_db')
+    @mock.patch('quibble.backend.subprocess.Popen')
+    def test_checkpoint_copies_tables(self, mock_popen, _):
+        mock_popen.return_value.communicate.side_effect = [
+            ('page\nuser\n', None), ('', None)]
+        mock_popen.return_value.returncode = 0
+        MySQL().checkpoint()
+
+        (_, kwargs) = mock_popen.return_value.communicate.call_args
+        self.assertIn('DROP DATABASE IF EXISTS wikidb_checkpoint;\n'
+                      'CREATE DATABASE wikidb_checkpoint;\n'
+                      'CREATE TABLE wikidb_checkpoint.`page` '
+                      'LIKE wikidb.`page`;\n'
+                      'INSERT INTO wikidb_checkpoint.`page` '
+                      'SELECT * FROM wikidb.`page`;\n',
+                      kwargs['input'])
+        self.assertIn('wikidb_checkpoint.`user`', kwargs['input'])
+
+    @mock.patch('quibble.backend.MySQL._install_db')
+    @mock.patch('quibble.backend.dump_compressed', return_value='')
+    def test_dump_per_table(self, mock_dump, _):
+        mysql = MySQL(dump_dir=tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, mysql.dump_dir)
+        with mock.patch.object(mysql, '_mysql',
+                               return_value='wikidb\tpage\nmysql\tuser\n'):
+            mysql.dump()
+        self.assertEqual(
+            [os.path.join(mysql.dump_dir, 'mysqldump', f)
+             for f in ['mysql.user.sql', 'wikidb.page.sql']],
+            sorted(args[1] for (args, _) in mock_dump.call_args_list))
+
+    @mock.patch('quibble.backend.MySQL._install_db')
+    def test_restore_requires_a_checkpoint(self, _):
+        with self.assertRaisesRegex(Exception, 'No checkpoint'):
+            MySQL().restore()
+
+
+class TestSQLite(unittest.TestCase):
+
+    def test_reset_removes_database_files(self):
+        sqlite = SQLite()
+        with open(os.path.join(sqlite.rootdir, 'wikidb.sqlite'), 'w'):
+            pass
+        os.mkdir(os.path.join(sqlite.rootdir, 'locks'))
+        sqlite.reset()
+        self.assertEqual([], os.listdir(sqlite.rootdir))
+
+    def query(self, sqlite, sql, dbname='wikidb'):
+        conn = sqlite3.connect(
+            os.path.join(sqlite.rootdir, '%s.sqlite' % dbname))
+        try:
+            with conn:
+                return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def test_restore_checkpoint(self):
+        sqlite = SQLite()
+        self.query(sqlite, 'CREATE TABLE page (title TEXT)')
+        self.query(sqlite, "INSERT INTO page VALUES ('Main_Page')")
+        sqlite.checkpoint()
+
+        self.query(sqlite, "INSERT INTO page VALUES ('Test')")
+        self.query(sqlite, 'CREATE TABLE cache (k TEXT)', dbname='wikicache')
+        sqlite.restore()
+
+        self.assertEqual([('Main_Page',)],
+                         self.query(sqlite, 'SELECT title FROM page'))
+        self.assertEqual(['.checkpoint', 'wikidb.sqlite'],
+                         sorted(os.listdir(sqlite.rootdir)))
+
+    def test_reset_discards_checkpoint(self):
+        sqlite = SQLite()
+        self.query(sqlite, 'CREATE TABLE page (title TEXT)')
+        sqlite.checkpoint()
+        sqlite.reset()
+        with self.assertRaisesRegex(Exception, 'No checkpoint'):
+            sqlite.restore()
+
+    def test_dump(self):
+        sqlite = SQLite(dump_dir=tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, sqlite.dump_dir)
+        self.query(sqlite, 'CREATE TABLE page (title TEXT)')
+        sqlite.dump()
+        self.assertEqual(['wikidb.sqlite.gz'], os.listdir(sqlite.dump_dir))
+
+
+class TestPostgres(unittest.TestCase):
+
+    def dump_compress(self, compression, version):
+        postgres = Postgres(dump_compression=compression)
+        with mock.patch('subprocess.check_output', return_value=version):
+            return postgres._dump_compress()
+
+    def test_dump_with_zstd(self):
+        self.assertEqual('zstd', self.dump_compress(
+            'zstd', 'pg_dump (PostgreSQL) 16.2\n'))
+
+    def test_dump_falls_back_to_gzip_before_postgres_16(self):
+        with self.assertLogs('backend.Postgres', level='WARNING'):
+            self.assertEqual('6', self.dump_compress(
+                'zstd', 'pg_dump (PostgreSQL) 15.6 (Debian 15.6-0+deb12u1)\n'))
+        self.assertEqual('6', self.dump_compress('gzip', None))
+
+    def test_dump_before_the_cluster_is_deleted(self):
+        postgres = Postgres(dump_dir='/dump')
+        postgres.server = mock.Mock()
+        postgres.hook_pid = 1234
+        calls = mock.Mock()
+        with mock.patch.object(postgres, 'dump', calls.dump), \
+                mock.patch('os.kill', calls.kill):
+            postgres.stop()
+        self.assertEqual(
+            [mock.call.dump(), mock.call.kill(1234, signal.SIGUSR1)],
+            calls.mock_calls)
+
+    def test_restore_without_checkpoint(self):
+        postgres = Postgres()
+        postgres.dbname = 'wikidb'
+        with mock.patch.object(postgres, '_psql') as psql:
+            with self.assertRaisesRegex(Exception, 'No checkpoint'):
+                postgres.restore()
+            psql.assert_not_called()
+
+            postgres.checkpoint_name = 'wikidb_checkpoint'
+            postgres.checkpoint()
+            postgres.restore()
+        self.assertEqual(2, psql.call_count)
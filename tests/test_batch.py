@@ -0,0 +1,118 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from quibble import batch
+
+SPEC = """
+defaults:
+  args: [--db, sqlite]
+  env:
+    ZUUL_BRANCH: master
+jobs:
+  - project: mediawiki/extensions/Foo
+  - project: mediawiki/extensions/Bar
+    ref: refs/changes/12/3412/1
+    args: [--skip-deps]
+    run: [phpunit]
+"""
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+        self.tmpdir = self._tmpdir.name
+        self.spec = os.path.join(self.tmpdir, 'batch.yaml')
+        with open(self.spec, 'w') as f:
+            f.write(SPEC)
+
+    def test_load_spec(self):
+        (foo, bar) = batch.load_spec(self.spec)
+        self.assertEqual('1-mediawiki-extensions-Foo', foo['name'])
+        self.assertEqual(['--db', 'sqlite'], foo['args'])
+        self.assertEqual(
+            {'ZUUL_PROJECT': 'mediawiki/extensions/Foo',
+             'ZUUL_BRANCH': 'master'},
+            foo['env'])
+        self.assertEqual(
+            ['--db', 'sqlite', '--skip-deps', '--run', 'phpunit'],
+            bar['args'])
+        self.assertEqual('refs/changes/12/3412/1', bar['env']['ZUUL_REF'])
+
+    def test_job_needs_a_project(self):
+        with open(self.spec, 'w') as f:
+            f.write('jobs: [{ref: refs/heads/master}]')
+        with self.assertRaisesRegex(Exception, 'Job 1 .* has no project'):
+            batch.load_spec(self.spec)
+
+    @mock.patch('quibble.worker.Worker')
+    def test_sequential_jobs_share_the_workspace(self, mock_worker):
+        run_job = mock_worker.return_value.run_job
+        run_job.side_effect = [
+            {'status': 'passed', 'duration': 1.0},
+            {'status': 'failed', 'duration': 2.0, 'error': 'phpunit'},
+        ]
+        log_dir = os.path.join(self.tmpdir, 'log')
+        os.makedirs(os.path.join(log_dir, '1-mediawiki-extensions-Foo'))
+        with open(os.path.join(log_dir, '1-mediawiki-extensions-Foo',
+                               'timing.json'), 'w') as f:
+            json.dump([{'stage': 'clone', 'duration': 0.5}], f)
+
+        summary = batch.Batch(batch.load_spec(self.spec), self.tmpdir,
+                              log_dir).run()
+
+        self.assertEqual(1, mock_worker.call_count)
+        for (args, _) in run_job.call_args_list:
+            self.assertEqual(
+                ['--workspace', self.tmpdir],
+                args[0]['args'][-4:-2])
+        (foo, bar) = summary['jobs']
+        self.assertEqual({'clone': 0.5}, foo['stages'])
+        self.assertEqual('failed', bar['status'])
+        mock_worker.return_value.backends.stop.assert_called_once_with()
+
+        report = batch.format_summary(summary)
+        self.assertIn('1 passed, 1 failed', report)
+        self.assertIn('clone: 0.5s', report)
+
+    def test_parallel_slots_have_their_own_workspace(self):
+        jobs = batch.load_spec(self.spec)
+        b = batch.Batch(jobs, self.tmpdir, self.tmpdir, parallel=4)
+        self.assertEqual(2, b.parallel)
+        self.assertEqual(
+            [os.path.join(self.tmpdir, 'slot0'),
+             os.path.join(self.tmpdir, 'slot1')],
+            b.workspaces())
+
+    @mock.patch('quibble.worker.Worker')
+    def test_parallel_run(self, mock_worker):
+        mock_worker.return_value.run_job.return_value = {
+            'status': 'passed', 'duration': 0.1}
+        summary = batch.Batch(batch.load_spec(self.spec), self.tmpdir,
+                              self.tmpdir, parallel=2).run()
+        self.assertEqual(
+            ['passed', 'passed'],
+            [job['status'] for job in summary['jobs']])
+
+    @mock.patch('quibble.worker.Worker')
+    def test_job_of_a_dead_slot_is_failed(self, mock_worker):
+        def run_job(job):
+            if 'Bar' in job['args'][-1]:
+                # Let the queue flush what the slot reported
+                time.sleep(0.5)
+                os._exit(3)
+            return {'status': 'passed', 'duration': 0.1}
+        mock_worker.return_value.run_job.side_effect = run_job
+
+        b = batch.Batch(batch.load_spec(self.spec), self.tmpdir,
+                        self.tmpdir, parallel=2)
+        b.poll = 0.1
+        (foo, bar) = b.run()['jobs']
+        self.assertEqual('passed', foo['status'])
+        self.assertEqual('failed', bar['status'])
+        self.assertRegex(bar['error'], 'slot . exited with code 3')
@@ -0,0 +1,140 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from quibble import cgroup
+
+
+class TestCgroups(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+        self.root = os.path.join(self._tmpdir.name, 'cgroup')
+        self.origin = os.path.join(self.root, 'test')
+        os.makedirs(self.origin)
+        self.proc_cgroup = os.path.join(self._tmpdir.name, 'proc_cgroup')
+        with open(self.proc_cgroup, 'w') as f:
+            f.write('0::/test\n')
+
+        # Delegated to the user, without io. Cgroups created below start
+        # with no controller until origin enables them.
+        self.write(self.origin, 'cgroup.controllers', 'cpu memory\n')
+        self.write(self.origin, 'cgroup.subtree_control', '')
+
+        self.cgroups = cgroup.Cgroups(
+            limits=[('memory.max', '1G')],
+            root=self.root, proc_cgroup=self.proc_cgroup)
+
+    def write(self, path, name, content):
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(content)
+
+    def read(self, path, name):
+        with open(os.path.join(path, name)) as f:
+            return f.read()
+
+    def procs(self, name):
+        with open(os.path.join(self.cgroups.path(name),
+                               'cgroup.procs')) as f:
+            return f.read()
+
+    def test_limit(self):
+        self.assertEqual(('memory.max', '4G'), cgroup.limit('memory.max=4G'))
+        self.assertEqual(('cpu.max', '200000 100000'),
+                         cgroup.limit('cpu.max=200000 100000'))
+        for invalid in ('memory.max', 'cgroup.procs=1', '../x=1'):
+            with self.assertRaises(ValueError):
+                cgroup.limit(invalid)
+
+    def test_setup(self):
+        with self.assertLogs('quibble.cgroup', level='WARNING') as logs:
+            self.assertTrue(self.cgroups.setup())
+        self.assertIn('not delegated: io', logs.output[0])
+
+        base = os.path.join(self.origin, 'quibble-%s' % os.getpid())
+        self.assertEqual(base, self.cgroups.base)
+        self.assertEqual(str(os.getpid()), self.procs('main'))
+        # The parent must enable them first
+        self.assertEqual('+cpu +memory',
+                         self.read(self.origin, 'cgroup.subtree_control'))
+        self.assertEqual('+cpu +memory',
+                         self.read(base, 'cgroup.subtree_control'))
+
+    def test_setup_without_controllers(self):
+        self.write(self.origin, 'cgroup.controllers', '')
+        with self.assertLogs('quibble.cgroup', level='WARNING') as logs:
+            self.assertTrue(self.cgroups.setup())
+        self.assertIn('not delegated: cpu, memory, io', logs.output[0])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.cgroups.base, 'cgroup.subtree_control')))
+
+    def test_controllers_already_enabled_in_origin(self):
+        self.write(self.origin, 'cgroup.subtree_control', 'cpu')
+        self.cgroups.setup()
+        self.assertEqual('+memory',
+                         self.read(self.origin, 'cgroup.subtree_control'))
+        self.assertEqual('+cpu +memory', self.read(self.cgroups.base,
+                                                   'cgroup.subtree_control'))
+
+    def test_setup_without_cgroup_v2(self):
+        with open(self.proc_cgroup, 'w') as f:
+            f.write('1:memory:/\n')
+        with self.assertLogs('quibble.cgroup', level='WARNING'):
+            self.assertFalse(self.cgroups.setup())
+        self.assertIsNone(self.cgroups.base)
+
+        # Does nothing
+        with self.cgroups.enter('phpunit'):
+            pass
+        self.assertEqual({}, self.cgroups.end('phpunit'))
+
+    def test_stage_usage(self):
+        self.cgroups.setup()
+        self.cgroups.begin('phpunit')
+        self.assertEqual(str(os.getpid()), self.procs('phpunit'))
+        with open(os.path.join(self.cgroups.path('phpunit'),
+                               'memory.max')) as f:
+            self.assertEqual('1G', f.read())
+
+        path = self.cgroups.path('phpunit')
+        with open(os.path.join(path, 'cpu.stat'), 'w') as f:
+            f.write('usage_usec 2500000\nuser_usec 2000000\n')
+        with open(os.path.join(path, 'memory.peak'), 'w') as f:
+            f.write('%s\n' % (512 * 1048576))
+        with open(os.path.join(path, 'io.stat'), 'w') as f:
+            f.write('8:0 rbytes=1048576 wbytes=2097152 rios=3 wios=4\n'
+                    '8:16 rbytes=1048576 wbytes=0 rios=1 wios=0\n')
+
+        self.assertEqual(
+            {'cpu': '2.5s', 'memory peak': '512.0 MiB',
+             'io read': '2.0 MiB', 'io written': '2.0 MiB'},
+            dict(self.cgroups.end('phpunit')))
+        self.assertEqual(str(os.getpid()), self.procs('main'))
+
+    def test_concurrent_stages_are_not_accounted(self):
+        self.cgroups.setup()
+        self.cgroups.begin('phpunit')
+
+        def concurrent():
+            with self.cgroups.enter('qunit'):
+                pass
+        with self.assertLogs('quibble.cgroup', level='WARNING'):
+            t = threading.Thread(target=concurrent)
+            t.start()
+            t.join()
+
+        self.assertEqual(str(os.getpid()), self.procs('main'))
+        self.assertEqual({}, self.cgroups.end('phpunit'))
+        self.assertEqual({}, self.cgroups.usage('qunit'))
+
+    def test_teardown(self):
+        self.cgroups.setup()
+        self.cgroups.teardown()
+        # Else Quibble could not move back to origin
+        self.assertEqual('-cpu -memory',
+                         self.read(self.origin, 'cgroup.subtree_control'))
+        with open(os.path.join(self.origin, 'cgroup.procs')) as f:
+            self.assertEqual(str(os.getpid()), f.read())
+        self.assertIsNone(self.cgroups.base)
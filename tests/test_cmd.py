@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 import os
+import subprocess
+import sys
+import tempfile
 import unittest
 from unittest import mock
 
 from quibble import cmd
+import quibble.relevance
 
 
 class CmdTest(unittest.TestCase):
@@ -206,3 +210,309 @@ class CmdTest(unittest.TestCase):
         q = cmd.QuibbleCmd()
         q.args = q.parse_arguments(args=[])
         self.assertEquals([], q.args.project_branch)
+
+    def test_should_run_skips_irrelevant_stages(self):
+        q = cmd.QuibbleCmd()
+        q.args = q.parse_arguments(args=[])
+        q.stage_rules = quibble.relevance.StageRules({
+            'phpunit': ['*.php'],
+            'qunit': ['*.js'],
+        })
+        q.changed_files = ['i18n/en.json', 'resources/foo.js']
+
+        self.assertFalse(q.should_run('phpunit'))
+        self.assertIn('*.php', q.skipped_stages['phpunit'])
+        self.assertTrue(q.should_run('qunit'))
+        self.assertTrue(q.should_run('selenium'), 'Stage without rules')
+        self.assertTrue(q.needs_install())
+
+    def test_install_not_needed_when_stages_are_irrelevant(self):
+        q = cmd.QuibbleCmd()
+        q.args = q.parse_arguments(args=[])
+        q.stage_rules = quibble.relevance.StageRules({
+            stage: ['*.php'] for stage in ['phpunit', 'qunit', 'selenium']
+        })
+        q.changed_files = ['i18n/en.json']
+        self.assertFalse(q.needs_install())
+
+    def test_should_run_without_stage_rules(self):
+        q = cmd.QuibbleCmd()
+        q.args = q.parse_arguments(args=[])
+        self.assertTrue(q.should_run('phpunit'))
+        self.assertTrue(q.needs_install())
+
+    def test_result_cache_is_opt_in(self):
+        q = cmd.QuibbleCmd()
+        q.args = q.parse_arguments(args=[])
+        q.setup_result_cache({'mediawiki/core': 'abc'})
+        self.assertIsNone(q.result_cache)
+
+        q.args = q.parse_arguments(
+            args=['--result-cache', '/cache', '--no-result-cache'])
+        q.setup_result_cache({'mediawiki/core': 'abc'})
+        self.assertIsNone(q.result_cache)
+
+    def test_run_stage_replays_cached_result(self):
+        q = cmd.QuibbleCmd()
+        q.log_dir = '/log'
+        q.result_cache = mock.Mock()
+        q.result_cache.replay.return_value = True
+        func = mock.Mock()
+
+        q.run_stage('phpunit db', func, {'db': 'mysql'})
+
+        func.assert_not_called()
+        q.result_cache.store.assert_not_called()
+        self.assertEqual('phpunit db', q.timings.records[0][0])
+
+    def test_run_stage_stores_result(self):
+        q = cmd.QuibbleCmd()
+        q.log_dir = '/log'
+        q.result_cache = mock.Mock()
+        q.result_cache.replay.return_value = False
+        func = mock.Mock()
+
+        q.run_stage('phpunit db', func, {'db': 'mysql'},
+                    artifacts=['junit-db.xml'])
+
+        func.assert_called_once_with()
+        q.result_cache.store.assert_called_once_with(
+            'phpunit db', {'db': 'mysql'}, artifacts=['/log/junit-db.xml'])
+
+    def test_run_stage_does_not_store_failures(self):
+        q = cmd.QuibbleCmd()
+        q.log_dir = '/log'
+        q.result_cache = mock.Mock()
+        q.result_cache.replay.return_value = False
+        func = mock.Mock(side_effect=Exception('failed'))
+
+        with self.assertRaises(Exception):
+            q.run_stage('phpunit db', func, {})
+        q.result_cache.store.assert_not_called()
+
+    def test_run_stage_store_failure_does_not_fail_the_stage(self):
+        q = cmd.QuibbleCmd()
+        q.log_dir = '/log'
+        q.result_cache = mock.Mock()
+        q.result_cache.replay.return_value = False
+        q.result_cache.store.side_effect = OSError('No space left on device')
+
+        with self.assertLogs('quibble.cmd', level='ERROR'):
+            q.run_stage('phpunit db', mock.Mock(), {})
+
+    def test_run_stage_without_config_is_not_cached(self):
+        q = cmd.QuibbleCmd()
+        q.result_cache = mock.Mock()
+        func = mock.Mock()
+
+        q.run_stage('extskin tests', func, None)
+
+        func.assert_called_once_with()
+        q.result_cache.replay.assert_not_called()
+        q.result_cache.store.assert_not_called()
+
+    def test_stage_config_depends_on_resolved_dependencies(self):
+        q = cmd.QuibbleCmd()
+        q.args = q.parse_arguments(args=[])
+        with tempfile.TemporaryDirectory() as mw_install_path:
+            q.mw_install_path = mw_install_path
+            config = q.stage_config()
+            os.makedirs(os.path.join(mw_install_path, 'node_modules'))
+            with open(os.path.join(mw_install_path,
+                                   'node_modules/.package-lock.json'),
+                      'w') as f:
+                f.write('{}')
+            self.assertNotEqual(config, q.stage_config())
+
+    def test_extskin_config_without_lock_is_not_cached(self):
+        q = cmd.QuibbleCmd()
+        q.args = q.parse_arguments(args=[])
+        with tempfile.TemporaryDirectory() as project_dir:
+            q.mw_install_path = project_dir
+            self.assertIsNotNone(q.extskin_config(project_dir, True, True))
+
+            with open(os.path.join(project_dir, 'package.json'), 'w') as f:
+                f.write('{}')
+            self.assertIsNotNone(q.extskin_config(project_dir, True, False))
+            with self.assertLogs('quibble.cmd'):
+                self.assertIsNone(q.extskin_config(project_dir, True, True))
+
+            with open(os.path.join(project_dir, 'package-lock.json'),
+                      'w') as f:
+                f.write('{}')
+            self.assertIsNotNone(q.extskin_config(project_dir, True, True))
+
+    def test_parallel_stages_run_phpunit_groups_concurrently(self):
+        q = cmd.QuibbleCmd()
+        q.args = q.parse_arguments(args=['--parallel-stages', '--run',
+                                         'phpunit'])
+        q.log_dir = '/log'
+        with mock.patch.object(q, 'run_phpunit_stage') as run_phpunit, \
+                mock.patch('quibble.test.thread_run') as thread_run:
+            q.run_stages_concurrently('mediawiki/extensions/Foo', 'ext')
+            (tasks, ), kwargs = thread_run.call_args
+            self.assertEqual(2, len(tasks))
+            for task in tasks:
+                task()
+        run_phpunit.assert_has_calls([
+            mock.call('dbless', 'ext', separate_log=True),
+            mock.call('db', 'ext', separate_log=True),
+        ])
+        self.assertEqual(0, q.args.parallel_stages)
+
+    @mock.patch('quibble.test.run_phpunit_databaseless')
+    def test_phpunit_progress_is_opt_in(self, run):
+        q = cmd.QuibbleCmd()
+        q.log_dir = '/log'
+        q.mw_install_path = '/src'
+        q.args = q.parse_arguments(args=[])
+        q.run_phpunit_stage('dbless', 'extensions')
+        self.assertIsNone(run.call_args[1]['progress'])
+
+        q.args = q.parse_arguments(args=['--phpunit-progress'])
+        q.run_phpunit_stage('dbless', 'extensions')
+        progress = run.call_args[1]['progress']
+        self.assertEqual('/log/phpunit-dbless-progress.json',
+                         progress.summary_file)
+        self.assertIsNone(progress.fail_fast)
+
+        # Implied
+        q.args = q.parse_arguments(args=['--fail-fast', '3'])
+        q.run_phpunit_stage('dbless', 'extensions')
+        progress = run.call_args[1]['progress']
+        self.assertEqual('/log/phpunit-dbless.teamcity.log',
+                         progress.teamcity_file)
+        self.assertEqual(3, progress.fail_fast)
+
+    def test_isolate_db_restores_the_checkpoint(self):
+        q = cmd.QuibbleCmd()
+        q.args = q.parse_arguments(args=['--isolate-db'])
+        db = mock.Mock()
+        q.backends.register('db', lambda: db)
+
+        q.restore_db()
+        db.restore.assert_not_called()
+
+        q.checkpoint_db()
+        q.restore_db()
+        db.checkpoint.assert_called_once_with()
+        db.restore.assert_called_once_with()
+
+    def test_isolate_db_is_ignored_with_parallel_stages(self):
+        q = cmd.QuibbleCmd()
+        q.args = q.parse_arguments(args=['--isolate-db', '--parallel-stages'])
+        db = mock.Mock()
+        q.backends.register('db', lambda: db)
+
+        q.checkpoint_db()
+        q.restore_db()
+        db.checkpoint.assert_not_called()
+        db.restore.assert_not_called()
+
+    @mock.patch('quibble.mediawiki.maintenance.rebuildLocalisationCache')
+    def test_install_rebuilds_localisation_cache(self, rebuild):
+        q = cmd.QuibbleCmd()
+        q.mw_install_path = '/src'
+        with mock.patch.object(q, 'mw_install') as mw_install, \
+                mock.patch.object(q, 'mw_update') as mw_update:
+            q.install()
+        mw_install.assert_called_once_with()
+        mw_update.assert_called_once_with()
+        rebuild.assert_called_once_with(lang=['en'], mwdir='/src')
+
+        rebuild.reset_mock()
+        q.engine_runs = [mock.Mock()]
+        with mock.patch.object(q, 'mw_install_engines') as install_engines:
+            q.install()
+        install_engines.assert_called_once_with()
+        rebuild.assert_called_once_with(lang=['en'], mwdir='/src')
+
+    def test_db_accepts_several_engines(self):
+        q = cmd.QuibbleCmd()
+        self.assertEqual(
+            'mysql,sqlite',
+            q.parse_arguments(args=['--db', 'mysql,sqlite']).db)
+        with self.assertRaises(SystemExit), \
+                mock.patch('sys.stderr'):
+            q.parse_arguments(args=['--db', 'mysql,oracle'])
+
+    def test_engine_runs_have_their_own_backends_and_files(self):
+        q = cmd.QuibbleCmd()
+        q.args = q.parse_arguments(args=['--db', 'mysql,sqlite'])
+        q.log_dir = '/log'
+        q.mw_install_path = '/src'
+        q.resources = mock.Mock()
+        q.resources.port.side_effect = [9413, 9414]
+        q.setup_engine_runs()
+        q.register_backends()
+
+        (mysql, sqlite) = q.engine_runs
+        self.assertEqual(('sqlite', 9414), (sqlite.args.db, sqlite.http_port))
+        self.assertEqual('mysql,sqlite', q.args.db)
+        self.assertEqual(('sqlite', None, None, None),
+                         q.backends.key('db-sqlite'))
+        self.assertEqual('mysql', q.backends.key('web-mysql')[-1])
+        with self.assertRaisesRegex(Exception, 'No backend registered'):
+            q.backends.get('db')
+        self.assertEqual({'QUIBBLE_DB': 'sqlite'}, sqlite.engine_env())
+
+        with mock.patch.object(sqlite, 'run_stage') as run_stage:
+            sqlite.run_phpunit_stage('db', None, separate_log=True)
+        (name, _, _), kwargs = run_stage.call_args
+        self.assertEqual('phpunit db-sqlite', name)
+        self.assertEqual(['junit-db-sqlite.xml'], kwargs['artifacts'])
+
+    def test_engine_runs_share_stage_rules_and_result_cache(self):
+        q = cmd.QuibbleCmd()
+        q.args = q.parse_arguments(args=['--db', 'mysql,sqlite'])
+        q.resources = mock.Mock()
+        q.stage_rules = quibble.relevance.StageRules({
+            stage: ['*.php'] for stage in ['phpunit', 'qunit', 'selenium']
+        })
+        q.changed_files = ['i18n/en.json']
+        q.result_cache = mock.Mock()
+        q.setup_engine_runs()
+
+        self.assertFalse(q.needs_install())
+        for run in q.engine_runs:
+            self.assertFalse(run.should_run('phpunit'))
+            self.assertIs(q.result_cache, run.result_cache)
+
+
+class CmdStartupTest(unittest.TestCase):
+
+    # Only needed once a stage runs
+    HEAVY_MODULES = ['git', 'yaml', 'pkg_resources', 'multiprocessing',
+                     'urllib.request', 'xml.etree.ElementTree', 'zuul']
+
+    def python(self, *args):
+        return subprocess.run(
+            [sys.executable] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+
+    def test_arg_parser_does_not_import_heavy_modules(self):
+        out = self.python('-c', (
+            'import sys\n'
+            'import quibble.cmd\n'
+            'quibble.cmd.QuibbleCmd().get_arg_parser()\n'
+            'print("\\n".join(sys.modules))\n')).stdout
+        loaded = set(out.splitlines())
+        self.assertEqual(
+            [], [m for m in self.HEAVY_MODULES if m in loaded])
+
+    @unittest.skipUnless(os.environ.get('QUIBBLE_IMPORT_BUDGET'),
+                         'QUIBBLE_IMPORT_BUDGET is not set')
+    def test_import_time_budget(self):
+        # Microseconds, depends on the host. Without lazy imports it was
+        # above 200ms.
+        budget = int(os.environ['QUIBBLE_IMPORT_BUDGET'])
+        stderr = self.python('-X', 'importtime', '-c',
+                             'import quibble.cmd').stderr
+        for line in stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = [f.strip() for f in line.split('|')]
+            if fields[-1] == 'quibble.cmd':
+                self.assertLess(int(fields[1]), budget)
+                return
+        self.fail('quibble.cmd import time not found:\n%s' % stderr)
@@ -0,0 +1,85 @@
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from quibble import gitchangedinhead
+from quibble.gitchangedinhead import ChangedFile
+from quibble.gitchangedinhead import GitChangedInHead
+
+
+class TestGitChangedInHead(unittest.TestCase):
+
+    def git(self, *args):
+        return subprocess.check_output(
+            ['git', '-c', 'user.name=Quibble',
+             '-c', 'user.email=q@example.org'] + list(args),
+            cwd=self.repo).decode().strip()
+
+    def write(self, path, content):
+        os.makedirs(os.path.join(self.repo, os.path.dirname(path)),
+                    exist_ok=True)
+        with open(os.path.join(self.repo, path), 'w') as f:
+            f.write(content)
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.addCleanup(gitchangedinhead.clear_cache)
+        self.repo = tmpdir.name
+
+        self.git('init', '-q')
+        self.write('renamed.txt', 'rename me\n')
+        self.write('modified.php', '<?php\n')
+        self.git('add', '.')
+        self.git('commit', '-q', '-m', 'initial')
+
+        self.git('mv', 'renamed.txt', 'moved.txt')
+        self.write('modified.php', '<?php // changed\n')
+        self.write('includes/added.php', '<?php\n')
+        self.write('resources/added.js', '\n')
+        self.git('add', '.')
+        self.git('commit', '-q', '-m', 'change')
+
+    def test_changed_files_with_renames(self):
+        self.assertEqual(sorted([
+            ChangedFile('A', 'includes/added.php'),
+            ChangedFile('M', 'modified.php'),
+            ChangedFile('R', 'moved.txt', old_path='renamed.txt'),
+            ChangedFile('A', 'resources/added.js'),
+        ], key=repr), sorted(
+            gitchangedinhead.changed_files(self.repo), key=repr))
+
+    def test_filters(self):
+        self.assertEqual(
+            ['includes/added.php', 'modified.php', 'resources/added.js'],
+            sorted(GitChangedInHead([], cwd=self.repo).changedFiles()))
+        self.assertEqual(
+            ['includes/added.php', 'modified.php'],
+            sorted(GitChangedInHead(['php'], cwd=self.repo).changedFiles()))
+
+    def test_git_runs_once_per_commit(self):
+        with mock.patch('quibble.gitchangedinhead.subprocess.check_output',
+                        wraps=subprocess.check_output) as git:
+            GitChangedInHead([], cwd=self.repo).changedFiles()
+            GitChangedInHead(['php'], cwd=self.repo).changedFiles()
+            self.assertEqual(1, git.call_count)
+
+        self.git('commit', '-q', '--allow-empty', '-m', 'empty')
+        with mock.patch('quibble.gitchangedinhead.subprocess.check_output',
+                        wraps=subprocess.check_output) as git:
+            self.assertEqual(
+                [], GitChangedInHead([], cwd=self.repo).changedFiles())
+            self.assertEqual(1, git.call_count)
+
+    def test_head_commit(self):
+        self.assertEqual(self.git('rev-parse', 'HEAD'),
+                         gitchangedinhead.head_commit(self.repo))
+        self.git('checkout', '-q', '--detach')
+        self.assertEqual(self.git('rev-parse', 'HEAD'),
+                         gitchangedinhead.head_commit(self.repo))
+        self.git('pack-refs', '--all')
+        self.git('checkout', '-q', '-')
+        self.assertEqual(self.git('rev-parse', 'HEAD'),
+                         gitchangedinhead.head_commit(self.repo))
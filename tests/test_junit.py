@@ -0,0 +1,88 @@
+import json
+import os
+import tempfile
+import unittest
+
+from quibble import junit
+
+JUNIT = """<?xml version="1.0" encoding="UTF-8"?>
+<testsuites>
+  <testsuite name="extensions" tests="5" time="6.6">
+    <testsuite name="FooTest" file="FooTest.php" tests="4" time="6.1">
+      <testcase name="testFast" class="FooTest" time="0.100"/>
+      <testsuite name="FooTest::testProvided" tests="3" time="6.0">
+        <testcase name="testProvided with data set #0" class="FooTest"
+                  time="1.000"/>
+        <testcase name="testProvided with data set #1" class="FooTest"
+                  time="2.000"/>
+        <testcase name="testProvided with data set &quot;big&quot;"
+                  class="FooTest" time="3.000">
+          <failure type="Error">boom</failure>
+        </testcase>
+      </testsuite>
+    </testsuite>
+    <testsuite name="BarTest" file="BarTest.php" tests="1" time="0.5">
+      <testcase name="testBar" class="BarTest" time="0.500"/>
+    </testsuite>
+  </testsuite>
+</testsuites>
+"""
+
+
+class TestJunit(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+        self.junit_file = os.path.join(self._tmpdir.name, 'junit.xml')
+        with open(self.junit_file, 'w') as f:
+            f.write(JUNIT)
+
+    def test_testcases(self):
+        cases = list(junit.testcases(self.junit_file))
+        self.assertEqual(5, len(cases))
+        self.assertEqual(('FooTest', 'testFast', 0.1), cases[0])
+
+    def test_report(self):
+        slow = junit.SlowTests(top=2)
+        slow.add_file(self.junit_file)
+        report = slow.report()
+
+        self.assertEqual(
+            ['FooTest::testProvided with data set "big"',
+             'FooTest::testProvided with data set #1'],
+            [t['name'] for t in report['tests']])
+        self.assertEqual(
+            [{'name': 'FooTest', 'time': 6.1},
+             {'name': 'BarTest', 'time': 0.5}],
+            report['classes'])
+        self.assertEqual(
+            [{'name': 'FooTest::testProvided', 'time': 6.0}],
+            report['providers'])
+
+    def test_regressions(self):
+        report = {'classes': [{'name': 'FooTest', 'time': 6.1},
+                              {'name': 'BarTest', 'time': 0.5}]}
+        baseline = {'classes': [{'name': 'FooTest', 'time': 4.0},
+                                {'name': 'BarTest', 'time': 0.1}]}
+        self.assertEqual(
+            [{'kind': 'classes', 'name': 'FooTest', 'time': 6.1,
+              'baseline': 4.0}],
+            junit.regressions(report, baseline, threshold=0.2),
+            'BarTest difference is under min_delta')
+        self.assertEqual([], junit.regressions(report, baseline,
+                                               threshold=0.6))
+
+    def test_slow_tests_writes_report_with_regressions(self):
+        output = os.path.join(self._tmpdir.name, 'slow.json')
+        baseline = os.path.join(self._tmpdir.name, 'baseline.json')
+        with open(baseline, 'w') as f:
+            json.dump({'providers': [
+                {'name': 'FooTest::testProvided', 'time': 1.0}]}, f)
+
+        junit.slow_tests([self.junit_file], output, baseline=baseline)
+
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual(['FooTest::testProvided'],
+                         [r['name'] for r in report['regressions']])
@@ -0,0 +1,101 @@
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from quibble.mediawiki import localsettings
+
+
+class TestLocalSettings(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+        self.tmpdir = self._tmpdir.name
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_shipped_snippets(self):
+        content = localsettings.snippets()
+        self.assertTrue(content.startswith('<?php'))
+        self.assertTrue(content.endswith('\n?>'))
+        self.assertIn('wgWikimediaJenkinsCI', content)
+
+    def test_snippets_are_sorted_and_sanitized(self):
+        self.write('20_b.php', '<?php $b = 2;')
+        self.write('10_a.php', '<?php $a = 1;')
+        self.write('30_no_open_tag.php', '$c = 3;')
+        self.write('40_close_tag.php', '<?php $d = 4; ?>')
+        self.write('50_string.php', "<?php $f = '?>';")
+        self.write('_ignored.php', '<?php $e = 5;')
+
+        self.assertEqual(
+            "<?php $a = 1;\n?><?php $b = 2;\n?><?php $f = '?>';\n?>",
+            localsettings.snippets(self.tmpdir))
+
+    def test_has_close_tag(self):
+        for source in [
+            '<?php $a = 1; ?>',
+            '<?php $a = 1; // comment ?> text',
+            '<?php $a = 1; # comment ?> text',
+            "<?php $a = <<<EOT\nfoo\nEOT;\n?>",
+        ]:
+            self.assertTrue(localsettings.has_close_tag(source), source)
+
+    def test_has_no_close_tag(self):
+        for source in [
+            '<?php $a = 1;',
+            "<?php $a = '?>';",
+            '<?php $a = "\\"?>";',
+            '<?php /* ?> */ $a = 1;',
+            '<?php $a = $b?->c;',
+            "<?php $a = <<<EOT\n?>\nEOT;\n",
+            "<?php $a = <<<'EOT'\n  ?>\n  EOT;\n",
+        ]:
+            self.assertFalse(localsettings.has_close_tag(source), source)
+
+    @mock.patch('quibble.mediawiki.localsettings.subprocess.run')
+    def test_lint_once_per_content(self, mock_run):
+        mock_run.return_value = subprocess.CompletedProcess(
+            args=[], returncode=0, stdout=b'')
+        localsettings.lint('<?php $a = 1;', cache_dir=self.tmpdir)
+        localsettings.lint('<?php $a = 1;', cache_dir=self.tmpdir)
+        self.assertEqual(1, mock_run.call_count)
+
+        localsettings.lint('<?php $a = 2;', cache_dir=self.tmpdir)
+        self.assertEqual(2, mock_run.call_count)
+
+    @mock.patch('quibble.mediawiki.localsettings.subprocess.run')
+    def test_lint_failure_is_not_remembered(self, mock_run):
+        mock_run.return_value = subprocess.CompletedProcess(
+            args=[], returncode=255, stdout=b'Parse error')
+        with self.assertRaisesRegex(Exception, 'Parse error'):
+            localsettings.lint('<?php $a =', cache_dir=self.tmpdir)
+        with self.assertRaises(Exception):
+            localsettings.lint('<?php $a =', cache_dir=self.tmpdir)
+        self.assertEqual(2, mock_run.call_count)
+
+    def test_prepend(self):
+        path = self.write('LocalSettings.php', '<?php $wgSitename = "x";\n')
+        os.chmod(path, 0o640)
+        localsettings.prepend(path, '<?php $a = 1;\n?>')
+
+        with open(path) as f:
+            self.assertEqual(
+                '<?php $a = 1;\n?><?php $wgSitename = "x";\n', f.read())
+        self.assertEqual(0o640, os.stat(path).st_mode & 0o777)
+        self.assertEqual(['LocalSettings.php'], os.listdir(self.tmpdir))
+
+    def test_write_dispatcher(self):
+        path = os.path.join(self.tmpdir, 'LocalSettings.php')
+        localsettings.write_dispatcher(path, ['sqlite', 'mysql'])
+        with open(path) as f:
+            content = f.read()
+        self.assertIn("getenv( 'QUIBBLE_DB' ) ?: 'sqlite';", content)
+        self.assertIn("[ 'sqlite', 'mysql' ]", content)
+        self.assertIn('"/LocalSettings-$quibbleDb.php"', content)
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from quibble.opcache import OpcacheFileCache
+from quibble.opcache import php_ini_scan_dir
+
+
+class TestOpcacheFileCache(unittest.TestCase):
+
+    @mock.patch('quibble.opcache.subprocess.check_output')
+    def test_php_ini_scan_dir(self, mock_check_output):
+        mock_check_output.return_value = (
+            b'Configuration File (php.ini) Path: /etc/php/7.0/cli\n'
+            b'Scan for additional .ini files in: /etc/php/7.0/cli/conf.d\n')
+        self.assertEqual('/etc/php/7.0/cli/conf.d', php_ini_scan_dir())
+
+    @mock.patch('quibble.opcache.subprocess.check_output')
+    def test_php_ini_scan_dir_none(self, mock_check_output):
+        mock_check_output.return_value = (
+            b'Scan for additional .ini files in: (none)\n')
+        self.assertIsNone(php_ini_scan_dir())
+
+    def test_keyed_cache_dir(self):
+        opcache = OpcacheFileCache(base_dir='/cache', key='abc')
+        self.assertEqual('/cache/abc/files', opcache.file_cache)
+
+    @mock.patch('quibble.opcache.php_ini_scan_dir',
+                return_value='/etc/php/conf.d')
+    def test_setup_keeps_default_scan_dir(self, _):
+        with tempfile.TemporaryDirectory() as base_dir:
+            opcache = OpcacheFileCache(base_dir=base_dir, key='k')
+            env = {}
+            opcache.setup(env=env)
+
+            self.assertEqual(
+                '/etc/php/conf.d%s%s' % (os.pathsep, opcache.ini_dir),
+                env['PHP_INI_SCAN_DIR'])
+            with open(os.path.join(opcache.ini_dir,
+                                   'quibble-opcache.ini')) as f:
+                ini = f.read()
+            self.assertIn('opcache.enable_cli=1', ini)
+            self.assertIn('opcache.file_cache=%s' % opcache.file_cache, ini)
+
+    def test_collector_reports_compiled_scripts(self):
+        opcache = OpcacheFileCache()
+        os.makedirs(os.path.join(opcache.file_cache, 'some', 'dir'))
+        opcache.begin('stage')
+        for name in ['a.php.bin', 'b.php.bin']:
+            open(os.path.join(opcache.file_cache, 'some', 'dir', name),
+                 'w').close()
+        self.assertEqual({'opcache compiled': 2, 'opcache cached': 2},
+                         opcache.end('stage'))
@@ -0,0 +1,99 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from quibble import progress as qprogress
+from quibble.progress import parse_teamcity
+
+TEAMCITY_LOG = """
+##teamcity[testSuiteStarted name='FooTest']
+##teamcity[testStarted name='testPass' locationHint='php_qn://FooTest.php']
+##teamcity[testFinished name='testPass' duration='12']
+##teamcity[testStarted name='testSlow']
+##teamcity[testFinished name='testSlow' duration='2500']
+##teamcity[testStarted name='testFail']
+##teamcity[testFailed name='testFail' message='Failed asserting |'a|' is b']
+##teamcity[testFinished name='testFail' duration='3']
+##teamcity[testStarted name='testSkip']
+##teamcity[testIgnored name='testSkip' message='Requires mysql']
+##teamcity[testFinished name='testSkip' duration='0']
+"""
+
+
+class TestTeamCity(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(
+            ('testFailed', {'name': 'a', 'message': "'x'\n[y]|"}),
+            parse_teamcity(
+                "##teamcity[testFailed name='a' message='|'x|'|n|[y|]||']"))
+
+    def test_parse_ignores_other_output(self):
+        self.assertIsNone(parse_teamcity('PHPUnit 6.5.8 by Sebastian'))
+
+
+class TestTestProgress(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+        self.teamcity_file = os.path.join(self._tmpdir.name, 'tc.log')
+        self.summary_file = os.path.join(self._tmpdir.name, 'summary.json')
+
+    def progress(self, **kwargs):
+        return qprogress.TestProgress('phpunit', self.teamcity_file,
+                                      self.summary_file, interval=0.05,
+                                      **kwargs)
+
+    def fake_phpunit(self, script):
+        return subprocess.Popen([sys.executable, '-c', script])
+
+    def test_counts(self):
+        progress = self.progress()
+        for line in TEAMCITY_LOG.splitlines():
+            progress.feed(line)
+        self.assertEqual(
+            {'passed': 2, 'failed': 1, 'skipped': 1, 'slow': 1},
+            progress.counts)
+        self.assertEqual(
+            [{'name': 'testFail', 'message': "Failed asserting 'a' is b"}],
+            progress.failures)
+
+    def test_follow_writes_summary(self):
+        progress = self.progress()
+        progress.start()
+        proc = self.fake_phpunit(
+            'import sys, time\n'
+            'f = open(%r, "w")\n'
+            'for line in %r.splitlines():\n'
+            '    f.write(line + "\\n"); f.flush(); time.sleep(0.01)\n'
+            'sys.exit(1)\n' % (self.teamcity_file, TEAMCITY_LOG))
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            progress.follow(proc)
+
+        with open(self.summary_file) as f:
+            summary = json.load(f)
+        self.assertEqual('failed', summary['status'])
+        self.assertEqual(1, summary['counts']['failed'])
+        self.assertEqual(2, summary['counts']['passed'])
+
+    def test_fail_fast_aborts_the_run(self):
+        progress = self.progress(fail_fast=1)
+        progress.start()
+        proc = self.fake_phpunit(
+            'import time\n'
+            'f = open(%r, "w")\n'
+            'f.write("##teamcity[testStarted name=\'a\']\\n"\n'
+            '        "##teamcity[testFailed name=\'a\' message=\'x\']\\n")\n'
+            'f.flush()\n'
+            'time.sleep(30)\n' % self.teamcity_file)
+
+        with self.assertRaisesRegex(Exception, 'aborted after 1 failures'):
+            progress.follow(proc)
+        self.assertIsNotNone(proc.returncode)
+        with open(self.summary_file) as f:
+            self.assertEqual('aborted', json.load(f)['status'])
@@ -52,3 +52,20 @@ class QuibbleTest(unittest.TestCase):
     def test_chrome_does_not_throttle_history_state_changes(self):
         self.assertIn('--disable-pushstate-throttle',
                       quibble.chromium_flags())
+
+    @mock.patch('subprocess.check_output',
+                return_value=b'Chromium 68.0.3440.75 built on Debian 9.5')
+    def test_chromium_supports_headless(self, _):
+        quibble.chromium_supports_headless.cache_clear()
+        self.assertTrue(quibble.chromium_supports_headless())
+
+    @mock.patch('subprocess.check_output',
+                return_value=b'Chromium 57.0.2987.98 built on Debian 8.7')
+    def test_old_chromium_does_not_support_headless(self, _):
+        quibble.chromium_supports_headless.cache_clear()
+        self.assertFalse(quibble.chromium_supports_headless())
+
+    @mock.patch('subprocess.check_output', side_effect=FileNotFoundError)
+    def test_missing_chromium_does_not_support_headless(self, _):
+        quibble.chromium_supports_headless.cache_clear()
+        self.assertFalse(quibble.chromium_supports_headless())
@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+
+from quibble.relevance import StageRules
+
+
+class TestStageRules(unittest.TestCase):
+
+    def test_stage_without_rules_is_never_skipped(self):
+        rules = StageRules({'phpunit': ['*.php']})
+        self.assertIsNone(rules.skip_reason('qunit', ['foo.php']))
+
+    def test_skip_when_no_changed_file_matches(self):
+        rules = StageRules({'phpunit': ['*.php', 'composer.json']})
+        self.assertEqual(
+            'no changed file matches *.php, composer.json',
+            rules.skip_reason('phpunit', ['i18n/en.json', 'modules/a.js']))
+        self.assertIsNone(rules.skip_reason(
+            'phpunit', ['i18n/en.json', 'includes/Foo.php']))
+
+    def test_never_skip_without_changed_files(self):
+        rules = StageRules({'phpunit': ['*.php']})
+        self.assertIsNone(rules.skip_reason('phpunit', []))
+
+    def test_for_project(self):
+        with tempfile.TemporaryDirectory() as project_dir:
+            self.assertIsNone(StageRules.for_project(project_dir))
+
+            with open(os.path.join(project_dir, '.quibble.yaml'), 'w') as f:
+                f.write("stages:\n  phpunit: ['*.php']\n")
+            rules = StageRules.for_project(project_dir)
+            self.assertEqual({'phpunit': ['*.php']}, rules.rules)
+
+    def test_invalid_rules(self):
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.yaml') as f:
+            f.write("stages: ['*.php']\n")
+            f.flush()
+            with self.assertRaisesRegex(Exception, 'must map stages'):
+                StageRules.load(f.name)
@@ -0,0 +1,79 @@
+import os
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+from quibble.resources import ResourceAllocator
+
+
+class TestResourceAllocator(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.runtime_dir = tmpdir.name
+
+    def test_port_is_claimed_once(self):
+        with ResourceAllocator(runtime_dir=self.runtime_dir) as one, \
+                ResourceAllocator(runtime_dir=self.runtime_dir) as two:
+            port = one.port(20000)
+            self.assertNotEqual(port, two.port(20000))
+
+    def test_port_released(self):
+        one = ResourceAllocator(runtime_dir=self.runtime_dir)
+        port = one.port(20100)
+        one.release()
+        with ResourceAllocator(runtime_dir=self.runtime_dir) as two:
+            self.assertEqual(port, two.port(20100))
+
+    def test_lock_file_of_another_user(self):
+        # Created with the umask of another user
+        path = os.path.join(self.runtime_dir, 'port-20300.lock')
+        open(path, 'w').close()
+        os.chmod(path, 0o444)
+        with ResourceAllocator(runtime_dir=self.runtime_dir) as alloc:
+            self.assertEqual(20300, alloc.port(20300))
+
+    def test_unreadable_lock_file_is_claimed(self):
+        real_open = os.open
+
+        def unreadable(path, *args):
+            if path.endswith('port-20400.lock'):
+                raise PermissionError(path)
+            return real_open(path, *args)
+
+        with ResourceAllocator(runtime_dir=self.runtime_dir) as alloc, \
+                mock.patch('os.open', side_effect=unreadable):
+            self.assertEqual(20401, alloc.port(20400))
+
+    def test_skips_port_in_use(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            s.listen()
+            busy = s.getsockname()[1]
+            with ResourceAllocator(runtime_dir=self.runtime_dir) as alloc:
+                self.assertNotEqual(busy, alloc.port(busy))
+
+    def test_no_free_port(self):
+        with ResourceAllocator(runtime_dir=self.runtime_dir,
+                               attempts=1) as alloc:
+            with mock.patch('quibble.resources.port_is_free',
+                            return_value=False):
+                with self.assertRaisesRegex(Exception, 'No free TCP port'):
+                    alloc.port(20200)
+
+    @mock.patch('quibble.resources.display_is_free',
+                side_effect=lambda number: number != 94)
+    def test_display_skips_used_display(self, _):
+        with ResourceAllocator(runtime_dir=self.runtime_dir) as one, \
+                ResourceAllocator(runtime_dir=self.runtime_dir) as two:
+            self.assertEqual(':95', one.display())
+            self.assertEqual(':96', two.display())
+
+    @mock.patch('quibble.resources.display_is_free', return_value=True)
+    def test_free_display(self, _):
+        with ResourceAllocator(runtime_dir=self.runtime_dir) as one, \
+                ResourceAllocator(runtime_dir=self.runtime_dir) as two:
+            one.free_display(one.display())
+            self.assertEqual(':94', two.display())
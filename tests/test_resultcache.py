@@ -0,0 +1,125 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from quibble.resultcache import ResultCache
+
+
+@mock.patch('quibble.resultcache.tool_versions',
+            return_value={'php': 'PHP 7.0.30'})
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+        self.cache_dir = os.path.join(self._tmpdir.name, 'cache')
+        self.log_dir = os.path.join(self._tmpdir.name, 'log')
+        os.mkdir(self.log_dir)
+
+    def artifact(self, name, content):
+        path = os.path.join(self.log_dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_key_depends_on_trees_stage_config_and_tools(self, tools):
+        cache = ResultCache(self.cache_dir, {'mediawiki/core': 'abc'})
+        key = cache.key('phpunit', {'db': 'mysql'})
+
+        self.assertEqual(key, cache.key('phpunit', {'db': 'mysql'}))
+        self.assertNotEqual(key, cache.key('phpunit', {'db': 'sqlite'}))
+        self.assertNotEqual(key, cache.key('core tests', {'db': 'mysql'}))
+        self.assertNotEqual(key, ResultCache(
+            self.cache_dir, {'mediawiki/core': 'def'}).key(
+                'phpunit', {'db': 'mysql'}))
+        tools.return_value = {'php': 'PHP 7.2.10'}
+        self.assertNotEqual(key, cache.key('phpunit', {'db': 'mysql'}))
+
+    def test_key_depends_on_quibble(self, _):
+        cache = ResultCache(self.cache_dir, {'mediawiki/core': 'abc'})
+        key = cache.key('phpunit', {})
+        with mock.patch('quibble.resultcache.quibble_digest',
+                        return_value='upgraded'):
+            self.assertNotEqual(key, cache.key('phpunit', {}))
+
+    def test_quibble_digest_covers_settings(self, _):
+        from quibble import resultcache
+        self.assertEqual(64, len(resultcache.quibble_digest()))
+        resultcache.quibble_digest.cache_clear()
+        real_open = open
+        read = []
+
+        def recording_open(path, *args, **kwargs):
+            read.append(path)
+            return real_open(path, *args, **kwargs)
+        with mock.patch('builtins.open', side_effect=recording_open):
+            resultcache.quibble_digest()
+        resultcache.quibble_digest.cache_clear()
+        self.assertTrue(any('mediawiki.d' in p for p in read))
+        self.assertTrue(any(p.endswith('test.py') for p in read))
+
+    def test_replay_without_result(self, _):
+        cache = ResultCache(self.cache_dir, {})
+        self.assertFalse(cache.replay('phpunit', {}, self.log_dir))
+
+    def test_store_and_replay_artifacts(self, _):
+        cache = ResultCache(self.cache_dir, {'mediawiki/core': 'abc'})
+        junit = self.artifact('junit.xml', '<testsuites/>')
+        cache.store('phpunit', {}, artifacts=[junit])
+        os.unlink(junit)
+
+        self.assertTrue(cache.replay('phpunit', {}, self.log_dir))
+        with open(junit) as f:
+            self.assertEqual('<testsuites/>', f.read())
+
+    def test_store_existing_result(self, _):
+        cache = ResultCache(self.cache_dir, {'mediawiki/core': 'abc'})
+        cache.store('phpunit', {})
+        entry = cache._entry('phpunit', {})
+        created = os.stat(os.path.join(entry, 'result.json')).st_mtime_ns
+
+        # Stored by a concurrent run
+        cache.store('phpunit', {})
+        self.assertEqual(created, os.stat(
+            os.path.join(entry, 'result.json')).st_mtime_ns)
+        self.assertEqual([os.path.basename(entry)],
+                         os.listdir(self.cache_dir))
+
+    def test_store_race(self, _):
+        cache = ResultCache(self.cache_dir, {})
+        entry = cache._entry('phpunit', {})
+
+        def rename(src, dst):
+            os.makedirs(dst)
+            raise OSError('Directory not empty')
+        with mock.patch('os.rename', side_effect=rename):
+            cache.store('phpunit', {})
+        self.assertEqual([os.path.basename(entry)],
+                         os.listdir(self.cache_dir))
+
+    def test_expired_results_are_not_replayed(self, _):
+        cache = ResultCache(self.cache_dir, {}, ttl=60)
+        cache.store('phpunit', {})
+        result = os.path.join(cache._entry('phpunit', {}), 'result.json')
+        with open(result) as f:
+            meta = json.load(f)
+        meta['created'] = time.time() - 120
+        with open(result, 'w') as f:
+            json.dump(meta, f)
+
+        self.assertFalse(cache.replay('phpunit', {}, self.log_dir))
+        cache.evict()
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_evicts_least_recently_used(self, _):
+        cache = ResultCache(self.cache_dir, {}, max_size=1500)
+        cache.store('old', {}, artifacts=[self.artifact('a', 'x' * 1000)])
+        old = cache._entry('old', {})
+        os.utime(old, (0, 0))
+        cache.store('new', {}, artifacts=[self.artifact('b', 'x' * 1000)])
+
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(cache._entry('new', {})))
@@ -1,3 +1,6 @@
+import os
+import tempfile
+import threading
 import unittest
 from unittest import mock
 from subprocess import CalledProcessError
@@ -38,6 +41,8 @@ class TestTestCommand(unittest.TestCase):
             'run_phpunit_databaseless': {'mwdir': '/tmp'},
             'run_qunit': {'mwdir': '/tmp'},
             'run_webdriver': {'mwdir': '/tmp', 'display': ':0'},
+            'run_webdriver_parallel': {
+                'mwdir': '/tmp', 'drivers': [], 'log_dir': '/tmp'},
         }
         run_cmds = [
             func for name, func in sorted(quibble.test.__dict__.items())
@@ -69,3 +74,65 @@ class TestTestCommand(unittest.TestCase):
 
     def test_parallel_run_accepts_an_empty_list_of_tasks(self):
         self.assertEqual(True, quibble.test.parallel_run([]))
+
+    @mock.patch.dict('os.environ', {'DISPLAY': ':0'}, clear=True)
+    @mock.patch('subprocess.check_call')
+    def test_run_webdriver_headless_unsets_display(self, mock_check_call):
+        quibble.test.run_webdriver(mwdir='/tmp', display=None)
+
+        (args, kwargs) = mock_check_call.call_args
+        self.assertNotIn('DISPLAY', kwargs['env'])
+
+    def test_distribute_balances_weight(self):
+        weights = {'a': 5, 'b': 3, 'c': 2, 'd': 1}
+        self.assertEqual(
+            [['a', 'd'], ['b', 'c']],
+            quibble.test.distribute(weights, 2, weight=weights.get))
+
+    def test_distribute_drops_empty_buckets(self):
+        self.assertEqual([['a']], quibble.test.distribute(['a'], 3))
+
+    @mock.patch('quibble.test.selenium_specs',
+                return_value=['a.js', 'b.js'])
+    @mock.patch('quibble.test.os.path.getsize', return_value=1)
+    @mock.patch('subprocess.Popen')
+    def test_run_webdriver_parallel(self, mock_popen, *_):
+        mock_popen.return_value.returncode = 0
+        drivers = [mock.Mock(port=4001, display=':1'),
+                   mock.Mock(port=4002, display=':2')]
+        with tempfile.TemporaryDirectory() as log_dir:
+            quibble.test.run_webdriver_parallel(
+                mwdir='/tmp', drivers=drivers, log_dir=log_dir)
+
+            self.assertEqual(2, mock_popen.call_count)
+            for (i, call) in enumerate(mock_popen.call_args_list):
+                (args, kwargs) = call
+                self.assertIn('--port', args[0])
+                self.assertEqual(str(drivers[i].port),
+                                 args[0][args[0].index('--port') + 1])
+                self.assertEqual(
+                    os.path.join(log_dir, 'selenium-%s' % i),
+                    kwargs['env']['LOG_DIR'])
+
+    def test_thread_run_runs_tasks_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        # Each task waits for the other one, deadlocks if run serially
+        quibble.test.thread_run([barrier.wait, barrier.wait], workers=2)
+
+    def test_thread_run_raises_after_all_tasks_are_done(self):
+        done = mock.Mock()
+        with self.assertRaises(CalledProcessError):
+            quibble.test.thread_run([
+                mock.Mock(side_effect=CalledProcessError(1, 'phpunit')),
+                done,
+            ], workers=1)
+        done.assert_called_once_with()
+
+    @mock.patch('subprocess.check_call')
+    def test_run_phpunit_writes_to_log_file(self, mock_check_call):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_file = os.path.join(log_dir, 'phpunit-db.log')
+            quibble.test.run_phpunit_database(mwdir='/tmp',
+                                              log_file=log_file)
+            (_, kwargs) = mock_check_call.call_args
+            self.assertEqual(log_file, kwargs['stdout'].name)
@@ -0,0 +1,38 @@
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+from quibble.timing import Timings
+
+
+class TestTimings(unittest.TestCase):
+
+    def test_records_stage_even_on_failure(self):
+        timings = Timings()
+        with self.assertRaises(ValueError):
+            with timings.stage('failing'):
+                raise ValueError()
+        self.assertEqual(['failing'], [r[0] for r in timings.records])
+
+    def test_collectors_values_are_recorded(self):
+        collector = mock.Mock()
+        collector.end.return_value = {'answer': 42}
+        timings = Timings()
+        timings.collectors.append(collector)
+
+        with timings.stage('stage'):
+            collector.begin.assert_called_once_with('stage')
+
+        (name, duration, extra) = timings.records[0]
+        self.assertEqual({'answer': 42}, extra)
+
+    def test_dump(self):
+        timings = Timings()
+        with timings.stage('one'):
+            pass
+        with tempfile.NamedTemporaryFile(mode='r') as f:
+            timings.dump(f.name)
+            dumped = json.load(f)
+        self.assertEqual('one', dumped[0]['stage'])
+        self.assertIn('duration', dumped[0])
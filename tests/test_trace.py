@@ -0,0 +1,85 @@
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from quibble import trace
+from quibble.timing import Timings
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_stages_are_spans(self):
+        tracer = trace.Tracer()
+        timings = Timings()
+        timings.collectors.append(tracer)
+
+        with timings.stage('install'):
+            pass
+
+        (install,) = tracer.events
+        self.assertEqual('install', install['name'])
+        self.assertEqual('stage', install['cat'])
+        self.assertEqual('X', install['ph'])
+        self.assertGreaterEqual(install['dur'], 0)
+        self.assertEqual(threading.get_ident(), install['tid'])
+
+    def test_concurrent_stages_of_the_same_name(self):
+        tracer = trace.Tracer()
+        tracer.begin('phpunit')
+        t = threading.Thread(target=lambda: (tracer.begin('phpunit'),
+                                             tracer.end('phpunit')))
+        t.start()
+        t.join()
+        tracer.end('phpunit')
+        self.assertEqual(2, len(tracer.events))
+        self.assertNotEqual(tracer.events[0]['tid'], tracer.events[1]['tid'])
+
+    def test_span_args(self):
+        tracer = trace.Tracer()
+        with tracer.span('clone mediawiki/core', 'clone', dest='src'):
+            pass
+        self.assertEqual({'dest': 'src'}, tracer.events[0]['args'])
+
+    def test_sample(self):
+        tracer = trace.Tracer()
+        proc = subprocess.Popen(['sleep', '10'])
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.kill)
+
+        tracer.sample()
+        tracer.sample()
+
+        self.assertEqual('sleep', tracer.processes[proc.pid]['name'])
+        self.assertEqual('sleep 10', tracer.processes[proc.pid]['cmdline'])
+        self.assertEqual(
+            ['rss', 'rss', 'cpu', 'io'],
+            [e['name'] for e in tracer.events])
+        self.assertIn('cores', tracer.events[2]['args'])
+
+    def test_read_stat(self):
+        (comm, cpu, rss) = trace.read_stat(os.getpid())
+        self.assertGreater(cpu, 0)
+        self.assertGreater(rss, 0)
+
+    def test_dump(self):
+        tracer = trace.Tracer(interval=0.01)
+        tracer.start()
+        with tracer.span('start db', 'backend'):
+            subprocess.check_call(['sleep', '0.1'])
+        tracer.stop()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'trace.json')
+            tracer.dump(filename)
+            with open(filename) as f:
+                events = json.load(f)['traceEvents']
+
+        names = {(e['ph'], e['name']) for e in events}
+        self.assertIn(('M', 'process_name'), names)
+        self.assertIn(('M', 'thread_name'), names)
+        self.assertIn(('X', 'start db'), names)
+        self.assertIn(('X', 'sleep'), names)
+        self.assertIn(('C', 'cpu'), names)
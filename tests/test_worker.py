@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from quibble.backend import SQLite
+from quibble.worker import WarmBackends
+from quibble.worker import Worker
+from quibble.worker import WorkerJob
+from quibble.worker import submit
+
+
+def mock_backend():
+    backend = mock.Mock()
+    backend.peak_rss.return_value = 0
+    return backend
+
+
+class TestWarmBackends(unittest.TestCase):
+
+    def test_backends_are_reset_between_jobs(self):
+        backend = mock_backend()
+        registry = WarmBackends()
+        registry.register('db', lambda: backend, key='mysql')
+        with registry:
+            self.assertIs(backend, registry.get('db'))
+        backend.reset.assert_called_once_with()
+        backend.stop.assert_not_called()
+
+        registry.register('db', mock.Mock(), key='mysql')
+        with registry:
+            self.assertIs(backend, registry.get('db'))
+        backend.start.assert_called_once_with()
+
+    def test_databases_are_dumped_at_the_end_of_each_job(self):
+        with tempfile.TemporaryDirectory() as dump_dir:
+            registry = WarmBackends()
+            registry.register('db', lambda: SQLite(dump_dir=dump_dir),
+                              key=('sqlite', dump_dir))
+            dump = os.path.join(dump_dir, 'wikidb.sqlite.gz')
+            for job in range(2):
+                with registry:
+                    db = registry.get('db')
+                    conn = sqlite3.connect(
+                        os.path.join(db.rootdir, 'wikidb.sqlite'))
+                    with conn:
+                        conn.execute('CREATE TABLE page (title TEXT)')
+                    conn.close()
+                self.assertTrue(os.path.exists(dump), 'job %s' % job)
+                os.unlink(dump)
+                # Reset and not stopped
+                self.assertIs(db, registry.get('db'))
+            registry.stop()
+
+    def test_restarted_when_key_changes(self):
+        (mysql, sqlite) = (mock_backend(), mock_backend())
+        registry = WarmBackends()
+        registry.register('db', lambda: mysql, key='mysql')
+        registry.get('db')
+        registry.register('db', lambda: sqlite, key='sqlite')
+
+        self.assertIs(sqlite, registry.get('db'))
+        mysql.stop.assert_called_once_with()
+
+    def test_key_can_be_callable(self):
+        registry = WarmBackends()
+        key = ['a']
+        registry.register('web', mock_backend, key=lambda: key[0])
+        web = registry.get('web')
+        self.assertIs(web, registry.get('web'))
+        key[0] = 'b'
+        self.assertIsNot(web, registry.get('web'))
+
+    def test_stopped_when_reset_fails(self):
+        backend = mock_backend()
+        backend.reset.side_effect = Exception('can not be reset')
+        registry = WarmBackends()
+        registry.register('db', lambda: backend)
+        with registry:
+            registry.get('db')
+        backend.stop.assert_called_once_with()
+        self.assertNotIn('db', registry)
+
+
+class TestWorker(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+        self.socket = os.path.join(self._tmpdir.name, 'worker.sock')
+        self.worker = Worker(self.socket, runtime_dir=self._tmpdir.name)
+        self.addCleanup(self.worker.resources.release)
+
+    @mock.patch.dict('os.environ', {'ZUUL_PROJECT': 'mediawiki/core'})
+    @mock.patch('quibble.worker.WorkerJob.execute')
+    def test_run_job_restores_environment(self, execute):
+        def job(args):
+            self.assertEqual('mediawiki/extensions/Foo',
+                             os.environ['ZUUL_PROJECT'])
+            os.environ['MW_INSTALL_PATH'] = '/workspace/src'
+        execute.side_effect = job
+
+        result = self.worker.run_job({
+            'args': ['--skip-zuul'],
+            'env': {'ZUUL_PROJECT': 'mediawiki/extensions/Foo'}})
+
+        self.assertEqual('passed', result['status'])
+        execute.assert_called_once_with(['--skip-zuul'])
+        self.assertEqual('mediawiki/core', os.environ['ZUUL_PROJECT'])
+        self.assertNotIn('MW_INSTALL_PATH', os.environ)
+
+    @mock.patch('quibble.worker.WorkerJob.execute',
+                side_effect=Exception('phpunit failed'))
+    def test_run_job_reports_failure(self, _):
+        result = self.worker.run_job({'args': []})
+        self.assertEqual('failed', result['status'])
+        self.assertEqual('phpunit failed', result['error'])
+
+    def test_job_uses_worker_backends_and_resources(self):
+        job = WorkerJob(self.worker)
+        job.allocate_resources()
+        self.assertIs(self.worker.backends, job.backends)
+        self.assertIs(self.worker.resources, job.resources)
+        self.assertEqual(self.worker.http_port, job.http_port)
+
+    def test_engine_ports_are_kept_while_web_servers_run(self):
+        job = WorkerJob(self.worker)
+        job.args = job.parse_arguments(args=['--db', 'mysql,sqlite'])
+        job.allocate_resources()
+        job.setup_engine_runs()
+        (mysql, sqlite) = job.engine_runs
+        self.worker.backends.register('web-mysql', lambda: mock.Mock(
+            port=mysql.http_port))
+        self.worker.backends.get('web-mysql')
+
+        job.free_engine_ports()
+        # Bound by the warm web server
+        self.assertIn('port-%s' % mysql.http_port,
+                      self.worker.resources._locks)
+        self.assertNotIn('port-%s' % sqlite.http_port,
+                         self.worker.resources._locks)
+
+        # Handed to the next job
+        job = WorkerJob(self.worker)
+        job.args = job.parse_arguments(args=['--db', 'mysql,sqlite'])
+        job.allocate_resources()
+        job.setup_engine_runs()
+        self.assertEqual(mysql.http_port, job.engine_runs[0].http_port)
+
+    def test_job_removes_repos_of_earlier_jobs(self):
+        src = os.path.join(self._tmpdir.name, 'src')
+        for repo in ['extensions/Foo', 'extensions/Bar', 'skins/Vector']:
+            os.makedirs(os.path.join(src, repo, '.git'))
+        # Shipped by mediawiki/core
+        os.makedirs(os.path.join(src, 'extensions/README'))
+
+        job = WorkerJob(self.worker)
+        job.mw_install_path = src
+        job.remove_stale_repos(['mediawiki/core', 'mediawiki/extensions/Foo'])
+
+        self.assertEqual(['Foo', 'README'],
+                         sorted(os.listdir(os.path.join(src, 'extensions'))))
+        self.assertEqual([], os.listdir(os.path.join(src, 'skins')))
+
+    def test_submit(self):
+        server = self.worker.server()
+        self.addCleanup(server.server_close)
+        self.assertEqual(0, os.stat(self.socket).st_mode & 0o077)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with mock.patch.object(self.worker, 'run_job',
+                                   return_value={'status': 'passed'}) as run:
+                result = submit(self.socket, ['--run', 'phpunit'],
+                                env={'ZUUL_PROJECT': 'mediawiki/core'})
+        finally:
+            server.shutdown()
+            thread.join()
+
+        self.assertEqual({'status': 'passed'}, result)
+        run.assert_called_once_with({
+            'args': ['--run', 'phpunit'],
+            'env': {'ZUUL_PROJECT': 'mediawiki/core'}})
@@ -1,8 +1,12 @@
 import os
+import subprocess
+import tempfile
 import unittest
 from unittest import mock
 
+import quibble.trace
 import quibble.zuul
+from zuul.merger.merger import Repo
 
 
 class TestClone(unittest.TestCase):
@@ -69,6 +73,18 @@ class TestClone(unittest.TestCase):
         self.assertEquals('REL1_42',
                           kwargs['project_branches']['mediawiki/vendor'])
 
+    @mock.patch('zuul.lib.cloner.Cloner.prepareRepo')
+    def test_traced_clone(self, mock_prepare):
+        tracer = quibble.trace.Tracer()
+        with tempfile.TemporaryDirectory() as workspace:
+            quibble.zuul.clone(
+                ['mediawiki/core', 'mediawiki/skins/Vector'],
+                workspace, None, tracer=tracer)
+        self.assertEqual(2, mock_prepare.call_count)
+        self.assertEqual(
+            ['clone mediawiki/core', 'clone mediawiki/skins/Vector'],
+            [e['name'] for e in tracer.events])
+
 
 class TestRepoDir(unittest.TestCase):
 
@@ -85,3 +101,222 @@ class TestRepoDir(unittest.TestCase):
     def test_maps_skins_to_extensions_directory(self):
         self.assertEqual('skins/NiceSkin',
                          quibble.zuul.repo_dir('mediawiki/skins/NiceSkin'))
+
+
+class TestGitMirror(unittest.TestCase):
+
+    def test_finds_bare_mirror(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            mirror = os.path.join(cache_dir, 'mediawiki/extensions/Foo.git')
+            os.makedirs(mirror)
+            self.assertEqual(mirror, quibble.zuul.git_mirror(
+                'https://gerrit.example.org/r/p/mediawiki/extensions/Foo.git',
+                cache_dir))
+
+    def test_no_mirror(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.assertIsNone(quibble.zuul.git_mirror(
+                'https://gerrit.example.org/r/mediawiki/extensions/Foo',
+                cache_dir))
+        self.assertIsNone(quibble.zuul.git_mirror(
+            'https://gerrit.example.org/r/mediawiki/extensions/Foo', None))
+
+
+class TestSubmoduleUpdate(unittest.TestCase):
+
+    def git(self, *args, cwd=None):
+        subprocess.check_call(
+            ['git', '-c', 'user.name=Quibble',
+             '-c', 'user.email=q@example.org'] + list(args),
+            cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    @mock.patch.dict(os.environ, {
+        'GIT_CONFIG_PARAMETERS': "'protocol.file.allow=always'"})
+    def test_update_from_mirror(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            upstream = os.path.join(tmp, 'upstream', 'lib')
+            self.git('init', '-q', upstream)
+            self.git('commit', '-q', '--allow-empty', '-m', 'lib',
+                     cwd=upstream)
+
+            cache_dir = os.path.join(tmp, 'cache')
+            self.git('clone', '-q', '--bare', upstream,
+                     os.path.join(cache_dir, 'lib.git'))
+
+            ext = os.path.join(tmp, 'ext')
+            self.git('init', '-q', ext)
+            self.git('submodule', 'add', upstream, 'lib', cwd=ext)
+            self.git('commit', '-q', '-m', 'submodule', cwd=ext)
+            # Start from a pristine clone with the submodule not fetched
+            clone = os.path.join(tmp, 'clone')
+            self.git('clone', '-q', ext, clone)
+
+            quibble.zuul.submodule_update(clone, jobs=2, cache_dir=cache_dir)
+
+            alternates = os.path.join(
+                clone, '.git', 'modules', 'lib', 'objects', 'info',
+                'alternates')
+            self.assertTrue(os.path.exists(alternates),
+                            'Submodule must use the mirror as reference')
+            self.assertTrue(
+                os.path.exists(os.path.join(clone, 'lib', '.git')))
+
+
+class TestCloner(unittest.TestCase):
+
+    def git(self, *args, cwd=None):
+        return subprocess.check_output(
+            ['git', '-c', 'user.name=Quibble',
+             '-c', 'user.email=q@example.org'] + list(args),
+            cwd=cwd, stderr=subprocess.DEVNULL).decode().strip()
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmpdir.cleanup)
+        tmp = self._tmpdir.name
+
+        # Upstream has master, the Zuul merger a ref for a change on master
+        self.git_dir = os.path.join(tmp, 'git')
+        self.zuul_dir = os.path.join(tmp, 'zuul')
+        work = os.path.join(tmp, 'work')
+        self.git('init', '-q', '-b', 'master', work)
+        self.git('commit', '-q', '--allow-empty', '-m', 'base', cwd=work)
+        self.git('clone', '-q', '--bare', work,
+                 os.path.join(self.git_dir, 'project'))
+        self.git('clone', '-q', '--bare', work,
+                 os.path.join(self.zuul_dir, 'project'))
+        self.git('commit', '-q', '--allow-empty', '-m', 'change', cwd=work)
+        self.change = self.git('rev-parse', 'HEAD', cwd=work)
+        self.git('push', '-q', os.path.join(self.zuul_dir, 'project'),
+                 'HEAD:refs/zuul/master/Z1', cwd=work)
+
+        self.workspace = os.path.join(tmp, 'workspace')
+        zuul_refs = mock.patch.object(
+            quibble.zuul.Cloner, 'zuulRefs', autospec=True,
+            side_effect=quibble.zuul.Cloner.zuulRefs)
+        self.zuul_refs = zuul_refs.start()
+        self.addCleanup(zuul_refs.stop)
+        fetch = mock.patch('zuul.merger.merger.Repo.fetchFrom',
+                           autospec=True,
+                           side_effect=Repo.fetchFrom)
+        self.fetch = fetch.start()
+        self.addCleanup(fetch.stop)
+
+    def clone(self, zuul_ref, branch=None):
+        cloner = quibble.zuul.Cloner(
+            git_base_url='file://%s' % self.git_dir,
+            projects=['project'],
+            workspace=self.workspace,
+            zuul_branch='master',
+            zuul_ref=zuul_ref,
+            zuul_url='file://%s' % self.zuul_dir,
+            branch=branch)
+        cloner.clone_map = [{'name': 'project', 'dest': '.'}]
+        cloner.execute()
+        return self.git('rev-parse', 'HEAD', cwd=self.workspace)
+
+    def test_fetches_zuul_ref(self):
+        self.assertEqual(self.change, self.clone('refs/zuul/master/Z1'))
+        # A single ref is fetched without asking Zuul first
+        self.zuul_refs.assert_not_called()
+        self.assertEqual(1, self.fetch.call_count)
+
+    def test_missing_zuul_ref(self):
+        head = self.clone('refs/zuul/master/Z2')
+        self.assertNotEqual(self.change, head)
+        self.assertEqual(1, self.fetch.call_count)
+
+    def test_single_query_for_override_and_fallback_refs(self):
+        # The branch does not exist, Zuul has the master ref
+        self.assertEqual(self.change,
+                         self.clone('refs/zuul/master/Z1', branch='REL1_42'))
+        self.zuul_refs.assert_called_once_with(
+            mock.ANY, mock.ANY, 'project',
+            ['refs/zuul/REL1_42/Z1', 'refs/zuul/master/Z1'])
+        self.fetch.assert_called_once_with(
+            mock.ANY, mock.ANY, 'refs/zuul/master/Z1')
+
+    def test_missing_override_and_fallback_refs_are_not_fetched(self):
+        head = self.clone('refs/zuul/master/Z2', branch='REL1_42')
+        self.assertNotEqual(self.change, head)
+        self.assertEqual(1, self.zuul_refs.call_count)
+        self.fetch.assert_not_called()
+
+    def test_update_fetches_from_cache_first(self):
+        self.clone(None)
+
+        # Upstream moved on, the cache mirrors all but its last commit
+        work = os.path.join(self._tmpdir.name, 'work')
+        self.git('commit', '-q', '--allow-empty', '-m', 'merged', cwd=work)
+        self.git('push', '-q', os.path.join(self.git_dir, 'project'),
+                 'HEAD:master', cwd=work)
+        cache_dir = os.path.join(self._tmpdir.name, 'cache')
+        self.git('clone', '-q', '--bare',
+                 os.path.join(self.git_dir, 'project'),
+                 os.path.join(cache_dir, 'project.git'))
+        self.git('commit', '-q', '--allow-empty', '-m', 'tip', cwd=work)
+        self.git('push', '-q', os.path.join(self.git_dir, 'project'),
+                 'HEAD:master', cwd=work)
+        tip = self.git('rev-parse', 'HEAD', cwd=work)
+
+        cloner = quibble.zuul.Cloner(
+            git_base_url='file://%s' % self.git_dir,
+            projects=['project'],
+            workspace=self.workspace,
+            zuul_branch='master', zuul_ref=None, zuul_url=None,
+            cache_dir=cache_dir)
+        cloner.clone_map = [{'name': 'project', 'dest': '.'}]
+        with self.assertLogs('zuul.Repo', level='INFO') as logs:
+            cloner.execute()
+
+        self.assertEqual(tip, self.git('rev-parse', 'HEAD',
+                                       cwd=self.workspace))
+        self.assertRegex(
+            '\n'.join(logs.output),
+            r'Fetched \d+ KiB from cache .*project\.git and \d+ KiB from '
+            'origin')
+        # The cache is not a remote of its own
+        self.assertEqual(
+            'file://%s/project' % self.git_dir,
+            self.git('config', 'remote.origin.url', cwd=self.workspace))
+
+    def test_stale_cache_does_not_change_origin_refs(self):
+        self.clone(None)
+
+        # The cache has a branch since deleted upstream
+        work = os.path.join(self._tmpdir.name, 'work')
+        cache_dir = os.path.join(self._tmpdir.name, 'cache')
+        self.git('clone', '-q', '--bare',
+                 os.path.join(self.git_dir, 'project'),
+                 os.path.join(cache_dir, 'project.git'))
+        self.git('push', '-q', os.path.join(cache_dir, 'project.git'),
+                 'HEAD:refs/heads/deleted', cwd=work)
+        # Gerrit changes are not needed
+        self.git('push', '-q', os.path.join(cache_dir, 'project.git'),
+                 'HEAD:refs/changes/01/1/1', cwd=work)
+
+        cloner = quibble.zuul.Cloner(
+            git_base_url='file://%s' % self.git_dir,
+            projects=['project'],
+            workspace=self.workspace,
+            zuul_branch='master', zuul_ref=None, zuul_url=None,
+            cache_dir=cache_dir)
+        cloner.clone_map = [{'name': 'project', 'dest': '.'}]
+        cloner.execute()
+
+        self.assertEqual(
+            'origin/HEAD -> origin/master\norigin/master',
+            '\n'.join(line.strip() for line in self.git(
+                'branch', '-r', cwd=self.workspace).splitlines()))
+        self.assertEqual(
+            self.change,
+            self.git('rev-parse', 'refs/cache/heads/deleted',
+                     cwd=self.workspace))
+        self.assertNotIn('changes', self.git(
+            'for-each-ref', '--format=%(refname)', cwd=self.workspace))
+
+    def test_update_without_cache_does_not_measure_objects(self):
+        with mock.patch('zuul.merger.merger.Repo.objectsSize') as size:
+            self.clone(None)
+            self.clone(None)
+        size.assert_not_called()
@@ -84,56 +84,81 @@ class Cloner(object):
         repo_is_cloned = os.path.exists(os.path.join(dest, '.git'))
 
         repo_cache = None
-        if (self.cache_dir and not repo_is_cloned):
+        if self.cache_dir:
             if os.path.exists(git_cache_bare):
                 repo_cache = git_cache_bare
             elif os.path.exists(git_cache):
                 repo_cache = git_cache
 
-            if repo_cache:
-                if self.cache_no_hardlinks:
-                    # file:// tells git not to hard-link across repos
-                    repo_cache = 'file://%s' % repo_cache
+        if repo_cache and not repo_is_cloned:
+            clone_source = repo_cache
+            if self.cache_no_hardlinks:
+                # file:// tells git not to hard-link across repos
+                clone_source = 'file://%s' % repo_cache
 
-                self.log.info("Creating repo %s from cache %s",
-                              project, repo_cache)
-                new_repo = git.Repo.clone_from(repo_cache, dest)
-                self.log.info("Updating origin remote in repo %s to %s",
-                              project, git_upstream)
-                new_repo.remotes.origin.config_writer.set('url', git_upstream)
-
-        if not repo_cache:
+            self.log.info("Creating repo %s from cache %s",
+                          project, clone_source)
+            new_repo = git.Repo.clone_from(clone_source, dest)
+            self.log.info("Updating origin remote in repo %s to %s",
+                          project, git_upstream)
+            new_repo.remotes.origin.config_writer.set('url', git_upstream)
+        elif not repo_cache:
             self.log.info("Creating repo %s from upstream %s",
                           project, git_upstream)
 
+        # Updates fetch from the cache first, then only what is missing
+        # from upstream
         repo = Repo(
             remote=git_upstream,
             local=dest,
             email=None,
-            username=None)
+            username=None,
+            cache=repo_cache)
 
         if not repo.isInitialized():
             raise Exception("Error cloning %s to %s" % (git_upstream, dest))
 
         return repo
 
-    def fetchFromZuul(self, repo, project, ref):
+    def zuulRefs(self, repo, project, refs):
+        """Return which of refs Zuul has for project, asking it once"""
         zuul_remote = '%s/%s' % (self.zuul_url, project)
 
         try:
-            repo.fetchFrom(zuul_remote, ref)
-            self.log.debug("Fetched ref %s from %s", ref, project)
+            found = repo.lsRemote(zuul_remote, *refs)
+        except GitCommandError as error:
+            # Bail out if the query fails due to infrastructure reasons
+            if 'fatal: unable to access' in error.stderr:
+                raise
+            self.log.debug("Project %s is not in Zuul", project)
+            return set()
+
+        available = set()
+        for ref in refs:
+            if ref in found:
+                available.add(ref)
+            else:
+                self.log.debug("Project %s in Zuul does not have ref %s",
+                               project, ref)
+        return available
+
+    def fetchFromZuul(self, repo, project, *refs):
+        zuul_remote = '%s/%s' % (self.zuul_url, project)
+
+        try:
+            repo.fetchFrom(zuul_remote, *refs)
+            self.log.debug("Fetched %s from %s", ', '.join(refs), project)
             return True
         except ValueError:
-            self.log.debug("Project %s in Zuul does not have ref %s",
-                           project, ref)
+            self.log.debug("Project %s in Zuul does not have %s",
+                           project, ', '.join(refs))
             return False
         except GitCommandError as error:
             # Bail out if fetch fails due to infrastructure reasons
-            if error.stderr.startswith('fatal: unable to access'):
+            if 'fatal: unable to access' in error.stderr:
                 raise
-            self.log.debug("Project %s in Zuul does not have ref %s",
-                           project, ref)
+            self.log.debug("Project %s in Zuul does not have %s",
+                           project, ', '.join(refs))
             return False
 
     def prepareRepo(self, project, dest):
@@ -198,6 +223,22 @@ class Cloner(object):
         else:
             fallback_zuul_ref = None
 
+        # Zuul refs by order of preference. When there are several, ask Zuul
+        # once which ones it has rather than trying to fetch each of them.
+        if indicated_revision:
+            wanted = [self.zuul_ref]
+        else:
+            wanted = [override_zuul_ref]
+            if fallback_zuul_ref != override_zuul_ref:
+                wanted.append(fallback_zuul_ref)
+        wanted = [ref for ref in wanted if ref]
+        if len(wanted) > 1:
+            available = self.zuulRefs(repo, project, wanted)
+            zuul_refs = [ref for ref in wanted if ref in available]
+        else:
+            # A failed fetch tells it is missing, in a single round trip
+            zuul_refs = wanted
+
         # If the user has requested an explicit revision to be checked out,
         # we use it above all else, and if we cannot satisfy this requirement
         # we raise an error and do not attempt to continue.
@@ -205,7 +246,8 @@ class Cloner(object):
             self.log.info("Attempting to check out revision %s for "
                           "project %s", indicated_revision, project)
             try:
-                self.fetchFromZuul(repo, project, self.zuul_ref)
+                if zuul_refs:
+                    self.fetchFromZuul(repo, project, *zuul_refs)
                 commit = repo.checkout(indicated_revision)
             except (ValueError, GitCommandError):
                 raise exceptions.RevNotFound(project, indicated_revision)
@@ -213,11 +255,7 @@ class Cloner(object):
                           indicated_revision)
         # If we have a non empty zuul_ref to use, use it. Otherwise we fall
         # back to checking out the branch.
-        elif ((override_zuul_ref and
-              self.fetchFromZuul(repo, project, override_zuul_ref)) or
-              (fallback_zuul_ref and
-               fallback_zuul_ref != override_zuul_ref and
-              self.fetchFromZuul(repo, project, fallback_zuul_ref))):
+        elif zuul_refs and self.fetchFromZuul(repo, project, zuul_refs[0]):
             # Work around a bug in GitPython which can not parse FETCH_HEAD
             gitcmd = git.Git(dest)
             fetch_head = gitcmd.rev_parse('FETCH_HEAD')
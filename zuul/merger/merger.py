@@ -41,8 +41,10 @@ class ZuulReference(git.Reference):
 class Repo(object):
     log = logging.getLogger("zuul.Repo")
 
-    def __init__(self, remote, local, email, username):
+    def __init__(self, remote, local, email, username, cache=None):
         self.remote_url = remote
+        # Local mirror of remote to fetch from first
+        self.cache = cache
         self.local_path = local
         self.email = email
         self.username = username
@@ -175,9 +177,18 @@ class Repo(object):
         except AssertionError:
             origin.fetch(ref)
 
-    def fetchFrom(self, repository, refspec):
+    def fetchFrom(self, repository, *refspecs):
         repo = self.createRepoObject()
-        repo.git.fetch(repository, refspec)
+        repo.git.fetch(repository, *refspecs)
+
+    def lsRemote(self, repository, *patterns):
+        """Map the refs of repository matching patterns to their commit"""
+        repo = self.createRepoObject()
+        refs = {}
+        for line in repo.git.ls_remote(repository, *patterns).splitlines():
+            commit, name = line.split('\t', 1)
+            refs[name] = commit
+        return refs
 
     def createZuulRef(self, ref, commit='HEAD'):
         repo = self.createRepoObject()
@@ -191,9 +202,32 @@ class Repo(object):
                                                 self.remote_url))
         repo.remotes.origin.push('%s:%s' % (local, remote))
 
+    def objectsSize(self, repo):
+        """Size of the object database in KiB"""
+        counts = dict(line.split(': ', 1) for line in
+                      repo.git.count_objects('-v').splitlines())
+        return int(counts['size']) + int(counts['size-pack'])
+
+    def updateFromCache(self, repo):
+        """Fetch the refs of the local mirror under refs/cache/, leaving
+        origin only the objects newer than the mirror. The mirror may be
+        stale: the refs of origin are only updated by fetching origin"""
+        try:
+            repo.git.fetch('--prune', self.cache,
+                           '+refs/heads/*:refs/cache/heads/*',
+                           '+refs/tags/*:refs/cache/tags/*')
+        except git.GitCommandError:
+            self.log.warning("Unable to fetch from cache %s" % self.cache,
+                             exc_info=True)
+
     def update(self):
         repo = self.createRepoObject()
         self.log.debug("Updating repository %s" % self.local_path)
+        if self.cache:
+            # Sizes read once per source
+            sizes = [self.objectsSize(repo)]
+            self.updateFromCache(repo)
+            sizes.append(self.objectsSize(repo))
         origin = repo.remotes.origin
         if repo.git.version_info[:2] < (1, 9):
             # Before 1.9, 'git fetch --tags' did not include the
@@ -203,3 +237,9 @@ class Repo(object):
             # https://github.com/git/git/blob/master/Documentation/RelNotes/1.9.0.txt#L18-L20
             origin.fetch()
         origin.fetch(tags=True)
+        if self.cache:
+            sizes.append(self.objectsSize(repo))
+            self.log.info("Fetched %s KiB from cache %s and %s KiB from "
+                          "origin into %s" % (sizes[1] - sizes[0], self.cache,
+                                              sizes[2] - sizes[1],
+                                              self.local_path))